@@ -20,7 +20,7 @@ with open('requirements.txt') as f:
 h = SetupHelper(initfile="tredparse/__init__.py", readmefile="README.md")
 h.check_version(name, majorv=2, minorv=7)
 
-libssw_ext = {"sources": ["src/ssw.c"], "include_dirs": ["src"]}
+libssw_ext = {"sources": ["src/ssw.c", "src/repeat_graph.c", "src/ssw_batch.c", "src/myers.c"], "include_dirs": ["src"]}
 
 setup(
       name=name,
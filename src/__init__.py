@@ -1 +1,2 @@
-from . ssw_wrap import Aligner
+from . ssw_wrap import Aligner, AlignerPanel, FlankFinder, PackedSeq, \
+    QueryProfile, RepeatGraphAligner
@@ -0,0 +1,52 @@
+/*
+ *  myers.c
+ *
+ *  Bit-parallel approximate matching (Myers, 1999) of a pattern of at most 64
+ *  bases anywhere in a read. The vertical deltas of the column of the edit
+ *  distance matrix are kept as the bit vectors pv (+1) and mv (-1), and the
+ *  score of the last row is updated from the horizontal delta at its bit:
+ *
+ *      pattern   i = 0 .. m - 1     (bit i)
+ *      read      j = 0 .. readLen - 1
+ *      score     edit distance of the pattern to a substring ending at j
+ *
+ */
+
+#include <stdint.h>
+#include "myers.h"
+
+int32_t myers_find (const uint64_t* peq,
+					const int32_t m,
+					const int8_t* read,
+					const int32_t readLen,
+					const int32_t max_edits,
+					const int8_t reverse) {
+
+	uint64_t mask = m < 64 ? ((uint64_t)1 << m) - 1 : ~(uint64_t)0;
+	uint64_t high = (uint64_t)1 << (m - 1);
+	uint64_t pv = mask, mv = 0, eq, xv, xh, ph, mh;
+	int32_t score = m, best = max_edits + 1, best_end = -1, ties = 0, i, j;
+	int8_t base;
+
+	for (i = 0; i < readLen; ++i) {
+		j = reverse ? readLen - 1 - i : i;
+		base = read[j];
+		eq = base >= 0 && base <= 4 ? peq[base] : 0;
+		xv = eq | mv;
+		xh = ((((eq & pv) + pv) & mask) ^ pv) | eq;
+		ph = mv | (~(xh | pv) & mask);
+		mh = pv & xh;
+		if (ph & high) ++score;
+		else if (mh & high) --score;
+		ph = (ph << 1) & mask;
+		mh = (mh << 1) & mask;
+		pv = mh | (~(xv | ph) & mask);
+		mv = ph & xv;
+		if (score < best) {
+			best = score;
+			best_end = j;
+			ties = 0;
+		} else if (score == best) ++ties;
+	}
+	return ties ? -1 : best_end;
+}
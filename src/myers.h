@@ -0,0 +1,41 @@
+/*
+ *  myers.h
+ *
+ *  Approximate search of a short pattern anywhere in a read, with the
+ *  bit-parallel algorithm of Myers (1999). The pattern fits in one 64 bits
+ *  word, so that each base of the read costs a few word operations.
+ *
+ */
+
+#ifndef MYERS_H
+#define MYERS_H
+
+#include <stdint.h>
+
+#ifdef __cplusplus
+extern "C" {
+#endif	// __cplusplus
+
+/*!	@function	Find where the best match of the pattern ends in the read, with at most max_edits edits.
+	@param	peq	bit vectors of the positions of each base (0 to 4) in the pattern; a pattern N sets the bit of the four
+				bases A, C, G, T, while the vector of N is 0 so that a read N matches nothing
+	@param	m	length of the pattern, from 1 to 64
+	@param	read	pointer to the read sequence; the read sequence needs to be numbers
+	@param	readLen	length of the read
+	@param	max_edits	most edits of the match
+	@param	reverse	0 to scan the read from its first base, 1 from its last base; the pattern is then expected reversed
+	@return	0-based position in the read of the last base of the best match in the scan order, -1 when the best match
+			has more than max_edits edits or ends at several positions
+*/
+int32_t myers_find (const uint64_t* peq,
+					const int32_t m,
+					const int8_t* read,
+					const int32_t readLen,
+					const int32_t max_edits,
+					const int8_t reverse);
+
+#ifdef __cplusplus
+}
+#endif	// __cplusplus
+
+#endif	// MYERS_H
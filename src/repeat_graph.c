@@ -0,0 +1,194 @@
+/*
+ *  repeat_graph.c
+ *
+ *  Local alignment of a read against the repeat graph of a STR locus:
+ *
+ *                      +---------+
+ *                      v         |
+ *      prefix  --->  motif  -----+--->  suffix
+ *
+ *  The graph nodes are the bases of the prefix flank, of one copy of the motif
+ *  and of the suffix flank. The last base of the motif goes either back to the
+ *  first base of the motif (one more repeat unit) or to the suffix flank. Each
+ *  cell of the dynamic programming matrix keeps the number of repeat units and
+ *  the starting position of the best path that ends there, so that one pass
+ *  (affine gaps, as in ssw.c) gives both the best score and the unit count.
+ *
+ */
+
+#include <stdint.h>
+#include <stdlib.h>
+#include "repeat_graph.h"
+
+#define NEG_INF (INT32_MIN / 2)
+
+typedef struct {
+	int32_t score;
+	int32_t units;		// number of repeat units used by the path, 0 while in the prefix
+	int32_t start_read;	// 0-based read position where the path starts; -1 for an empty cell
+	int32_t start_node;	// graph node where the path starts
+} cell;
+
+/* Higher score first, then fewer repeat units */
+static inline int32_t better (const cell* a, const cell* b) {
+	return a->score > b->score || (a->score == b->score && a->units < b->units);
+}
+
+/* Extend the path of c into the next node, paying penalty, and keep it if better than target */
+static inline void relax (cell* target, const cell* c, int32_t penalty, int32_t units) {
+	cell cand;
+	if (c->start_read < 0) return;
+	cand.score = c->score - penalty;
+	cand.units = units;
+	cand.start_read = c->start_read;
+	cand.start_node = c->start_node;
+	if (better(&cand, target)) *target = cand;
+}
+
+static inline void empty (cell* c) {
+	c->score = NEG_INF;
+	c->units = 0;
+	c->start_read = -1;
+	c->start_node = -1;
+}
+
+int32_t repeat_graph_align (const int8_t* read,
+					const int32_t readLen,
+					const int8_t* prefix,
+					const int32_t prefixLen,
+					const int8_t* motif,
+					const int32_t motifLen,
+					const int8_t* suffix,
+					const int32_t suffixLen,
+					const int8_t* mat,
+					const int32_t n,
+					const uint8_t weight_gapO,
+					const uint8_t weight_gapE,
+					s_repeat_align* result) {
+
+	const int32_t p = prefixLen, m = motifLen, s = suffixLen;
+	const int32_t nodes = p + m + s, motif0 = p, motif1 = p + m - 1, suffix0 = p + m;
+	int32_t i, v, score, changed, aLhang, aRhang, bLhang, bRhang;
+	int8_t* seq;
+	cell *h_prev, *h, *hp, *e, *f, *tmp, best;
+
+	result->score = 0;
+	result->units = 1;
+	result->ref_begin = result->ref_end = result->read_begin = result->read_end = result->hang = -1;
+	if (readLen <= 0 || m <= 0 || p < 0 || s < 0) return -1;
+
+	seq = (int8_t*)malloc(nodes * sizeof(int8_t));
+	h_prev = (cell*)malloc(nodes * sizeof(cell));
+	h = (cell*)malloc(nodes * sizeof(cell));
+	hp = (cell*)malloc(nodes * sizeof(cell));
+	e = (cell*)malloc(nodes * sizeof(cell));
+	f = (cell*)malloc(nodes * sizeof(cell));
+	if (!seq || !h_prev || !h || !hp || !e || !f) {
+		free(seq); free(h_prev); free(h); free(hp); free(e); free(f);
+		return -1;
+	}
+
+	for (v = 0; v < p; ++v) seq[v] = prefix[v];
+	for (v = 0; v < m; ++v) seq[p + v] = motif[v];
+	for (v = 0; v < s; ++v) seq[suffix0 + v] = suffix[v];
+	for (v = 0; v < nodes; ++v) {
+		empty(&h_prev[v]);
+		empty(&e[v]);
+	}
+	empty(&best);
+	best.score = 0;
+
+	for (i = 0; i < readLen; ++i) {
+		const int8_t* row = mat + read[i];
+
+		/* Match or mismatch from the previous read base, or gap in the reference (e) */
+		for (v = 0; v < nodes; ++v) {
+			score = row[seq[v] * n];
+			cell* c = &hp[v];
+			c->score = score;	// start a new path here
+			c->units = (v < motif0) ? 0 : 1;
+			c->start_read = i;
+			c->start_node = v;
+			if (v == motif0) {
+				if (p > 0 && h_prev[p - 1].score > 0) relax(c, &h_prev[p - 1], -score, 1);
+				if (h_prev[motif1].score > 0) relax(c, &h_prev[motif1], -score, h_prev[motif1].units + 1);
+			} else if (v > 0 && h_prev[v - 1].score > 0) {
+				relax(c, &h_prev[v - 1], -score, h_prev[v - 1].units);
+			}
+			if (better(&e[v], c)) *c = e[v];
+		}
+
+		/* Gap in the read (f), following the graph edges: the flanks and the motif are linear, the loop edge is
+		   only crossed in a second pass around the motif, as deleting more than one full unit is never better */
+		for (v = 0; v < nodes; ++v) {
+			empty(&f[v]);
+			if (v == motif0) {
+				if (p > 0) {
+					relax(&f[v], &hp[p - 1], weight_gapO, 1);
+					relax(&f[v], &f[p - 1], weight_gapE, 1);
+				}
+			} else if (v > 0) {
+				relax(&f[v], &hp[v - 1], weight_gapO, hp[v - 1].units);
+				relax(&f[v], &f[v - 1], weight_gapE, f[v - 1].units);
+			}
+			if (v == motif1) {
+				cell old = f[motif0];
+				relax(&f[motif0], &hp[motif1], weight_gapO, hp[motif1].units + 1);
+				relax(&f[motif0], &f[motif1], weight_gapE, f[motif1].units + 1);
+				changed = better(&f[motif0], &old);
+				for (v = motif0 + 1; changed && v <= motif1; ++v) {
+					old = f[v];
+					relax(&f[v], &f[v - 1], weight_gapE, f[v - 1].units);
+					changed = better(&f[v], &old);
+				}
+				v = motif1;
+			}
+		}
+
+		for (v = 0; v < nodes; ++v) {
+			cell* c = &h[v];
+			*c = better(&f[v], &hp[v]) ? f[v] : hp[v];
+			if (c->score <= 0) {
+				empty(c);
+				c->score = 0;
+			} else if (better(c, &best)) {
+				best = *c;
+				result->read_end = i;
+				result->ref_end = v;	// graph node, placed on the reference below
+			}
+
+			/* Gap in the reference for the next read base */
+			cell ev;
+			empty(&ev);
+			relax(&ev, &e[v], weight_gapE, e[v].units);
+			relax(&ev, c, weight_gapO, c->units);
+			e[v] = ev;
+		}
+
+		tmp = h_prev; h_prev = h; h = tmp;
+	}
+
+	if (best.start_read >= 0) {
+		int32_t units = best.units > 0 ? best.units : 1, refLen;
+		result->score = best.score;
+		result->units = units;
+		result->read_begin = best.start_read;
+		/* Place the alignment on the shortest reference prefix + motif * units + suffix: paths start in the
+		   flanks or in the first unit, and the paths ending in the prefix only use one unit */
+		result->ref_begin = best.start_node;
+		result->ref_end += m * (units - 1);
+
+		refLen = p + m * units + s;
+		aLhang = result->ref_begin;
+		aRhang = refLen - result->ref_end - 1;
+		bLhang = result->read_begin;
+		bRhang = readLen - result->read_end - 1;
+		result->hang = aRhang + bLhang;
+		if (aLhang + bRhang < result->hang) result->hang = aLhang + bRhang;
+		if (aLhang + aRhang < result->hang) result->hang = aLhang + aRhang;
+		if (bLhang + bRhang < result->hang) result->hang = bLhang + bRhang;
+	}
+
+	free(seq); free(h_prev); free(h); free(hp); free(e); free(f);
+	return result->score;
+}
@@ -0,0 +1,77 @@
+/*
+ *  repeat_graph.h
+ *
+ *  Local alignment of a read against the repeat graph of a STR locus, that is
+ *  the prefix flank, followed by the repeat motif in a loop, followed by the
+ *  suffix flank. Any path through the graph spells one of the references
+ *  prefix + motif * units + suffix, so a single dynamic programming pass gives
+ *  the best alignment over all the unit counts.
+ *
+ */
+
+#ifndef REPEAT_GRAPH_H
+#define REPEAT_GRAPH_H
+
+#include <stdint.h>
+
+#ifdef __cplusplus
+extern "C" {
+#endif	// __cplusplus
+
+/*!	@typedef	structure of the alignment result against the repeat graph
+	@field	score	the best alignment score; 0 when no alignment is found
+	@field	units	number of repeat units of the shortest reference prefix + motif * units + suffix containing the best
+					alignment (at least 1)
+	@field	ref_begin	0-based best alignment beginning position on that reference
+	@field	ref_end	0-based best alignment ending position on that reference
+	@field	read_begin	0-based best alignment beginning position on read
+	@field	read_end	0-based best alignment ending position on read
+	@field	hang	smallest overhang of the alignment, among the terminal overlaps (read before reference, reference before read)
+					and the contain overlaps (read in reference, reference in read)
+*/
+typedef struct {
+	int32_t score;
+	int32_t units;
+	int32_t ref_begin;
+	int32_t ref_end;
+	int32_t read_begin;
+	int32_t read_end;
+	int32_t hang;
+} s_repeat_align;
+
+/*!	@function	Align a read against the repeat graph prefix -> (motif)+ -> suffix. Among the alignments with the best score,
+				the one using the fewest repeat units is reported.
+	@param	read	pointer to the query sequence; the query sequence needs to be numbers
+	@param	readLen	length of the query sequence
+	@param	prefix	pointer to the prefix flank sequence, as numbers
+	@param	prefixLen	length of the prefix flank, can be 0
+	@param	motif	pointer to the repeat motif sequence, as numbers
+	@param	motifLen	length of the repeat motif, must be > 0
+	@param	suffix	pointer to the suffix flank sequence, as numbers
+	@param	suffixLen	length of the suffix flank, can be 0
+	@param	mat	pointer to the substitution matrix, see function ssw_init
+	@param	n	the square root of the number of elements in mat (mat has n*n elements)
+	@param	weight_gapO	the absolute value of gap open penalty
+	@param	weight_gapE	the absolute value of gap extension penalty
+	@param	result	pointer to the alignment result structure to fill
+	@return	the best alignment score, -1 on invalid input or allocation failure
+*/
+int32_t repeat_graph_align (const int8_t* read,
+					const int32_t readLen,
+					const int8_t* prefix,
+					const int32_t prefixLen,
+					const int8_t* motif,
+					const int32_t motifLen,
+					const int8_t* suffix,
+					const int32_t suffixLen,
+					const int8_t* mat,
+					const int32_t n,
+					const uint8_t weight_gapO,
+					const uint8_t weight_gapE,
+					s_repeat_align* result);
+
+#ifdef __cplusplus
+}
+#endif	// __cplusplus
+
+#endif	// REPEAT_GRAPH_H
@@ -782,7 +782,7 @@ s_align* ssw_align (const s_profile* prof,
 				  	int32_t refLen,
 				  	const uint8_t weight_gapO,
 				  	const uint8_t weight_gapE,
-					const uint8_t flag,	//  (from high to low) bit 5: return the best alignment beginning position; 6: if (ref_end1 - ref_begin1 <= filterd) && (read_end1 - read_begin1 <= filterd), return cigar; 7: if max score >= filters, return cigar; 8: always return cigar; if 6 & 7 are both setted, only return cigar when both filter fulfilled
+					const uint8_t flag,	//  (from high to low) bit 4: never return cigar; bit 5: return the best alignment beginning position; 6: if (ref_end1 - ref_begin1 <= filterd) && (read_end1 - read_begin1 <= filterd), return cigar; 7: if max score >= filters, return cigar; 8: always return cigar; if 6 & 7 are both setted, only return cigar when both filter fulfilled
 					const uint16_t filters,
 					const int32_t filterd,
 					const int32_t maskLen) {
@@ -833,7 +833,7 @@ s_align* ssw_align (const s_profile* prof,
 		r->ref_end2 = -1;
 	}
 	free(bests);
-	if (flag == 0 || (flag == 2 && r->score1 < filters)) goto end;
+	if (flag == 0 || ((flag & ~16) == 2 && r->score1 < filters)) goto end;
 
 	// Find the beginning position of the best alignment.
 	read_reverse = seq_reverse(prof->read, r->read_end1);
@@ -849,7 +849,7 @@ s_align* ssw_align (const s_profile* prof,
 	r->ref_begin1 = bests_reverse[0].ref;
 	r->read_begin1 = r->read_end1 - bests_reverse[0].read;
 	free(bests_reverse);
-	if ((7&flag) == 0 || ((2&flag) != 0 && r->score1 < filters) || ((4&flag) != 0 && (r->ref_end1 - r->ref_begin1 > filterd || r->read_end1 - r->read_begin1 > filterd))) goto end;
+	if ((7&flag) == 0 || (16&flag) != 0 || ((2&flag) != 0 && r->score1 < filters) || ((4&flag) != 0 && (r->ref_end1 - r->ref_begin1 > filterd || r->read_end1 - r->read_begin1 > filterd))) goto end;
 
 	// Generate cigar.
 	refLen = r->ref_end1 - r->ref_begin1 + 1;
@@ -870,6 +870,66 @@ end:
 	return r;
 }
 
+static int32_t min4 (int32_t a, int32_t b, int32_t c, int32_t d) {
+	int32_t m = a < b ? a : b;
+	m = m < c ? m : c;
+	return m < d ? m : d;
+}
+
+int32_t ssw_align_panel (const s_profile* prof,
+					const int8_t* refs,
+					const int32_t* refLens,
+					const int32_t refNum,
+					const uint8_t weight_gapO,
+					const uint8_t weight_gapE,
+					const uint16_t* filters,
+					const int32_t* filterl,
+					const int32_t maskLen,
+					const int8_t best_only,
+					s_panel_align* results) {
+
+	int32_t i, passed = 0, best = -1, aLhang, aRhang, bLhang, bRhang;
+	const int8_t* ref = refs;
+	s_panel_align res;
+	s_align* a;
+
+	for (i = 0; i < refNum; ref += refLens[i], ++i) {
+		res.score = 0;
+		res.ref_begin = -1;
+		res.ref_end = res.read_begin = res.read_end = res.hang = -1;
+
+		/* Targets that fail the score filter skip the search of the beginning position */
+		a = ssw_align(prof, ref, refLens[i], weight_gapO, weight_gapE, 18, filters[i], 0, maskLen);
+		if (a != NULL) {
+			res.score = a->score1;
+			if (a->score1 >= filters[i] && a->read_end1 - a->read_begin1 + 1 >= filterl[i]) {
+				res.ref_begin = a->ref_begin1;
+				res.ref_end = a->ref_end1;
+				res.read_begin = a->read_begin1;
+				res.read_end = a->read_end1;
+				aLhang = a->ref_begin1;
+				aRhang = refLens[i] - a->ref_end1 - 1;
+				bLhang = a->read_begin1;
+				bRhang = prof->readLen - a->read_end1 - 1;
+				res.hang = min4(aRhang + bLhang, aLhang + bRhang, aLhang + aRhang, bLhang + bRhang);
+			}
+			align_destroy(a);
+		}
+
+		if (res.ref_begin < 0) {
+			if (!best_only) results[i] = res;
+			continue;
+		}
+		++ passed;
+		if (!best_only) results[i] = res;
+		else if (best < 0 || res.score > results[0].score) {
+			results[0] = res;
+			best = i;
+		}
+	}
+	return best_only ? best : passed;
+}
+
 void align_destroy (s_align* a) {
 	free(a->cigar);
 	free(a);
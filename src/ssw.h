@@ -51,6 +51,25 @@ typedef struct {
 	int32_t cigarLen;
 } s_align;
 
+/*!	@typedef	structure of the alignment result against one reference of a panel
+	@field	score	the best alignment score
+	@field	ref_begin	0-based best alignment beginning position on reference; ref_begin = -1 when the alignment does not pass
+						the filters
+	@field	ref_end	0-based best alignment ending position on reference
+	@field	read_begin	0-based best alignment beginning position on read
+	@field	read_end	0-based best alignment ending position on read
+	@field	hang	smallest overhang of the alignment, among the terminal overlaps (read before reference, reference before read)
+					and the contain overlaps (read in reference, reference in read)
+*/
+typedef struct {
+	uint16_t score;
+	int32_t ref_begin;
+	int32_t ref_end;
+	int32_t read_begin;
+	int32_t read_end;
+	int32_t hang;
+} s_panel_align;
+
 /*!	@function	Create the query profile using the query sequence.
 	@param	read	pointer to the query sequence; the query sequence needs to be numbers
 	@param	readLen	length of the query sequence
@@ -84,7 +103,8 @@ void init_destroy (s_profile* p);
 	@param	refLen	length of the target sequence
 	@param	weight_gapO	the absolute value of gap open penalty
 	@param	weight_gapE	the absolute value of gap extension penalty
-	@param	flag	bitwise FLAG; (from high to low) bit 5: when setted as 1, function ssw_align will return the best alignment
+	@param	flag	bitwise FLAG; (from high to low) bit 4: when setted as 1, (whatever bit 5, 6, 7 or 8 is setted) the function
+					will never return cigar; bit 5: when setted as 1, function ssw_align will return the best alignment
 					beginning position; bit 6: when setted as 1, if (ref_end1 - ref_begin1 < filterd && read_end1 - read_begin1
 					< filterd), (whatever bit 5 is setted) the function will return the best alignment beginning position and
 					cigar; bit 7: when setted as 1, if the best alignment score >= filters, (whatever bit 5 is setted) the function
@@ -106,8 +126,9 @@ void init_destroy (s_profile* p);
 	@return	pointer to the alignment result structure
 	@note	Whatever the parameter flag is setted, this function will at least return the optimal and sub-optimal alignment score,
 			and the optimal alignment ending positions on target and query sequences. If both bit 6 and 7 of the flag are setted
-			while bit 8 is not, the function will return cigar only when both criteria are fulfilled. All returned positions are
-			0-based coordinate.
+			while bit 8 is not, the function will return cigar only when both criteria are fulfilled. If bit 7 is the only one
+			setted besides bit 4, the function will return the best alignment beginning position only when the best alignment
+			score >= filters, and never cigar (score and coordinates only mode). All returned positions are 0-based coordinate.
 */
 s_align* ssw_align (const s_profile* prof,
 					const int8_t* ref,
@@ -119,6 +140,35 @@ s_align* ssw_align (const s_profile* prof,
 					const int32_t filterd,
 					const int32_t maskLen);
 
+/*!	@function	Align one query against a panel of references, reporting the score and the coordinates of the best alignment
+				against each of them (no cigar).
+	@param	prof	pointer to the query profile structure
+	@param	refs	pointer to the concatenated target sequences; each of them needs to be numbers and corresponding to the mat
+				parameter of function ssw_init
+	@param	refLens	pointer to the lengths of the target sequences
+	@param	refNum	number of target sequences
+	@param	weight_gapO	the absolute value of gap open penalty
+	@param	weight_gapE	the absolute value of gap extension penalty
+	@param	filters	pointer to the score filters, one per target: alignments with score < filters are reported as not passing
+	@param	filterl	pointer to the length filters, one per target: alignments spanning < filterl bases of the query are reported
+					as not passing
+	@param	maskLen	see function ssw_align
+	@param	best_only	when setted as 1, only the best passing alignment (the first one in case of ties) is written into results[0]
+	@param	results	pointer to the output array, refNum elements (1 element when best_only is setted)
+	@return	the number of passing alignments; when best_only is setted, the index of the best passing target, -1 if none
+*/
+int32_t ssw_align_panel (const s_profile* prof,
+					const int8_t* refs,
+					const int32_t* refLens,
+					const int32_t refNum,
+					const uint8_t weight_gapO,
+					const uint8_t weight_gapE,
+					const uint16_t* filters,
+					const int32_t* filterl,
+					const int32_t maskLen,
+					const int8_t best_only,
+					s_panel_align* results);
+
 /*!	@function	Release the memory allocated by function ssw_align.
 	@param	a	pointer to the alignment result structure
 */
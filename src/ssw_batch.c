@@ -0,0 +1,398 @@
+/*
+ *  ssw_batch.c
+ *
+ *  Local alignment of a batch of reads against a panel of references, with
+ *  one read per lane of the SSE2 registers:
+ *
+ *      lane      0      1            15
+ *            +------+------+-   -+-------+
+ *      row j | r0[j]| r1[j]| ... | r15[j]|   x   reference base i
+ *            +------+------+-   -+-------+
+ *
+ *  Each register holds the cell (i, j) of the dynamic programming matrices of
+ *  16 reads against the same reference, so the 16 alignments advance together
+ *  and the query profile is built once per batch rather than per reference.
+ *  The recursion is the affine gap Smith-Waterman of ssw.c, and the ending
+ *  position is the first cell reaching the best score, scanning the reference
+ *  then the read. As in ssw.c, the scores are first computed in 8 bits, and
+ *  again in 16 bits when they may have overflowed, and the beginning position
+ *  comes from a second pass over the reversed read and reference, from the
+ *  ending position back to the first cell reaching the best score.
+ *
+ */
+
+#include <stdint.h>
+#include <stdlib.h>
+#include <emmintrin.h>
+#include "ssw_batch.h"
+
+#define LANES 16		/* reads per register of 8 bits lanes */
+#define WORD_LANES 8	/* reads per register of 16 bits lanes */
+#define MAXLEN 32767	/* longest read or reference, as the positions are kept in the lanes */
+#define READ_PAD 5		/* code of the rows past the end of a read */
+#define REF_PAD 6		/* code of the columns past the beginning of a reference, in the second pass */
+#define REF_N 7			/* code of the reference N in the second pass, so that it does not match the read N */
+
+static inline __m128i blend (__m128i mask, __m128i a, __m128i b) {
+	return _mm_or_si128(_mm_and_si128(mask, a), _mm_andnot_si128(mask, b));
+}
+
+static inline int32_t min4 (int32_t a, int32_t b, int32_t c, int32_t d) {
+	int32_t m = a < b ? a : b;
+	m = m < c ? m : c;
+	return m < d ? m : d;
+}
+
+/* Smith-Waterman in 16 bits lanes of the read bases in the lanes of vRead (rows) against the reference bases in the
+   lanes of vRef (columns). For each lane, gives the best score and the first cell reaching it, scanning the columns in
+   order and the rows in order within a column. The scan stops once every lane reaches its score in vTerminate. */
+static void sw_word (const __m128i* vRead,
+					int32_t rows,
+					const __m128i* vRef,
+					int32_t cols,
+					__m128i vMatch,
+					__m128i vMismatch,
+					__m128i vGapO,
+					__m128i vGapE,
+					__m128i vTerminate,
+					__m128i* pvH,
+					__m128i* pvE,
+					int16_t* best,
+					int16_t* bestRow,
+					int16_t* bestCol) {
+
+	__m128i vZero = _mm_setzero_si128(), vN = _mm_set1_epi16(4), vOne = _mm_set1_epi16(1);
+	__m128i vBest = vZero, vRow = _mm_set1_epi16(-1), vCol = _mm_set1_epi16(-1), vI = vZero;
+	int32_t i, j;
+
+	for (j = 0; j < rows; ++j) pvH[j] = pvE[j] = vZero;
+
+	for (i = 0; i < cols; ++i, vI = _mm_add_epi16(vI, vOne)) {
+		__m128i b = vRef[i], bN = _mm_cmpeq_epi16(b, vN);
+		__m128i vF = vZero, vDiag = vZero, vJ = vZero, vUpdated = vZero;
+
+		for (j = 0; j < rows; ++j, vJ = _mm_add_epi16(vJ, vOne)) {
+			__m128i r = vRead[j], e = pvE[j], h, s, gt;
+
+			/* Match or mismatch, no penalty against an N */
+			s = blend(_mm_cmpeq_epi16(r, b), vMatch, vMismatch);
+			s = _mm_andnot_si128(_mm_or_si128(_mm_cmpeq_epi16(r, vN), bN), s);
+
+			h = _mm_adds_epi16(vDiag, s);
+			vDiag = pvH[j];
+			h = _mm_max_epi16(h, e);
+			h = _mm_max_epi16(h, vF);
+			h = _mm_max_epi16(h, vZero);
+			pvH[j] = h;
+
+			gt = _mm_cmpgt_epi16(h, vBest);
+			vBest = _mm_max_epi16(vBest, h);
+			vRow = blend(gt, vJ, vRow);
+			vUpdated = _mm_or_si128(vUpdated, gt);
+
+			/* Gap in the read (E) for the next column, gap in the reference (F) for the next row */
+			h = _mm_subs_epi16(h, vGapO);
+			pvE[j] = _mm_max_epi16(_mm_subs_epi16(e, vGapE), h);
+			vF = _mm_max_epi16(_mm_subs_epi16(vF, vGapE), h);
+		}
+
+		vCol = blend(vUpdated, vI, vCol);
+		if (_mm_movemask_epi8(_mm_cmplt_epi16(vBest, vTerminate)) == 0) break;
+	}
+
+	_mm_storeu_si128((__m128i*)best, vBest);
+	_mm_storeu_si128((__m128i*)bestRow, vRow);
+	_mm_storeu_si128((__m128i*)bestCol, vCol);
+}
+
+/* Rows of the first cells of the column pvH equal to vValue, in the lanes set in mask */
+static inline void first_rows (const __m128i* pvH, int32_t rows, __m128i vValue, int32_t mask, int32_t* row) {
+	int32_t j, k, found;
+	for (j = 0; j < rows && mask; ++j) {
+		found = _mm_movemask_epi8(_mm_cmpeq_epi8(pvH[j], vValue)) & mask;
+		mask &= ~found;
+		for (k = 0; found; ++k, found >>= 1) if (found & 1) row[k] = j;
+	}
+}
+
+/* Smith-Waterman in 8 bits lanes, with the scores biased as in ssw.c. The scores come either from vProfile (one vector
+   per base of the reference ref and row) when all the lanes share the reference, or from the codes of the read bases in
+   vRead (rows) and of the reference bases in vRef (columns), where the read and the reference N never match but add
+   vReadN and vRefN (the bias) to the score. For each lane, gives the best score and the first cell reaching it, as
+   sw_word: the column is saved in pvHmax when the best score of a lane increases, and the rows are located at the end.
+   With terminate, the lanes already know their best score: the first cell reaching it is located as soon as it is
+   found, and the scan stops once every lane reaches it. Returns 1 if a score may have overflowed, 0 otherwise. */
+static int32_t sw_byte (const __m128i* vProfile,
+					const int8_t* ref,
+					const __m128i* vRead,
+					const __m128i* vReadN,
+					const __m128i* vRef,
+					const __m128i* vRefN,
+					int32_t rows,
+					int32_t cols,
+					uint8_t match,
+					uint8_t mismatch,
+					uint8_t weight_gapO,
+					uint8_t weight_gapE,
+					const uint8_t* terminate,
+					__m128i* pvH,
+					__m128i* pvE,
+					__m128i* pvHmax,
+					int32_t* best,
+					int32_t* bestRow,
+					int32_t* bestCol) {
+
+	__m128i vZero = _mm_setzero_si128(), vBias = _mm_set1_epi8(mismatch), vBest = vZero;
+	__m128i vMatch = _mm_set1_epi8(match + mismatch), vTerminate = vZero;
+	__m128i vGapO = _mm_set1_epi8(weight_gapO), vGapE = _mm_set1_epi8(weight_gapE);
+	uint8_t lanes[LANES];
+	int32_t i, j, k, mask, done = 0;
+
+	if (terminate) vTerminate = _mm_loadu_si128((__m128i*)terminate);
+	for (j = 0; j < rows; ++j) pvH[j] = pvE[j] = vZero;
+	if (!terminate) for (j = 0; j < rows; ++j) pvHmax[j] = vZero;
+	for (k = 0; k < LANES; ++k) bestCol[k] = bestRow[k] = -1;
+
+	for (i = 0; i < cols; ++i) {
+		const __m128i* vP = vProfile ? vProfile + ref[i] * rows : 0;
+		__m128i b = vRef ? vRef[i] : vZero, bN = vRefN ? vRefN[i] : vZero;
+		__m128i vF = vZero, vDiag = vZero, vColumn = vZero, vSame;
+
+		for (j = 0; j < rows; ++j) {
+			__m128i e = pvE[j], h, s;
+
+			if (vP) s = vP[j];
+			else {	/* Match or mismatch, no penalty against an N */
+				s = _mm_and_si128(_mm_cmpeq_epi8(vRead[j], b), vMatch);
+				s = _mm_max_epu8(s, _mm_max_epu8(vReadN[j], bN));
+			}
+
+			h = _mm_subs_epu8(_mm_adds_epu8(vDiag, s), vBias);
+			vDiag = pvH[j];
+			h = _mm_max_epu8(h, e);
+			h = _mm_max_epu8(h, vF);
+			pvH[j] = h;
+			vColumn = _mm_max_epu8(vColumn, h);
+
+			/* Gap in the read (E) for the next column, gap in the reference (F) for the next row */
+			h = _mm_subs_epu8(h, vGapO);
+			pvE[j] = _mm_max_epu8(_mm_subs_epu8(e, vGapE), h);
+			vF = _mm_max_epu8(_mm_subs_epu8(vF, vGapE), h);
+		}
+
+		/* Lanes whose best score increases in this column */
+		vSame = _mm_cmpeq_epi8(_mm_max_epu8(vColumn, vBest), vBest);
+		mask = ~_mm_movemask_epi8(vSame) & 0xffff;
+		if (!mask) continue;
+		vBest = _mm_max_epu8(vBest, vColumn);
+		if (terminate) {
+			mask = _mm_movemask_epi8(_mm_cmpeq_epi8(_mm_max_epu8(vBest, vTerminate), vBest)) & ~done;
+			done |= mask;
+			first_rows(pvH, rows, vTerminate, mask, bestRow);
+		} else {
+			for (j = 0; j < rows; ++j) pvHmax[j] = blend(vSame, pvHmax[j], pvH[j]);
+		}
+		for (k = 0; k < LANES; ++k) if (mask >> k & 1) bestCol[k] = i;
+		if (done == 0xffff) break;
+	}
+	if (!terminate) first_rows(pvHmax, rows, vBest, 0xffff, bestRow);
+
+	_mm_storeu_si128((__m128i*)lanes, vBest);
+	for (k = 0, mask = 0; k < LANES; ++k) {
+		best[k] = lanes[k];
+		if (lanes[k] + mismatch >= 255) mask = 1;
+	}
+	return mask;
+}
+
+/* Beginning positions of the alignments in the lanes where terminate is set, from a second pass over the reversed
+   reads and reference, in 16 bits lanes when the scores did not fit in 8 bits */
+static void sw_reverse (const int8_t** read,
+					const int8_t* ref,
+					const int32_t* endRead,
+					const int32_t* endRef,
+					const int32_t* terminate,
+					int32_t word,
+					uint8_t match,
+					uint8_t mismatch,
+					uint8_t weight_gapO,
+					uint8_t weight_gapE,
+					__m128i* vRead,
+					__m128i* vReadN,
+					__m128i* vRef,
+					__m128i* vRefN,
+					__m128i* pvH,
+					__m128i* pvE,
+					int32_t* beginRead,
+					int32_t* beginRef) {
+
+	int32_t h, i, j, k, rows = 0, cols = 0, best[LANES];
+	int16_t lane[WORD_LANES], wbest[WORD_LANES], row[WORD_LANES], col[WORD_LANES], wterm[WORD_LANES];
+	uint8_t lane8[LANES], laneN[LANES], term8[LANES];
+
+	for (k = 0; k < LANES; ++k) {
+		if (!terminate[k]) continue;
+		if (endRead[k] + 1 > rows) rows = endRead[k] + 1;
+		if (endRef[k] + 1 > cols) cols = endRef[k] + 1;
+	}
+	if (!rows) return;
+
+	if (!word) {
+		for (j = 0; j < rows; ++j) {
+			for (k = 0; k < LANES; ++k) {
+				lane8[k] = terminate[k] && j <= endRead[k] ? read[k][endRead[k] - j] : READ_PAD;
+				laneN[k] = lane8[k] == 4 ? mismatch : 0;
+			}
+			vRead[j] = _mm_loadu_si128((__m128i*)lane8);
+			vReadN[j] = _mm_loadu_si128((__m128i*)laneN);
+		}
+		for (i = 0; i < cols; ++i) {
+			for (k = 0; k < LANES; ++k) {
+				lane8[k] = terminate[k] && i <= endRef[k] ? ref[endRef[k] - i] : REF_PAD;
+				laneN[k] = lane8[k] == 4 ? mismatch : 0;
+				if (lane8[k] == 4) lane8[k] = REF_N;
+			}
+			vRef[i] = _mm_loadu_si128((__m128i*)lane8);
+			vRefN[i] = _mm_loadu_si128((__m128i*)laneN);
+		}
+		for (k = 0; k < LANES; ++k) term8[k] = terminate[k];
+		sw_byte(0, 0, vRead, vReadN, vRef, vRefN, rows, cols, match, mismatch, weight_gapO, weight_gapE,
+				term8, pvH, pvE, 0, best, beginRead, beginRef);
+		return;
+	}
+
+	for (h = 0; h < LANES; h += WORD_LANES) {
+		for (j = 0; j < rows; ++j) {
+			for (k = 0; k < WORD_LANES; ++k)
+				lane[k] = terminate[h + k] && j <= endRead[h + k] ? read[h + k][endRead[h + k] - j] : READ_PAD;
+			vRead[j] = _mm_loadu_si128((__m128i*)lane);
+		}
+		for (i = 0; i < cols; ++i) {
+			for (k = 0; k < WORD_LANES; ++k)
+				lane[k] = terminate[h + k] && i <= endRef[h + k] ? ref[endRef[h + k] - i] : REF_PAD;
+			vRef[i] = _mm_loadu_si128((__m128i*)lane);
+		}
+		for (k = 0; k < WORD_LANES; ++k) wterm[k] = terminate[h + k];
+		sw_word(vRead, rows, vRef, cols, _mm_set1_epi16(match), _mm_set1_epi16(-mismatch),
+				_mm_set1_epi16(weight_gapO), _mm_set1_epi16(weight_gapE), _mm_loadu_si128((__m128i*)wterm),
+				pvH, pvE, wbest, row, col);
+		for (k = 0; k < WORD_LANES; ++k) {
+			beginRead[h + k] = row[k];
+			beginRef[h + k] = col[k];
+		}
+	}
+}
+
+int32_t ssw_align_reads (const int8_t* reads,
+					const int32_t* readLens,
+					const int32_t readNum,
+					const int8_t* refs,
+					const int32_t* refLens,
+					const int32_t refNum,
+					const int8_t match,
+					const int8_t mismatch,
+					const uint8_t weight_gapO,
+					const uint8_t weight_gapE,
+					const uint16_t* filters,
+					const int32_t* filterl,
+					s_panel_align* results) {
+
+	int32_t maxRead = 1, maxRef = 1, ret = -1, g, h, k, r, i, j, b, word;
+	const int8_t* read[LANES];
+	const int8_t *ref, *next = reads;
+	int32_t len[LANES], score[LANES], endRead[LANES], endRef[LANES], beginRead[LANES], beginRef[LANES],
+			terminate[LANES];
+	int16_t lane[WORD_LANES], best[WORD_LANES], row[WORD_LANES], col[WORD_LANES];
+	uint8_t lane8[LANES];
+	__m128i *vProfile, *vRead, *vReadN, *vRef, *vRefN, *pvH, *pvE, *pvHmax;
+
+	for (k = 0; k < readNum; ++k) if (readLens[k] > maxRead) maxRead = readLens[k];
+	for (r = 0; r < refNum; ++r) if (refLens[r] > maxRef) maxRef = refLens[r];
+	if (maxRead > MAXLEN || maxRef > MAXLEN) return -1;
+
+	vProfile = (__m128i*) calloc(5 * maxRead, sizeof(__m128i));
+	vRead = (__m128i*) calloc(maxRead, sizeof(__m128i));
+	vReadN = (__m128i*) calloc(maxRead, sizeof(__m128i));
+	vRef = (__m128i*) calloc(maxRef, sizeof(__m128i));
+	vRefN = (__m128i*) calloc(maxRef, sizeof(__m128i));
+	pvH = (__m128i*) calloc(maxRead, sizeof(__m128i));
+	pvE = (__m128i*) calloc(maxRead, sizeof(__m128i));
+	pvHmax = (__m128i*) calloc(maxRead, sizeof(__m128i));
+	if (!vProfile || !vRead || !vReadN || !vRef || !vRefN || !pvH || !pvE || !pvHmax) goto end;
+
+	for (g = 0; g < readNum; g += LANES) {
+		int32_t n = readNum - g < LANES ? readNum - g : LANES, rows = 0;
+
+		for (k = 0; k < LANES; ++k) {
+			len[k] = k < n ? readLens[g + k] : 0;
+			read[k] = next;
+			next += len[k];
+			if (len[k] > rows) rows = len[k];
+		}
+
+		/* Query profile of the batch with the scores biased by mismatch, the lanes of the shorter reads (or without
+		   read) are padded with mismatches */
+		for (b = 0; b < 5; ++b) {
+			for (j = 0; j < rows; ++j) {
+				for (k = 0; k < LANES; ++k) {
+					if (j >= len[k]) lane8[k] = 0;
+					else if (b == 4 || read[k][j] == 4) lane8[k] = mismatch;
+					else lane8[k] = read[k][j] == b ? match + mismatch : 0;
+				}
+				vProfile[b * rows + j] = _mm_loadu_si128((__m128i*)lane8);
+			}
+		}
+
+		for (r = 0, ref = refs; r < refNum; ref += refLens[r], ++r) {
+
+			/* Scores and ending positions, in 16 bits if they may have overflowed in 8 bits */
+			word = sw_byte(vProfile, ref, 0, 0, 0, 0, rows, refLens[r], match, mismatch, weight_gapO, weight_gapE,
+						   0, pvH, pvE, pvHmax, score, endRead, endRef);
+			if (word) {
+				for (i = 0; i < refLens[r]; ++i) vRef[i] = _mm_set1_epi16(ref[i]);
+				for (h = 0; h < LANES; h += WORD_LANES) {
+					for (j = 0; j < rows; ++j) {
+						for (k = 0; k < WORD_LANES; ++k) lane[k] = j < len[h + k] ? read[h + k][j] : READ_PAD;
+						vRead[j] = _mm_loadu_si128((__m128i*)lane);
+					}
+					sw_word(vRead, rows, vRef, refLens[r], _mm_set1_epi16(match), _mm_set1_epi16(-mismatch),
+							_mm_set1_epi16(weight_gapO), _mm_set1_epi16(weight_gapE), _mm_set1_epi16(MAXLEN),
+							pvH, pvE, best, row, col);
+					for (k = 0; k < WORD_LANES; ++k) {
+						score[h + k] = best[k];
+						endRead[h + k] = row[k];
+						endRef[h + k] = col[k];
+					}
+				}
+			}
+
+			/* Beginning positions, only for the alignments passing the score filter */
+			for (k = 0; k < LANES; ++k)
+				terminate[k] = k < n && score[k] > 0 && score[k] >= filters[r] ? score[k] : 0;
+			sw_reverse(read, ref, endRead, endRef, terminate, word, match, mismatch, weight_gapO, weight_gapE,
+					   vRead, vReadN, vRef, vRefN, pvH, pvE, beginRead, beginRef);
+
+			for (k = 0; k < n; ++k) {
+				s_panel_align* res = results + (int64_t)(g + k) * refNum + r;
+				res->score = score[k];
+				res->ref_begin = -1;
+				res->ref_end = res->read_begin = res->read_end = res->hang = -1;
+				if (!terminate[k] || beginRead[k] + 1 < filterl[r]) continue;
+
+				res->ref_end = endRef[k];
+				res->read_end = endRead[k];
+				res->ref_begin = endRef[k] - beginRef[k];
+				res->read_begin = endRead[k] - beginRead[k];
+				res->hang = min4(refLens[r] - res->ref_end - 1 + res->read_begin,
+								 res->ref_begin + len[k] - res->read_end - 1,
+								 res->ref_begin + refLens[r] - res->ref_end - 1,
+								 res->read_begin + len[k] - res->read_end - 1);
+			}
+		}
+	}
+	ret = 0;
+
+end:
+	free(vProfile); free(vRead); free(vReadN); free(vRef); free(vRefN); free(pvH); free(pvE); free(pvHmax);
+	return ret;
+}
@@ -0,0 +1,58 @@
+/*
+ *  ssw_batch.h
+ *
+ *  Local alignment of a batch of reads against a panel of references, with
+ *  one read per lane of the SIMD registers. The alignments of the reads of a
+ *  locus against the same reference run side by side, so that the setup of the
+ *  reference is shared by the whole batch instead of being paid per read.
+ *
+ */
+
+#ifndef SSW_BATCH_H
+#define SSW_BATCH_H
+
+#include <stdint.h>
+#include "ssw.h"
+
+#ifdef __cplusplus
+extern "C" {
+#endif	// __cplusplus
+
+/*!	@function	Align each read of a batch against each reference of a panel, reporting the score and the coordinates of
+				the best alignments as ssw_align_panel does for one read. The substitution scores are match for identical
+				bases, -mismatch for different bases and 0 when either base is an N (4), as in the ssw_wrap score matrix.
+	@param	reads	pointer to the reads concatenated; the reads need to be numbers
+	@param	readLens	length of each read
+	@param	readNum	number of reads
+	@param	refs	pointer to the references concatenated; the references need to be numbers
+	@param	refLens	length of each reference
+	@param	refNum	number of references
+	@param	match	score of a match
+	@param	mismatch	the absolute value of the score of a mismatch
+	@param	weight_gapO	the absolute value of gap open penalty
+	@param	weight_gapE	the absolute value of gap extension penalty
+	@param	filters	minimal score of the alignment against each reference, one per reference
+	@param	filterl	minimal length of the alignment on the read against each reference, one per reference
+	@param	results	pointer to readNum * refNum results, the results of a read against all the references following each
+					other; ref_begin = -1 when the alignment does not pass the filters
+	@return	0 on success, -1 on allocation failure or when a read or a reference is too long for the 16 bits lanes
+*/
+int32_t ssw_align_reads (const int8_t* reads,
+					const int32_t* readLens,
+					const int32_t readNum,
+					const int8_t* refs,
+					const int32_t* refLens,
+					const int32_t refNum,
+					const int8_t match,
+					const int8_t mismatch,
+					const uint8_t weight_gapO,
+					const uint8_t weight_gapE,
+					const uint16_t* filters,
+					const int32_t* filterl,
+					s_panel_align* results);
+
+#ifdef __cplusplus
+}
+#endif	// __cplusplus
+
+#endif	// SSW_BATCH_H
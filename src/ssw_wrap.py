@@ -13,8 +13,15 @@ library and update the cache by using /sbin/ldconfig as root
 # Standard library packages
 import os
 import itertools
+import string
+import struct
 from ctypes import *
 
+# Third party packages
+import numpy as np
+
+_complement = string.maketrans('ATCGatcgNnXx', 'TAGCtagcNnXx')
+
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
 
 def load_ssw_library():
@@ -50,6 +57,40 @@ class CAlignRes(Structure):
                 ('cigar', POINTER(c_uint32)),
                 ('cigarLen', c_int32)]
 
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+class CPanelAlignRes(Structure):
+    """
+    @class  CPanelAlignRes
+    @brief  ctypes Structure with s_panel_align struct mapping filled by ssw_align_panel func
+            One element per reference of the panel, ref_begin = -1 if filtered out
+    """
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    #~~~~~~~Ctype Structure~~~~~~~#
+    _fields_ = [('score', c_uint16),
+                ('ref_begin', c_int32),
+                ('ref_end', c_int32),
+                ('query_begin', c_int32),
+                ('query_end', c_int32),
+                ('hang', c_int32)]
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+class CRepeatAlignRes(Structure):
+    """
+    @class  CRepeatAlignRes
+    @brief  ctypes Structure with s_repeat_align struct mapping filled by repeat_graph_align func
+    """
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    #~~~~~~~Ctype Structure~~~~~~~#
+    _fields_ = [('score', c_int32),
+                ('units', c_int32),
+                ('ref_begin', c_int32),
+                ('ref_end', c_int32),
+                ('query_begin', c_int32),
+                ('query_end', c_int32),
+                ('hang', c_int32)]
+
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
 class Aligner(object):
     """
@@ -81,6 +122,17 @@ class Aligner(object):
     align_destroy = libssw.align_destroy
     align_destroy.restype = None
     align_destroy.argtypes = [POINTER(CAlignRes)]
+    # ssw_align_panel function
+    ssw_align_panel = libssw.ssw_align_panel
+    ssw_align_panel.restype = c_int32
+    ssw_align_panel.argtypes = [c_void_p, POINTER(c_int8), POINTER(c_int32), c_int32, c_uint8, c_uint8,
+                                POINTER(c_uint16), POINTER(c_int32), c_int32, c_int8, POINTER(CPanelAlignRes)]
+    # ssw_align_reads function
+    ssw_align_reads = libssw.ssw_align_reads
+    ssw_align_reads.restype = c_int32
+    ssw_align_reads.argtypes = [POINTER(c_int8), POINTER(c_int32), c_int32, POINTER(c_int8), POINTER(c_int32),
+                                c_int32, c_int8, c_int8, c_uint8, c_uint8, POINTER(c_uint16), POINTER(c_int32),
+                                POINTER(CPanelAlignRes)]
 
     #~~~~~~~FONDAMENTAL METHODS~~~~~~~#
 
@@ -114,7 +166,7 @@ class Aligner(object):
                 gap_open=3,
                 gap_extend=1,
                 report_secondary=False,
-                report_cigar=False):
+                report_cigar=True):
         """
         Initialize object by creating an interface with ssw library fonctions
         A reference sequence is also assigned to the object for multiple alignment against queries
@@ -125,7 +177,8 @@ class Aligner(object):
         @param gap_open Absolute value of gap open penalty
         @param gap_extend Absolute value of gap extend penalty
         @param report_secondary Report the 2nd best alignement if true
-        @param report_cigar Report cigar string if true
+        @param report_cigar Report cigar string if true, otherwise only the score and coordinates
+        are computed and alignments failing min_score skip the traceback
         """
 
         # Store overall alignment parameters
@@ -158,13 +211,7 @@ class Aligner(object):
         """
         self.match = match
         self.mismatch = mismatch
-
-        mat_decl = c_int8 * 25
-        self.mat = mat_decl(match, -mismatch, -mismatch, -mismatch, 0,
-                            -mismatch, match, -mismatch, -mismatch, 0,
-                            -mismatch, -mismatch, match, -mismatch, 0,
-                            -mismatch, -mismatch, -mismatch, match, 0,
-                            0, 0, 0, 0, 0)
+        self.mat = score_matrix(match, mismatch)
 
     def get_reference(self, ref_seq):
         return self.ref_seq
@@ -174,39 +221,49 @@ class Aligner(object):
         self._ref_seq = self._DNA_to_int_mat(self.ref_seq)
     reference = property(get_reference, set_reference)
 
-    def align(self, query_seq, min_score=0, min_len=0):
+    def profile(self, query_seq):
+        """
+        Encode the query and create its query profile with the object score matrix. The
+        profile can be passed to align() of any Aligner sharing the same match/mismatch
+        weights, so that a query is profiled only once for several references
+        @param query_seq Query sequence as a python string (case insensitive)
+        @return A QueryProfile object, to be released with its destroy() method
+        """
+        return QueryProfile(query_seq, self.mat)
+
+    def align(self, query_seq, min_score=0, min_len=0, profile=None, mask_len=None):
         """
         Perform the alignment of query against the object reference sequence
         @param query_seq Query sequence as a python string (case insensitive)
         @param min_score Minimal score of match. None will be return in case of filtering out
         @param min_len Minimal length of match. None will be return in case of filtering out
-        @return A SSWAlignRes Object containing informations about the alignment.
+        @param profile QueryProfile of query_seq to reuse, built from scratch if None
+        @param mask_len Distance on the reference between the optimal and the suboptimal
+        alignment ends, from the query length if None
+        @return A SSWAlignRes Object containing informations about the alignment, or a
+        PyAlignCoords object if the cigar is not reported.
         """
-        # Determine the size of the ref sequence and cast it in a c type integer matrix
-        _query_seq = self._DNA_to_int_mat(query_seq)
-
-        # Create the query profile using the query sequence
-        profile = self.ssw_init(_query_seq, # Query seq in c type integers
-                                c_int32(len(query_seq)), # Length of Queryseq in bites
-                                self.mat, # Score matrix
-                                5, # Square root of the number of elements in mat
-                                2) # flag = no estimation of the best alignment score
+        own_profile = profile is None
+        if own_profile:
+            profile = self.profile(query_seq)
 
-        # Setup the mask_len parameters = distance between the optimal and suboptimal alignment
-        # if < 15, the function will NOT return the suboptimal alignment information
+        if mask_len is None:
+            mask_len = get_mask_len(query_seq)
 
-        if len(query_seq) > 30:
-            mask_len = len(query_seq) / 2
+        if self.report_cigar:
+            flag = 1 # Bitwise FLAG for output values = return all
+            filters = 0 # Score filter = return all
         else:
-            mask_len = 15
+            flag = 18 # Bitwise FLAG for output values = coordinates if score >= filters, no cigar
+            filters = min_score # Score filter = skip the traceback below min_score
 
-        c_result = self.ssw_align (profile, # Query profile
+        c_result = self.ssw_align (profile.profile, # Query profile
                                 self._ref_seq, # Ref seq in c type integers
                                 c_int32(len(self.ref_seq)), # Length of Refseq in bites
                                 self.gap_open, # Absolute value of gap open penalty
                                 self.gap_extend, # absolute value of gap extend penalty
-                                1, # Bitwise FLAG for output values = return all
-                                0, # Score filter = return all
+                                flag, # Bitwise FLAG for output values
+                                filters, # Score filter
                                 0, # Distance filter = return all
                                 mask_len) # Distance between the optimal and suboptimal alignment
 
@@ -214,34 +271,23 @@ class Aligner(object):
         score = c_result.contents.score
         match_len  = c_result.contents.query_end - c_result.contents.query_begin + 1
 
-        if score >= min_score and match_len >= min_len:
+        if score < min_score or match_len < min_len:
+            py_result = None
+        elif self.report_cigar:
             py_result = PyAlignRes(c_result, query_seq, self.ref_seq)
         else:
-            py_result = None
+            py_result = PyAlignCoords(c_result, query_seq, self.ref_seq)
 
         # Free reserved space by ssw.init and ssw_init methods.
-        self._init_destroy(profile)
+        if own_profile:
+            profile.destroy()
         self._align_destroy(c_result)
 
         # Return the object
         return py_result
 
     def _DNA_to_int_mat(self, seq):
-        # Declare the matrix
-        query_num_decl = c_int8 * len(seq)
-        query_num = query_num_decl()
-
-        # for each letters in ATCGN transform in integers thanks to self.base_to_int
-        for (idx, base) in enumerate(seq):
-            try:
-                value = self.base_to_int[base]
-            # if the base is not in the canonic DNA bases assign 4 as for N
-            except KeyError:
-                value = 4
-            finally:
-                query_num[idx] = value
-
-        return query_num
+        return DNA_to_int_mat(seq)
 
     def _init_destroy(self, profile):
         """
@@ -255,6 +301,573 @@ class Aligner(object):
         """
         self.align_destroy(align)
 
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+class QueryProfile(object):
+    """
+    @class  QueryProfile
+    @brief  Query sequence encoded in c type integers together with its SSW query profile.
+            The profile keeps pointers to both the encoded query and the score matrix, so
+            the object holds a reference on them for as long as the profile is alive
+    """
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    def __init__(self, query_seq, mat):
+        self.query_seq = query_seq
+        self.mat = mat
+        self._query_seq = DNA_to_int_mat(query_seq)
+
+        # Create the query profile using the query sequence
+        self.profile = Aligner.ssw_init(self._query_seq, # Query seq in c type integers
+                                c_int32(len(query_seq)), # Length of Queryseq in bites
+                                mat, # Score matrix
+                                5, # Square root of the number of elements in mat
+                                2) # flag = no estimation of the best alignment score
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.destroy()
+
+    def destroy(self):
+        """
+        Free the space alocated for the matrix used by init
+        """
+        if self.profile is not None:
+            Aligner.init_destroy(self.profile)
+            self.profile = None
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+class AlignerPanel(object):
+    """
+    @class  AlignerPanel
+    @brief  A panel of reference sequences sharing the same alignment parameters. Each query
+            is encoded and profiled once, then aligned against every reference of the panel.
+            Panels can be pickled, for example to be precompiled once and loaded at startup
+    """
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    def __init__(self, ref_seqs, **kwargs):
+        """
+        @param ref_seqs List of reference sequences as python strings (case insensitive)
+        @param kwargs Alignment parameters passed to each Aligner (match, mismatch, gap_open...)
+        """
+        self._init(list(ref_seqs), kwargs, DNA_to_int_mat("".join(ref_seqs)))
+
+    def _init(self, ref_seqs, kwargs, packed):
+        self.kwargs = kwargs
+        self._refs = ref_seqs
+        self._aligners = None  # One Aligner per reference, only built if needed
+        self._aligner = Aligner(**kwargs)  # Profiles the queries of align_batch()
+
+        # All the references concatenated in c type integers, for the batch alignment
+        self.ref_lens = [len(ref_seq) for ref_seq in ref_seqs]
+        self._ref_offsets = [0]
+        for ref_len in self.ref_lens:
+            self._ref_offsets.append(self._ref_offsets[-1] + ref_len)
+        self._ref_seqs = packed
+        self._ref_lens = (c_int32 * len(ref_seqs))(*self.ref_lens)
+
+    def __getstate__(self):
+        return self._refs, self.kwargs, string_at(self._ref_seqs, sizeof(self._ref_seqs))
+
+    def __setstate__(self, state):
+        ref_seqs, kwargs, packed = state
+        self._init(ref_seqs, kwargs, (c_int8 * len(packed)).from_buffer_copy(packed))
+
+    def __len__(self):
+        return len(self._refs)
+
+    def __getitem__(self, idx):
+        return self.aligners[idx]
+
+    @property
+    def aligners(self):
+        if self._aligners is None:
+            self._aligners = [Aligner(ref_seq=ref_seq, **self.kwargs) for ref_seq in self._refs]
+        return self._aligners
+
+    @property
+    def ref_seqs(self):
+        return self._refs[:]
+
+    def align(self, query_seq, min_score=0, min_len=0, indices=None):
+        """
+        Align the query against the references of the panel, building its profile only once
+        @param query_seq Query sequence as a python string (case insensitive)
+        @param min_score Minimal score of match, either one value or a list with one per reference
+        @param min_len Minimal length of match, either one value or a list with one per reference
+        @param indices Indices of the references to align against, all references if None
+        @return A list of (index, PyAlignRes) for the alignments passing the filters
+        """
+        if indices is None:
+            indices = xrange(len(self))
+        min_scores = _per_reference(min_score, len(self))
+        min_lens = _per_reference(min_len, len(self))
+
+        results = []
+        if not self.aligners:
+            return results
+        with self.aligners[0].profile(query_seq) as profile:
+            for idx in indices:
+                al = self.aligners[idx].align(query_seq, min_score=min_scores[idx],
+                                              min_len=min_lens[idx], profile=profile)
+                if al:
+                    results.append((idx, al))
+        return results
+
+    def filters(self, min_score=0, min_len=0):
+        """
+        Cast the filters into c type arrays with one value per reference, so that the same
+        filters can be reused by align_batch() across many queries
+        @param min_score Minimal score of match, either one value or a list with one per reference
+        @param min_len Minimal length of match, either one value or a list with one per reference
+        @return A tuple of c type arrays (min_scores, min_lens)
+        """
+        n = len(self)
+        min_scores = (c_uint16 * n)(*_per_reference(min_score, n))
+        min_lens = (c_int32 * n)(*_per_reference(min_len, n))
+        return min_scores, min_lens
+
+    def align_batch(self, query_seq, min_score=0, min_len=0, best_only=False,
+                    filters=None, start=0, stop=None):
+        """
+        Align the query against all the references of the panel within a single call into
+        the SSW library. Only the score and coordinates are computed, not the cigar
+        @param query_seq Query sequence as a python string (case insensitive)
+        @param min_score Minimal score of match, either one value or a list with one per reference
+        @param min_len Minimal length of match, either one value or a list with one per reference
+        @param best_only Only report the best alignment passing the filters
+        @param filters Precomputed filters from filters(), override min_score and min_len
+        @param start Index of the first reference to align against
+        @param stop Index after the last reference to align against, the end of the panel if None
+        @return An array of CPanelAlignRes, one per reference from start to stop, where
+        ref_begin = -1 for the alignments filtered out. If best_only, a tuple (index,
+        CPanelAlignRes) of the best alignment instead, or None if no alignment passes the filters
+        """
+        if stop is None:
+            stop = len(self)
+        n = stop - start
+        if n <= 0:
+            return None if best_only else (CPanelAlignRes * 0)()
+        min_scores, min_lens = filters or self.filters(min_score, min_len)
+        results = (CPanelAlignRes * (1 if best_only else n))()
+        with self._aligner.profile(query_seq) as profile:
+            ret = Aligner.ssw_align_panel(profile.profile,
+                                          _at(self._ref_seqs, self._ref_offsets[start]),
+                                          _at(self._ref_lens, start),
+                                          n,
+                                          self._aligner.gap_open,
+                                          self._aligner.gap_extend,
+                                          _at(min_scores, start),
+                                          _at(min_lens, start),
+                                          get_mask_len(query_seq),
+                                          1 if best_only else 0,
+                                          results)
+        if best_only:
+            return (start + ret, results[0]) if ret >= 0 else None
+        return results
+
+    def align_reads(self, query_seqs, min_score=0, min_len=0, filters=None, start=0, stop=None):
+        """
+        Align a batch of queries against the references of the panel, with one query per lane
+        of the SIMD registers, so that the setup of each reference is shared by the whole batch.
+        The scores and coordinates are those of align_batch() for each query
+        @param query_seqs List of query sequences as python strings (case insensitive) or PackedSeq
+        @param min_score Minimal score of match, either one value or a list with one per reference
+        @param min_len Minimal length of match, either one value or a list with one per reference
+        @param filters Precomputed filters from filters(), override min_score and min_len
+        @param start Index of the first reference to align against
+        @param stop Index after the last reference to align against, the end of the panel if None
+        @return A list with one array of CPanelAlignRes per query, as returned by align_batch(),
+        or None if a query or a reference is too long for the batch
+        """
+        if stop is None:
+            stop = len(self)
+        n = max(stop - start, 0)
+        query_seqs = [str(x) for x in query_seqs]
+        min_scores, min_lens = filters or self.filters(min_score, min_len)
+        results = (CPanelAlignRes * (n * len(query_seqs)))()
+        if n and query_seqs:
+            query_lens = (c_int32 * len(query_seqs))(*[len(x) for x in query_seqs])
+            ret = Aligner.ssw_align_reads(DNA_to_int_mat("".join(query_seqs)),
+                                          query_lens,
+                                          len(query_seqs),
+                                          _at(self._ref_seqs, self._ref_offsets[start]),
+                                          _at(self._ref_lens, start),
+                                          n,
+                                          self._aligner.match,
+                                          self._aligner.mismatch,
+                                          self._aligner.gap_open,
+                                          self._aligner.gap_extend,
+                                          _at(min_scores, start),
+                                          _at(min_lens, start),
+                                          results)
+            if ret < 0:
+                return None
+        size = sizeof(CPanelAlignRes) * n
+        return [(CPanelAlignRes * n).from_buffer(results, i * size) for i in xrange(len(query_seqs))]
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+class RepeatGraphAligner(object):
+    """
+    @class  RepeatGraphAligner
+    @brief  Aligner against the repeat graph prefix -> (repeat)+ -> suffix of a STR locus, in both
+            orientations. A single dynamic programming pass per strand gives the best alignment over
+            all the references prefix + repeat * units + suffix, and the number of units it uses
+    """
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    # Load the ssw library using ctypes
+    libssw = load_ssw_library()
+
+    # repeat_graph_align function
+    repeat_graph_align = libssw.repeat_graph_align
+    repeat_graph_align.restype = c_int32
+    repeat_graph_align.argtypes = [POINTER(c_int8), c_int32, POINTER(c_int8), c_int32, POINTER(c_int8), c_int32,
+                                   POINTER(c_int8), c_int32, POINTER(c_int8), c_int32, c_uint8, c_uint8,
+                                   POINTER(CRepeatAlignRes)]
+
+    def __init__(self, prefix, repeat, suffix,
+                match=2,
+                mismatch=2,
+                gap_open=3,
+                gap_extend=1):
+        """
+        @param prefix Prefix flank sequence as a python string (case insensitive)
+        @param repeat Repeat motif as a python string (case insensitive)
+        @param suffix Suffix flank sequence as a python string (case insensitive)
+        @param match Weight for a match
+        @param mismatch Absolute value of mismatch penalty
+        @param gap_open Absolute value of gap open penalty
+        @param gap_extend Absolute value of gap extend penalty
+        """
+        self.prefix, self.repeat, self.suffix = prefix, repeat, suffix
+        self.match, self.mismatch = match, mismatch
+        self.gap_open, self.gap_extend = gap_open, gap_extend
+        self.mat = score_matrix(match, mismatch)
+
+        # The reverse strand spells the reverse complement of prefix + repeat * units + suffix
+        self.graphs = []
+        for graph in ((prefix, repeat, suffix), (rc(suffix), rc(repeat), rc(prefix))):
+            self.graphs.append([(DNA_to_int_mat(x), len(x)) for x in graph])
+
+    def align(self, query_seq, strands=(0, 1)):
+        """
+        Perform the alignment of query against the repeat graph
+        @param query_seq Query sequence as a python string (case insensitive)
+        @param strands Strands of the graph to align against, 0 forward and 1 reverse
+        @return A PyRepeatAlignRes of the best alignment across the strands, the one using the
+        fewest units in case of ties. None if no alignment is found
+        """
+        _query_seq = DNA_to_int_mat(query_seq)
+        best = None
+        for strand in strands:
+            (prefix, plen), (repeat, rlen), (suffix, slen) = self.graphs[strand]
+            c_result = CRepeatAlignRes()
+            score = self.repeat_graph_align(_query_seq, len(query_seq),
+                                            prefix, plen, repeat, rlen, suffix, slen,
+                                            self.mat, 5, self.gap_open, self.gap_extend,
+                                            byref(c_result))
+            if score <= 0:
+                continue
+            if best is None or (score, -c_result.units) > (best.score, -best.units):
+                best = PyRepeatAlignRes(c_result, strand, query_seq,
+                                        plen + rlen * c_result.units + slen)
+        return best
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+class PyRepeatAlignRes(object):
+    """
+    @class  PyRepeatAlignRes
+    @brief  Result of an alignment against the repeat graph. Coordinates are on the shortest reference
+    prefix + repeat * units + suffix containing the alignment, in the orientation of the strand
+    """
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    __slots__ = ('score', 'units', 'strand', 'ref_len', 'ref_begin', 'ref_end',
+                 'query_seq', 'query_begin', 'query_end', 'hang')
+
+    def __str__(self):
+        msg = "OPTIMAL MATCH\n"
+        msg += "Score            {}\n".format(self.score)
+        msg += "Units            {}\n".format(self.units)
+        msg += "Strand           {}\n".format("-" if self.strand else "+")
+        msg += "Reference begin  {}\n".format(self.ref_begin)
+        msg += "Reference end    {}\n".format(self.ref_end)
+        msg += "Query begin      {}\n".format(self.query_begin)
+        msg += "Query end        {}\n".format(self.query_end)
+        return msg
+
+    def __init__ (self, res, strand, query_seq, ref_len):
+        self.score = res.score
+        self.units = res.units
+        self.strand = strand
+        self.ref_len = ref_len
+        self.ref_begin = res.ref_begin
+        self.ref_end = res.ref_end
+        self.query_seq = query_seq
+        self.query_begin = res.query_begin
+        self.query_end = res.query_end
+        self.hang = res.hang
+
+    def touches_start(self, flank):
+        """
+        Does the alignment start within the first flank bases of the reference?
+        """
+        return self.ref_begin < flank
+
+    def touches_end(self, flank):
+        """
+        Does the alignment end within the last flank bases of the reference?
+        """
+        return self.ref_end > self.ref_len - flank - 1
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+class FlankFinder(object):
+    """
+    @class  FlankFinder
+    @brief  Short pattern searched anywhere in the queries with a few edits, by the bit-parallel
+            algorithm of Myers (1999) in the SSW library. The pattern fits in one 64 bits word,
+            and an N of the pattern matches any base
+    """
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    # Load the ssw library using ctypes
+    libssw = load_ssw_library()
+
+    # myers_find function
+    myers_find = libssw.myers_find
+    myers_find.restype = c_int32
+    myers_find.argtypes = [POINTER(c_uint64), c_int32, POINTER(c_int8), c_int32, c_int32, c_int8]
+
+    def __init__(self, pattern, reverse=False):
+        """
+        @param pattern Pattern as a python string (case insensitive), at most 64 bases
+        @param reverse Scan the queries from their last base, for a pattern that ends a region
+        """
+        if not 0 < len(pattern) <= 64:
+            raise ValueError("Pattern of {} bases, 1 to 64 expected".format(len(pattern)))
+        self.pattern = pattern
+        self.reverse = reverse
+        peq = [0] * 5
+        for i, base in enumerate(pattern[::-1] if reverse else pattern):
+            code = Aligner.base_to_int.get(base, 4)
+            for x in (xrange(4) if code == 4 else (code,)):
+                peq[x] |= 1 << i
+        self._peq = (c_uint64 * 5)(*peq)
+
+    @staticmethod
+    def encode(query_seq):
+        """
+        @param query_seq Query sequence as a python string (case insensitive)
+        @return The query in c type integers, which find() takes in place of the string so that
+        a query searched for several patterns is encoded once
+        """
+        return DNA_to_int_mat(query_seq)
+
+    def find(self, query_seq, max_edits):
+        """
+        Find the best match of the pattern in the query
+        @param query_seq Query sequence as a python string or as returned by encode()
+        @param max_edits Most edits of the match
+        @return The position in the query of the base that ends the best match, the first base
+        of the match if reverse. -1 if the best match has more than max_edits edits or ends at
+        several positions
+        """
+        if isinstance(query_seq, basestring):
+            query_seq = DNA_to_int_mat(query_seq)
+        return self.myers_find(self._peq, len(self.pattern), query_seq, len(query_seq),
+                               max_edits, 1 if self.reverse else 0)
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+class PackedSeq(object):
+    """
+    @class  PackedSeq
+    @brief  DNA sequence packed in 2 bits per base, plus a bit mask of the N. The whole state
+            is the key string (length, packed bases, N mask), which makes a compact hash key.
+            Encoding and reverse complement are vectorized, and the aligners take the
+            sequence in place of a python string
+    """
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    __slots__ = ('key',)
+
+    def __init__(self, seq):
+        """
+        @param seq DNA sequence as a python string (case insensitive), the bases other than
+        ACGT are packed as N
+        """
+        self.key = self._pack(np.frombuffer(seq.translate(_base_to_int), dtype=np.int8))
+
+    @classmethod
+    def from_codes(cls, codes):
+        """
+        @param codes numpy array of the bases as integers, as in Aligner.base_to_int
+        @return The PackedSeq of these bases
+        """
+        packed = cls.__new__(cls)
+        packed.key = cls._pack(codes)
+        return packed
+
+    @staticmethod
+    def packable(seq):
+        """
+        @return True if the sequence is made of ACGTN only, and unpacks to the same string
+        """
+        return not seq.translate(None, "ACGTN")
+
+    @staticmethod
+    def _pack(codes):
+        n = len(codes)
+        twobit = np.zeros((n + 3) / 4 * 4, dtype=np.uint8)
+        twobit[:n] = codes
+        nmask = twobit == 4
+        twobit &= 3
+        twobit = twobit.reshape(-1, 4)
+        bases = twobit[:, 0] << 6 | twobit[:, 1] << 4 | twobit[:, 2] << 2 | twobit[:, 3]
+        return struct.pack("<I", n) + bases.tostring() + np.packbits(nmask[:n]).tostring()
+
+    def __getstate__(self):
+        return self.key
+
+    def __setstate__(self, state):
+        self.key = state
+
+    def __len__(self):
+        return struct.unpack_from("<I", self.key)[0]
+
+    def __eq__(self, other):
+        return isinstance(other, PackedSeq) and self.key == other.key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __str__(self):
+        return _int_to_base[self.codes()].tostring()
+
+    def __repr__(self):
+        return "PackedSeq('{}')".format(self)
+
+    def codes(self):
+        """
+        @return The bases as a numpy array of integers, as in Aligner.base_to_int
+        """
+        n = len(self)
+        nbytes = (n + 3) / 4
+        bases = np.frombuffer(self.key, dtype=np.uint8, count=nbytes, offset=4)
+        codes = np.empty((nbytes, 4), dtype=np.int8)
+        for i, shift in enumerate((6, 4, 2, 0)):
+            codes[:, i] = bases >> shift & 3
+        codes = codes.reshape(-1)[:n]
+        nmask = np.frombuffer(self.key, dtype=np.uint8, offset=4 + nbytes)
+        codes[np.unpackbits(nmask)[:n].view(np.bool_)] = 4
+        return codes
+
+    def rc(self):
+        """
+        @return The reverse complement, as a PackedSeq
+        """
+        codes = self.codes()[::-1]
+        return self.from_codes(np.where(codes == 4, codes, 3 - codes))
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+def score_matrix(match=2, mismatch=2):
+    """
+    Cost matrix filled with match and mismatch values. Ambiguous base: no penalty
+    """
+    mat_decl = c_int8 * 25
+    return mat_decl(match, -mismatch, -mismatch, -mismatch, 0,
+                    -mismatch, match, -mismatch, -mismatch, 0,
+                    -mismatch, -mismatch, match, -mismatch, 0,
+                    -mismatch, -mismatch, -mismatch, match, 0,
+                    0, 0, 0, 0, 0)
+
+def rc(seq):
+    """
+    Reverse complement of a DNA sequence, either a python string or a PackedSeq
+    """
+    if isinstance(seq, PackedSeq):
+        return seq.rc()
+    return seq.translate(_complement)[::-1]
+
+def get_mask_len(query_seq):
+    """
+    Setup the mask_len parameters = distance between the optimal and suboptimal alignment
+    if < 15, the function will NOT return the suboptimal alignment information
+    """
+    if len(query_seq) > 30:
+        return len(query_seq) / 2
+    return 15
+
+def DNA_to_int_mat(seq):
+    """
+    Cast a DNA sequence into a c type integer matrix as expected by the SSW C library
+    """
+    # Declare the matrix
+    query_num_decl = c_int8 * len(seq)
+
+    # A PackedSeq unpacks into integers already, which the matrix shares without copy
+    if isinstance(seq, PackedSeq):
+        return query_num_decl.from_buffer(seq.codes())
+
+    # for each letters in ATCGN transform in integers thanks to Aligner.base_to_int
+    # if the base is not in the canonic DNA bases assign 4 as for N
+    return query_num_decl.from_buffer_copy(seq.translate(_base_to_int))
+
+_base_to_int = "".join(chr(Aligner.base_to_int.get(chr(i), 4)) for i in xrange(256))
+_int_to_base = np.array([Aligner.int_to_base[i] for i in xrange(5)])
+
+def _at(array, idx):
+    """
+    Pointer to the element idx of a c type array, to pass a slice of it to the SSW C library
+    """
+    return cast(addressof(array) + idx * sizeof(array._type_), POINTER(array._type_))
+
+def _per_reference(value, n):
+    """
+    Expand a filter value shared by all the references into one value per reference
+    """
+    if isinstance(value, (list, tuple)):
+        return value
+    return [value] * n
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+class PyAlignCoords(object):
+    """
+    @class  PyAlignCoords
+    @brief  Lightweight result of a score only alignment, holding the score and the begin/end
+    coordinates from a CAlignRes structure but no cigar string
+    """
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+
+    __slots__ = ('score', 'score2', 'ref_seq', 'ref_begin', 'ref_end',
+                 'query_seq', 'query_begin', 'query_end')
+
+    def __str__(self):
+        msg = "OPTIMAL MATCH\n"
+        msg += "Score            {}\n".format(self.score)
+        msg += "Score 2          {}\n".format(self.score2)
+        msg += "Reference begin  {}\n".format(self.ref_begin)
+        msg += "Reference end    {}\n".format(self.ref_end)
+        msg += "Query begin      {}\n".format(self.query_begin)
+        msg += "Query end        {}\n".format(self.query_end)
+        return msg
+
+    def __init__ (self, Res, query_seq, ref_seq):
+        contents = Res.contents
+        self.score = contents.score
+        self.score2 = contents.score2
+        self.ref_seq = ref_seq
+        self.ref_begin = contents.ref_begin
+        self.ref_end = contents.ref_end
+        self.query_seq = query_seq
+        self.query_begin = contents.query_begin
+        self.query_end = contents.query_end
+
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
 class PyAlignRes(object):
     """
@@ -12,6 +12,21 @@ def test_tred():
     main(["tests/samples.csv", "--workdir", "work"])
 
 
+def test_locus_processes(tmpdir):
+    """ Reads classified by the pool of processes of each sample, shared by
+    its loci, give the calls of the serial path
+    """
+    import json
+    from tredparse.tred import main
+    calls = []
+    for opts in ([], ["--locuscpus", "2"]):
+        workdir = str(tmpdir.join("locuscpus{}".format(len(opts))))
+        main(["tests/samples.csv", "--workdir", workdir, "--cpus", "1"] + opts)
+        calls.append([json.load(open("{}/{}.json".format(workdir, x)))["tredCalls"]
+                      for x in ("t001", "t002")])
+    assert calls[0] == calls[1]
+
+
 def test_tredreport():
     """ Highlight the potential risk individuals
     """
@@ -19,6 +34,617 @@ def test_tredreport():
     main(["work/t001.json", "work/t002.json", "--tsv", "work.tsv"])
 
 
+def test_aligner_panel():
+    """ Aligning against a panel reuses the query profile but gives the same
+    alignments as aligning against each reference separately
+    """
+    from ssw import Aligner, AlignerPanel
+    prefix, repeat, suffix = "GCGACCCTGGAAAAGCTGATGAAGGCCTTCGAGTCCCTCAAGTCCTTC", "CAG", \
+                             "CAACAGCCGCCACCGCCGCCGCCGCCGCCG"
+    refs = [prefix + repeat * units + suffix for units in range(1, 30)]
+    read = prefix[-20:] + repeat * 15 + suffix[:20]
+    kwargs = dict(match=1, mismatch=5, gap_open=7, gap_extend=2)
+    panel = AlignerPanel(refs, **kwargs)
+    hits = dict(panel.align(read, min_score=30))
+    batch = panel.align_batch(read, min_score=30)
+    for i, ref in enumerate(refs):
+        al = Aligner(ref_seq=ref, **kwargs).align(read, min_score=30)
+        xl = Aligner(ref_seq=ref, report_cigar=False, **kwargs).align(read, min_score=30)
+        if not al:
+            assert i not in hits and batch[i].ref_begin == -1 and xl is None
+            continue
+        coords = (al.score, al.ref_begin, al.ref_end, al.query_begin, al.query_end)
+        assert coords == (xl.score, xl.ref_begin, xl.ref_end, xl.query_begin, xl.query_end)
+        assert coords == (hits[i].score, hits[i].ref_begin, hits[i].ref_end,
+                          hits[i].query_begin, hits[i].query_end)
+        assert coords == (batch[i].score, batch[i].ref_begin, batch[i].ref_end,
+                          batch[i].query_begin, batch[i].query_end)
+
+    xl = Aligner(ref_seq=refs[0], report_cigar=False, **kwargs)
+    assert xl.align(read, min_score=len(read)) is None
+
+    best, al = panel.align_batch(read, min_score=30, best_only=True)
+    assert refs[best].count(repeat) >= 15
+    assert al.score == max(x.score for x in batch) == len(read)
+
+    window = panel.align_batch(read, min_score=30, start=10, stop=20)
+    assert [x.score for x in window] == [x.score for x in batch[10:20]]
+    assert panel.align_batch(read, min_score=30, best_only=True, start=5)[0] == best
+
+    import cPickle
+    packed = cPickle.loads(cPickle.dumps(panel, cPickle.HIGHEST_PROTOCOL))
+    assert packed.ref_seqs == refs
+    assert [x.score for x in packed.align_batch(read, min_score=30)] == \
+           [x.score for x in batch]
+
+    from ssw.ssw_wrap import rc
+    reads = [read, rc(read), read[5:-5], prefix[-20:] + repeat * 25 + suffix[:20],
+             prefix[-20:] + "CAGCTG" * 10 + suffix[:20]] * 4
+    for read, lanes in zip(reads, panel.align_reads(reads, min_score=30)):
+        one = panel.align_batch(read, min_score=30)
+        assert [(x.score, x.ref_begin, x.ref_end, x.query_begin, x.query_end) for x in lanes] == \
+               [(x.score, x.ref_begin, x.ref_end, x.query_begin, x.query_end) for x in one]
+
+
+def test_repeat_graph():
+    """ A single alignment against the repeat graph finds the same best hit as
+    the panel of references with one to 50 units
+    """
+    from ssw import AlignerPanel, RepeatGraphAligner
+    from ssw.ssw_wrap import rc
+    prefix, repeat, suffix = "GCCTTCGAGTCCCTCAAG", "CAG", "CAACAGCCGCCACCGCCG"
+    refs, units = [], []
+    for u in range(1, 51):
+        ref = prefix + repeat * u + suffix
+        refs += [ref, rc(ref)]
+        units += [u, u]
+    kwargs = dict(match=1, mismatch=5, gap_open=7, gap_extend=2)
+    panel = AlignerPanel(refs, **kwargs)
+    graph = RepeatGraphAligner(prefix, repeat, suffix, **kwargs)
+    for u, start, mutate in ((5, 60, False), (20, 40, True), (45, 70, True),
+                             (60, 100, False), (12, 0, False)):
+        haplotype = "TTGACCAGGA" * 8 + prefix + repeat * u + suffix + "GGATCCATTA" * 8
+        read = haplotype[start: start + 150]
+        if mutate:  # One mismatch and one deletion
+            read = read[:30] + "T" + read[31:100] + read[102:]
+        for query in (read, rc(read)):
+            i, best = panel.align_batch(query, best_only=True)
+            al = graph.align(query)
+            assert (best.score, units[i], best.ref_begin, best.ref_end,
+                    best.query_begin, best.query_end, best.hang) == \
+                   (al.score, al.units, al.ref_begin, al.ref_end,
+                    al.query_begin, al.query_end, al.hang)
+
+    # Reads classified against the graph have at most the units of the panel
+    from collections import namedtuple
+    from tredparse.bam_parser import BamParser
+    from tredparse.meta import TREDsRepo
+    from tredparse.utils import InputParams
+    Read = namedtuple("Read", "query_name query_sequence")
+    bp = BamParser(InputParams("graph.bam", 60, TREDsRepo(), "HD", repeatgraph=True))
+    for u, expected in ((20, (20, "FULL")), (21, (20, "PREF"))):
+        read = Read("r", bp.fullPrefix + bp.repeat * u + bp.fullSuffix)
+        assert bp._parseReadGraph(bp.chr, read, bp._buildGraph())[1:] == expected
+
+
+def test_packed_seq():
+    """ Packed sequences unpack to the same bases and reverse complement, and
+    align like the python strings
+    """
+    import cPickle
+    from ssw import AlignerPanel, PackedSeq
+    from ssw.ssw_wrap import rc
+    read = "GCCTTCGAGTCCCTCAAGCAGCAGCAGNCAGCAGCAACAGCCGCCACCGCCG"
+    for seq in (read, read[:-1], read[:-2], read[:-3], ""):
+        packed = PackedSeq(seq)
+        assert str(packed) == seq and len(packed) == len(seq)
+        assert str(rc(packed)) == rc(seq)
+        assert cPickle.loads(cPickle.dumps(packed)) == packed
+    assert PackedSeq("AAA").key != PackedSeq("AAAA").key
+    assert str(PackedSeq("acgtX")) == "ACGTN" and not PackedSeq.packable("acgtX")
+
+    refs = [read[:18] + "CAG" * units + read[-18:] for units in range(1, 10)]
+    panel = AlignerPanel(refs, match=1, mismatch=5, gap_open=7, gap_extend=2)
+    assert [x.score for x in panel.align_batch(PackedSeq(read))] == \
+           [x.score for x in panel.align_batch(read)]
+
+
+@pytest.mark.parametrize("options", [
+    dict(unitsearch="window"),
+    dict(unitsearch="validate"),
+    dict(strandvote=True),
+    dict(readcache=10000),
+    dict(triage=("nokmer",)),
+    dict(threads=3),
+])
+def test_option_calls(options):
+    """ Reads classified with each of the speed options get the calls of the
+    serial exhaustive scan
+    """
+    from tredparse.bam_parser import BamParser, READCACHE
+    from tredparse.meta import TREDsRepo
+    from tredparse.utils import InputParams
+    repo = TREDsRepo()
+    options = dict(options)
+    readcache = options.pop("readcache", 0)  # Set on the process, by run()
+    for bam, name in (("tests/t001.bam", "HD"), ("tests/t002.bam", "DM1")):
+        serial = BamParser(InputParams(bam, 150, repo, name))
+        serial.parse()
+        READCACHE.resize(readcache)
+        try:
+            bp = BamParser(InputParams(bam, 150, repo, name, **options))
+            bp.parse()
+        finally:
+            READCACHE.resize(0)
+            READCACHE.clear()
+        assert bp.details.to_list() == serial.details.to_list()
+
+
+def test_unit_search():
+    """ Reads are aligned against the targets around the motif estimate, and
+    the window is widened only when the best alignment sits on its edge
+    """
+    from collections import namedtuple
+    from tredparse.bam_parser import BamParser, UNITWINDOW
+    from tredparse.meta import TREDsRepo
+    from tredparse.utils import InputParams
+    repo = TREDsRepo()
+    bp = BamParser(InputParams("window.bam", 150, repo, "HD", unitsearch="window"))
+    db = bp._buildDB()
+    ranges = []
+    alignSW = bp._alignSW
+    def spy(seq, db, lo, hi, strands, verbose=False):
+        ranges.append((lo, hi))
+        return alignSW(seq, db, lo, hi, strands, verbose=verbose)
+    bp._alignSW = spy
+    read = bp.fullPrefix[-40:] + bp.repeat * 10 + bp.fullSuffix[:40]
+    record = namedtuple("Read", "query_name query_sequence")("r", read)
+    assert bp._parseReadWindow(None, record, db)[1:] == (10, "FULL")
+    estimate = bp._estimate_units(read)
+    assert ranges == [(estimate - UNITWINDOW, estimate + UNITWINDOW)]
+    assert bp._parseReadSW(None, record, db)[1:] == (10, "FULL")
+
+    for bam, name in (("tests/t001.bam", "HD"), ("tests/t002.bam", "DM1")):
+        bp = BamParser(InputParams(bam, 150, repo, name, unitsearch="validate"))
+        bp.parse()
+        stats = bp.unitsearch_stats
+        assert stats["reads"] and not stats["disagreements"]
+        assert stats["targets"] < stats["reads"] * 2 * bp.max_units
+
+
+def test_strand_vote():
+    """ Reads are aligned to the strand their k-mers vote for, or to both
+    when the vote is void, and get the calls of the alignment to both strands
+    """
+    from collections import namedtuple
+    from tredparse.bam_parser import BamParser, rc
+    from tredparse.meta import TREDsRepo
+    from tredparse.utils import InputParams
+    Read = namedtuple("Read", "query_name query_sequence")
+    repo = TREDsRepo()
+    bp = BamParser(InputParams("vote.bam", 150, repo, "HD", strandvote=True))
+    read = bp.fullPrefix[-40:] + bp.repeat * 10 + bp.fullSuffix[:40]
+    assert bp._strands(read) == (0,) and bp._strands(rc(read)) == (1,)
+    assert bp._strands("ACGT" * 20) == (0, 1)
+
+    # A read of one strand is not aligned to the other one
+    db = bp._buildDB()
+    strands = []
+    alignSW = bp._alignSW
+    def spy(seq, db, lo, hi, voted, verbose=False):
+        strands.append(voted)
+        return alignSW(seq, db, lo, hi, voted, verbose=verbose)
+    bp._alignSW = spy
+    both = BamParser(InputParams("vote.bam", 150, repo, "HD"))
+    for seq, strand in ((read, 0), (rc(read), 1)):
+        best = bp._parseReadSW(None, Read("r", seq), db)
+        assert best[1:] == (10, "FULL")
+        assert best == both._parseReadSW(None, Read("r", seq), db)
+        assert strands.pop() == (strand,)
+
+
+def test_read_cache():
+    """ Cache evicts the least recently used keys, and reads found in the
+    read cache are not classified again
+    """
+    from tredparse.bam_parser import BamParser, READCACHE
+    from tredparse.meta import TREDsRepo
+    from tredparse.utils import InputParams, LRUCache
+    cache = LRUCache(2)
+    cache["a"], cache["b"] = 1, 2
+    assert cache.get("a") == 1  # b is now the least recently used
+    cache["c"] = 3
+    assert "b" not in cache and cache.get("b") is None and len(cache) == 2
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    repo = TREDsRepo()
+    READCACHE.resize(10000)
+    READCACHE.clear()
+    try:
+        classified = []
+        for i in range(2):
+            bp = BamParser(InputParams("tests/t002.bam", 150, repo, "DM1"))
+            classify = bp._classify
+            def spy(parseRead, chr, read, db):
+                classified.append(read.query_sequence)
+                return classify(parseRead, chr, read, db)
+            bp._classify = spy
+            bp.parse()
+            if not i:  # Each sequence is classified once, its repeats hit
+                lookups = READCACHE.hits + READCACHE.misses
+                assert READCACHE.misses == len(classified) == len(READCACHE)
+                assert len(set(classified)) == len(classified)
+        # The second parse is served from the cache
+        assert len(classified) == READCACHE.misses
+        assert READCACHE.hits + READCACHE.misses == 2 * lookups
+    finally:
+        READCACHE.resize(0)
+        READCACHE.clear()
+
+
+def test_triage():
+    """ Reads are skipped before the alignment for the enabled reasons only,
+    and counted instead of classified
+    """
+    import random
+    from tredparse.bam_parser import BamParser, ReadRecord, TRIAGE
+    from tredparse.meta import TREDsRepo
+    from tredparse.utils import InputParams
+    random.seed(1)
+    repo = TREDsRepo()
+    bp = BamParser(InputParams("triage.bam", 150, repo, "HD", triage=TRIAGE))
+    read = bp.fullPrefix + bp.repeat * 10 + bp.fullSuffix
+    noise = "".join(random.choice("ACGT") for i in range(len(read)))
+    good, bad = [30] * len(read), [5] * len(read)
+    for record, reason in ((ReadRecord("r", read, good, False, False, False), None),
+                           (ReadRecord("r", read, good, True, False, False), "duplicate"),
+                           (ReadRecord("r", read, good, False, True, False), "secondary"),
+                           (ReadRecord("r", read, good, False, False, True), "supplementary"),
+                           (ReadRecord("r", read, bad, False, False, False), "lowqual"),
+                           (ReadRecord("r", noise, good, False, False, False), "nokmer")):
+        assert bp._triage(record) == reason
+    bp.triage = ("nokmer",)
+    assert bp._triage(ReadRecord("r", read, bad, True, False, False)) is None
+
+    # The triaged read is only counted, the flank read goes to the alignment
+    bp = BamParser(InputParams("triage.bam", 150, repo, "HD", triage=("nokmer",)))
+    db = bp._buildDB()
+    classified = []
+    classify = bp._classify
+    def spy(parseRead, chr, read, db):
+        classified.append(read.query_sequence)
+        return classify(parseRead, chr, read, db)
+    bp._classify = spy
+    read = bp.fullPrefix[-40:] + bp.repeat * 10 + bp.fullSuffix[:40]
+    noise = noise[:len(read)]
+    assert bp._decide(bp._parseReadSW, None,
+                      ReadRecord("r", noise, good, False, False, False), db) is None
+    assert classified == [] and bp.triage_counts == {"nokmer": 1}
+    best = bp._decide(bp._parseReadSW, None,
+                      ReadRecord("r", read, good, False, False, False), db)
+    assert best[1:] == (10, "FULL") and classified == [read]
+    assert bp.triage_counts == {"nokmer": 1}
+
+
+def test_locus_threads():
+    """ Reads are classified by the threads of the pool, not by the thread
+    of the parser, and tallied in the order of the serial path
+    """
+    import threading
+    from tredparse.bam_parser import BamParser
+    from tredparse.meta import TREDsRepo
+    from tredparse.utils import InputParams
+    repo = TREDsRepo()
+    serial = BamParser(InputParams("tests/t001.bam", 150, repo, "HD"))
+    serial.parse()
+    bp = BamParser(InputParams("tests/t001.bam", 150, repo, "HD", threads=3))
+    threads = []
+    decide = bp._decide
+    def spy(parseRead, chr, read, db):
+        threads.append(threading.current_thread())
+        return decide(parseRead, chr, read, db)
+    bp._decide = spy
+    bp.parse()
+    assert threads and threading.current_thread() not in threads
+    assert bp.details.to_list() == serial.details.to_list()
+    assert bp.counts == serial.counts
+
+
+def test_fast_path():
+    """ Reads classified by the fast path get the calls of the panel scan
+    """
+    import pysam
+    from ssw import FlankFinder
+    from tredparse.bam_parser import BamParser
+    from tredparse.meta import TREDsRepo
+    from tredparse.utils import InputParams
+    finder = FlankFinder("CAGCAGNAG")
+    assert finder.find("TTCAGCAGTAGTT", 0) == 10
+    assert finder.find("TTCAGCTGTAGTT", 0) == -1 and finder.find("TTCAGCTGTAGTT", 1) == 10
+    assert FlankFinder("CAGCAGNAG", reverse=True).find("TTCAGCAGTAGTT", 0) == 2
+    assert finder.find("CAGCAGAAGCAGCAGAAG", 0) == -1  # Ends at two positions
+
+    repo = TREDsRepo()
+    for bam, name in (("tests/t001.bam", "HD"), ("tests/t002.bam", "DM1")):
+        tred = repo[name]
+        bp = BamParser(InputParams(bam, 150, repo, name, fastpath=True))
+        db = bp._buildDB()
+        reads = [x for x in pysam.AlignmentFile(bam).fetch(tred.chr,
+                 tred.repeat_start - 150, tred.repeat_end + 150) if x.query_sequence]
+        fast = [x for x in reads if bp._parseReadFast(x, db)]
+        assert fast
+        for read in fast:
+            assert bp._parseReadFast(read, db) == bp._parseReadSW(tred.chr, read, db)
+
+        bp.parse()
+        default = BamParser(InputParams(bam, 150, repo, name))
+        default.parse()
+        assert bp.fastpath_counts["fast"] and bp.counts == default.counts
+
+
+def test_read_details():
+    """ Reads stored by columns give back the dicts of the reads, and tally
+    the counts by tag, PREF and POST sharing theirs
+    """
+    from collections import defaultdict
+    from tredparse.bam_parser import ReadDetails
+    reads = [("REPT", 50, "r1", "CAGCAG"), ("FULL", 15, "r2", "CAGNCA"),
+             ("PREF", 20, "r3", "CAGXCA"), ("REPT", 50, "r1", "CTGCTG"),
+             ("POST", 12, "r4", "GCAGCA"), ("FULL", 17, "r5", "CAGCAA")]
+    details = ReadDetails()
+    for read in reads:
+        details.append(*read)
+    assert details.to_list() == [{"tag": t, "h": h, "id": i, "seq": s}
+                                 for t, h, i, s in reads]
+    tags, h, ids = details.columns()
+    assert h.tolist() == [x[1] for x in reads]
+    assert ids.tolist() == [0, 1, 2, 0, 3, 4]
+    nodetails = ReadDetails(keepseqs=False)
+    nodetails.extend(details)
+    assert [x["id"] for x in nodetails] == [x[2] for x in reads]
+    assert "seq" not in nodetails.to_list()[0]
+
+    assert details.remove_pairs("REPT") == 1  # Both reads of r1
+    assert [x["id"] for x in details] == ["r2", "r3", "r4", "r5"]
+    counts = dict(FULL=defaultdict(int), REPT=defaultdict(int))
+    counts["PREF"] = counts["POST"] = defaultdict(int)
+    details.tally(counts)
+    assert sorted(counts["FULL"].items()) == [(15, 1), (17, 1)]
+    assert sorted(counts["PREF"].items()) == [(12, 1), (20, 1)]
+
+
+def test_long_reads():
+    """ Long reads are classified from the repeat tract between their flanks,
+    on either strand, and tracts beyond the allele sizes of the caller are
+    partial
+    """
+    import random
+    from collections import namedtuple
+    from tredparse.bam_parser import BamParser, rc
+    from tredparse.meta import TREDsRepo
+    from tredparse.utils import InputParams
+    Read = namedtuple("Read", "query_name query_sequence")
+    random.seed(1)
+    repo = TREDsRepo()
+    bp = BamParser(InputParams("long.bam", 15000, repo, "HD", longreads=True))
+    tred = repo.get("HD")
+    for units in (12, 40, 120, 500):
+        left, right = ["".join(random.choice("ACGT") for i in range(3000)) for j in range(2)]
+        read = left + tred.prefix + "CAG" * units + "CAA" + "CAG" * 5 + tred.suffix + right
+        expected = (units + 6, "FULL") if units < bp.max_units else (bp.max_units, "PREF")
+        for seq in (read, rc(read)):
+            assert bp._parseReadLong(tred.chr, Read("r", seq), None)[1:] == expected
+    assert bp._parseReadLong(tred.chr, Read("r", left + right), None) is None
+    # Neither a read ending in the tract nor a read starting off the locus,
+    # with only the last bases of the prefix, spans the tract
+    ends = left + tred.prefix + "CAG" * 20 + "CAACAGCAGCCA"
+    starts = left[:-8] + tred.prefix[-8:] + "CAG" * 20 + tred.suffix + right
+    for read in (ends, starts):
+        for seq in (read, rc(read)):
+            assert bp._parseReadLong(tred.chr, Read("r", seq), None) is None
+    # The anchor profiles are built once per locus
+    assert BamParser(InputParams("long.bam", 15000, repo, "HD",
+                                 longreads=True)).anchors is bp.anchors
+
+
+def test_depth():
+    """ Depths from the read spans are the sums of the pileup columns, for
+    single regions and for overlapping regions in one call
+    """
+    import logging
+    import pysam
+    from tredparse.bam_parser import BamDepth
+    samfile = pysam.AlignmentFile("tests/t001.bam")
+    bd = BamDepth("tests/t001.bam", "hg38", logging.getLogger())
+    regions = [("chr4", 3073000, 3075000), ("chr4", 3074000, 3074500),
+               ("chr4", 3076000, 3076001), ("chr4", 3060000, 3080000)]
+    expected = [sum(c.n for c in samfile.pileup(*x)) * 1. / (x[2] - x[1] + 1)
+                for x in regions]
+    assert bd.regions_depth(regions) == expected
+    assert bd.region_depth(*regions[0]) == expected[0]
+
+
+def test_locus_prefetch():
+    """ Loci are visited in genomic order, and the reads prefetched in the
+    background are those fetched in the foreground, by a reader thread that
+    is stopped when the iteration ends
+    """
+    import logging
+    from tredparse.bam_parser import AlignmentSession, LocusPrefetcher, \
+            genomic_order
+    from tredparse.meta import TREDsRepo
+    repo = TREDsRepo()
+    session = AlignmentSession("tests/t001.bam", threads=2)
+    treds = genomic_order(session, [repo[x] for x in ("DM1", "SCA1", "HD")])
+    assert [x.name for x in treds] == ["HD", "SCA1", "DM1"]
+    items = [(x, True) for x in treds]
+    logger = logging.getLogger()
+    serial = list(LocusPrefetcher(session, items, logger))
+    prefetched = LocusPrefetcher(session, items, logger, prefetch=True)
+    visited = []
+    for b, lb in prefetched:
+        # With one locus queued ahead, the reader is still to queue the last
+        assert prefetched.reader.is_alive() or len(visited) >= len(treds) - 2
+        a, la = serial[len(visited)]
+        assert a is b and la.records == lb.records
+        visited.append(b)
+    assert visited == treds
+    assert not prefetched.reader.is_alive()
+
+    # Abandoned part-way, the reader thread is stopped
+    prefetcher = LocusPrefetcher(session, items, logger, prefetch=True)
+    loci = iter(prefetcher)
+    assert next(loci)[0] is treds[0]
+    assert prefetcher.reader.is_alive()
+    loci.close()
+    assert not prefetcher.reader.is_alive()
+    session.close()
+
+
+def test_minibam(tmpdir):
+    """ Mini-BAM has the reads of the locus windows, in the order of the BAM
+    file, and the sample facts in its header
+    """
+    import logging
+    import pysam
+    from tredparse.bam_parser import header_facts, write_evidence
+    from tredparse.meta import TREDsRepo
+    tred = TREDsRepo()["HD"]
+    minibam = str(tmpdir.join("t001.bam"))
+    write_evidence("tests/t001.bam", [tred], "hg38", minibam,
+                   logging.getLogger(), facts={"readLen": 150})
+    region = (tred.chr, tred.repeat_start - 10000, tred.repeat_end + 10000)
+    names = lambda x: [(r.query_name, r.flag) for r in \
+                        pysam.AlignmentFile(x).fetch(*region)]
+    assert names(minibam) == names("tests/t001.bam")
+    assert header_facts(minibam) == {"readLen": 150}
+    assert header_facts("tests/t001.bam") == {}
+
+
+def test_remote_bam(tmpdir):
+    """ Local copy of a BAM file served with range requests gives the reads of
+    the regions, and the next copy comes from the block cache. The file is
+    fingerprinted by its version
+    """
+    import logging
+    import os.path as op
+    import threading
+    import BaseHTTPServer
+    import SimpleHTTPServer
+    import pysam
+    from tredparse.bam_parser import bam_fingerprint, locus_regions
+    from tredparse.meta import TREDsRepo
+    from tredparse.remote import BlockCache, RemoteBam
+
+    requests, etag = [], ['"v1"']
+
+    class RangeHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+        def do_GET(self):
+            requests.append(self.path)
+            try:
+                data = open(self.translate_path(self.path), "rb").read()
+            except IOError:
+                return self.send_error(404)
+            start, end = self.headers["Range"].split("=")[1].split("-")
+            start, end = int(start), min(int(end), len(data) - 1)
+            self.send_response(206)
+            self.send_header("Content-Range",
+                             "bytes {}-{}/{}".format(start, end, len(data)))
+            self.send_header("Content-Length", end - start + 1)
+            self.send_header("ETag", etag[0])
+            self.end_headers()
+            self.wfile.write(data[start: end + 1])
+
+        def log_message(self, *args):
+            pass
+
+    server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), RangeHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = "http://127.0.0.1:{}/tests/t001.bam".format(server.server_port)
+
+    tred = TREDsRepo()["HD"]
+    logger = logging.getLogger()
+    cache = BlockCache(str(tmpdir.join("cache")), 1 << 30)
+    region = (tred.chr, tred.repeat_start - 10000, tred.repeat_end + 10000)
+    names = lambda x: [(r.query_name, r.flag) for r in \
+                        pysam.AlignmentFile(x).fetch(*region)]
+    for i in range(2):
+        localcopy = str(tmpdir.join("t001.{}.bam".format(i)))
+        RemoteBam(url, cache, logger).localize(locus_regions([tred], "hg38",
+                                               logger), localcopy)
+        assert names(localcopy) == names("tests/t001.bam")
+        if i == 0:
+            fetched, requests[:] = len(requests), []
+    assert fetched > 2 and len(requests) == 2  # Only the sizes of bam and bai
+
+    fingerprint = bam_fingerprint(url)
+    assert fingerprint == (url, op.getsize("tests/t001.bam"), '"v1"', None)
+    etag[0] = '"v2"'  # Object replaced behind the URL
+    assert bam_fingerprint(url) != fingerprint
+    server.shutdown()
+
+
+def test_http_bam(tmpdir):
+    """ BAM file served without range requests is genotyped as the local file,
+    its fingerprint falling back to the URL
+    """
+    import json
+    import os
+    import threading
+    import BaseHTTPServer
+    import SimpleHTTPServer
+    from tredparse.bam_parser import bam_fingerprint
+    from tredparse.tred import main
+
+    root = os.getcwd()
+
+    class PlainHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+        def translate_path(self, path):  # The runs change the working folder
+            return os.path.join(root, path.lstrip("/"))
+
+        def log_message(self, *args):
+            pass
+
+    server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), PlainHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = "http://127.0.0.1:{}/tests/t001.bam".format(server.server_port)
+    assert bam_fingerprint(url) == (url,)
+
+    samples = tmpdir.join("samples.csv")
+    samples.write("#SampleKey,BAM,TRED\nlocal,{},HD\nhttp,{},HD\n"\
+                  .format(os.path.join(root, "tests/t001.bam"), url))
+    workdir = str(tmpdir.join("work"))
+    main([str(samples), "--workdir", workdir, "--cpus", "1",
+          "--profiles", str(tmpdir.join("profiles"))])
+    calls = [json.load(open("{}/{}.json".format(workdir, x)))["tredCalls"]
+             for x in ("local", "http")]
+    assert calls[1]["HD.1"] == calls[0]["HD.1"] and \
+           calls[1]["HD.2"] == calls[0]["HD.2"]
+    server.shutdown()
+
+
+def test_sample_profile(tmpdir):
+    """ Sample facts are read back from the sidecar by the next profile of
+    the same BAM file, and only by it
+    """
+    from tredparse.bam_parser import SampleProfile
+    from tredparse.meta import TREDsRepo
+    tred = TREDsRepo()["HD"]
+    profile = SampleProfile("tests/t001.bam", str(tmpdir))
+    assert profile.get("readLen", lambda: 150) == 150
+    profile.locus(tred)["depth"] = 27.5
+    profile.save()
+
+    profile = SampleProfile("tests/t001.bam", str(tmpdir))
+    assert profile.get("readLen", lambda: 100) == 150
+    assert profile.locus(tred) == {"depth": 27.5}
+    assert SampleProfile("tests/t002.bam", str(tmpdir)).locus(tred) == {}
+
+
 @pytest.mark.skip(reason="Requires latex")
 def test_tredplot():
     """ Plot the likelihood surface based on the model
@@ -13,23 +13,77 @@ length extraction. These signals are then pushed into the Maximum Likelihood
 model for the prediction of allele sizes.
 """
 
+import cPickle
+import copy
+import hashlib
+import itertools
+import json
 import logging
 import math
+import os
+import Queue
+import os.path as op
+import re
 import sys
 import string
+import threading
 
 import numpy as np
 import pysam
 
-from collections import defaultdict
-from ssw import Aligner
-from utils import datafile
+from array import array
+from bisect import bisect_left
+from collections import defaultdict, namedtuple
+from multiprocessing import Pool, current_process
+from multiprocessing.pool import ThreadPool
+from remote import is_remote, remote_version
+from ssw import Aligner, AlignerPanel, FlankFinder, PackedSeq, RepeatGraphAligner
+from utils import LRUCache, datafile
 
 
 SPAN = 1000
 FLANKMATCH = 9
+UNITWINDOW = 3  # Repeat units aligned on each side of the estimate
+STRANDKMER = 12  # k-mer size for the strand vote
+PANEL_READLEN = 250  # Read length covered by the precompiled panels
+# Reasons to skip reads before the alignment, see BamParser._triage()
+TRIAGE = ("duplicate", "secondary", "supplementary", "lowqual", "nokmer")
+TRIAGE_MINQUAL = 10  # Mean base quality of the lowqual reads
+TRIAGE_MOTIFS = 4  # Motif occurrences needed by reads without flank k-mers
+FASTPATH_EDITS = 1  # Edits allowed in the flanks found by the fast path
+THREAD_BATCH = 64  # Reads handed out at once to the classification threads
+PROCESS_CHUNK = 1000  # Reads sent at once to the classification processes
+READ_BATCH = 256  # Reads aligned at once, one per SIMD lane of the aligner
+READ_BATCH_MIN = 64  # Fewest reads to align that are worth a batch
+LONGREAD_MOTIF = 12  # Motif bases that extend the flanks of the long read anchors
+LONGREAD_SCORE = .6  # Fraction of the perfect score needed to anchor a flank
+LONGREAD_MARGIN = 8  # Score lead of an anchor over its best match elsewhere
+LONGREAD_SCORING = dict(match=2, mismatch=4, gap_open=4, gap_extend=2)  # As minimap2 -x map-ont
 DNAPE_ELONGATE = SPAN * 10  # How far do we look beyond the target for paired-end
+PILEUP_SKIP = 0x4 | 0x100 | 0x200 | 0x400  # Unmapped, secondary, QC fail, duplicate
+PILEUP_MAXDEPTH = 8000  # Reads kept by the pileup at each position
+GENDER_MAXREADS = 500  # Reads sampled in each unique region of chrY
+GENDER_XRATIO = .75  # X/autosome depth ratio below which the sample is male
+PROFILE_VERSION = 1  # Bumped when the profiled windows or values change
+PROFILE_HEADER = "tredparse.profile:"  # Header comment of the sample facts of a mini-BAM
 _complement = string.maketrans('ATCGatcgNnXx', 'TAGCtagcNnXx')
+# Aligner panels of the loci, shared by all samples in the process
+PANELS = {}
+# Long read anchors of the loci, whose query profiles live as long as the process
+ANCHORS = {}
+# Classifications of the reads by packed sequence, disabled until resized
+READCACHE = LRUCache()
+GENDERS = {}  # Gender, Y depth and X/autosome ratio, by BAM fingerprint
+_missing = object()
+# Keys of the parsers handing out chunks, and in a classification process the
+# parser rebuilt for the last key with its targets
+_PARSER_KEYS = itertools.count()
+_CHUNK_PARSER = None
+
+# Sequence-only copy of the reads sent to the classification processes, with
+# the attributes of pysam.AlignedSegment used for the classification
+ReadRecord = namedtuple("ReadRecord", "query_name query_sequence "\
+                "query_qualities is_duplicate is_secondary is_supplementary")
 
 
 class BamParser:
@@ -42,12 +96,26 @@ class BamParser:
         self.logger = logging.getLogger('BamParser')
         self.logger.setLevel(inputParams.getLogLevel())
         self.bam = inputParams.bam
+        self.session = inputParams.session
+        self.profile = inputParams.profile
+        self.locus = inputParams.locus
+        self.altreads = inputParams.altreads
         self.gender = inputParams.gender
         self.depth = inputParams.depth
         self.READLEN = inputParams.READLEN
         self.clip = inputParams.clip
         self.alts = inputParams.alts
         self.repeatpairs = inputParams.repeatpairs
+        self.repeatgraph = inputParams.repeatgraph
+        self.unitsearch = inputParams.unitsearch
+        self.strandvote = inputParams.strandvote
+        self.triage = inputParams.triage
+        self.fastpath = inputParams.fastpath
+        self.threads = inputParams.threads
+        self.procs = inputParams.procs
+        self.pool = inputParams.pool
+        self.batchalign = inputParams.batchalign
+        self.longreads = inputParams.longreads
         self.ref = inputParams.ref
         # initialize tred-specific things
         self.tred = inputParams.tred
@@ -71,6 +139,10 @@ class BamParser:
         # Compute REPT cutoff
         self.period = len(self.repeat)
         self.max_units = int(math.ceil(self.READLEN * 1. / self.period))
+        if self.longreads:  # Capped by the allele sizes of the caller instead
+            self.max_units = (SPAN - 1) / self.period
+        self.motifs = [re.compile(x.replace("N", "[ACGT]")) \
+                        for x in set((self.repeat, rc(self.repeat)))]
 
         # Stores all the read counts for each repeat units
         counts = {}
@@ -79,25 +151,276 @@ class BamParser:
             counts[tag] = defaultdict(int)
 
         self.counts = counts
-        self.details = []  # Store read sequences, enabled on logging.INFO
+        # Store read sequences, enabled on logging.INFO
+        self.details = ReadDetails(keepseqs=inputParams.detailseqs)
+        self.thresholds = {}  # Alignment filters for each read length
+        # Number of reads, targets aligned and disagreements with the
+        # exhaustive scan, when validating the narrowed unit search
+        self.unitsearch_stats = defaultdict(int)
+        self.strand_kmers = self._buildStrandKmers()
+        self.flank_kmers = self._buildFlankKmers()
+        self.triage_counts = defaultdict(int)  # Reads skipped for each reason
+        self.fastpath_counts = defaultdict(int)  # Reads classified without SW
+        self.lock = threading.Lock()  # Guards the counters and READCACHE
+        self.batched = {}  # Alignments of the reads of the batch, by sequence
+        self.fastpaths = {}  # Fast path results of the reads of the batch, by sequence
+        if self.fastpath:
+            self.flanks = self._buildFlanks()
+        if self.longreads:
+            self.anchors = self._buildAnchors()
+        # Everything but the read sequence that the classification depends on
+        self.cachekey = (self.fullPrefix, self.repeat, self.fullSuffix,
+                         self.max_units, self.clip, self.repeatgraph,
+                         self.unitsearch, self.strandvote, self.longreads)
 
     def _buildDB(self):
         '''
         Build a series of aligners that each uses a reference with varying
         number of repeats - whichever scores the best is the winner.
         '''
-        ssws = []
-        # Build a list of ssw
-        for units in xrange(1, self.max_units + 1):
-            target = self.fullPrefix + self.repeat * units + self.fullSuffix
-            target_rc = rc(target)
-            for seq in (target, target_rc):
-                ssw = Aligner(ref_seq=seq,
-                              match=1, mismatch=5, gap_open=7, gap_extend=2,  # Strict
-                              #match=1, mismatch=4, gap_open=6, gap_extend=1, # BWA-MEM
-                              report_secondary=False)
-                ssws.append((units, seq, ssw))
-        return ssws
+        return get_panels(self.fullPrefix, self.repeat, self.fullSuffix,
+                          self.max_units)
+
+    def _buildStrandKmers(self):
+        '''
+        Build the k-mers of the locus (flanks and motif) that are only found on
+        the forward strand and those only found on the reverse strand.
+        '''
+        k = STRANDKMER
+        target = self.fullPrefix + self.repeat * (k / self.period + 2) + \
+                 self.fullSuffix
+        kmers = []
+        for seq in (target, rc(target)):
+            kmers.append(set(seq[i: i + k] for i in xrange(len(seq) - k + 1) \
+                             if "N" not in seq[i: i + k]))
+        shared = kmers[0] & kmers[1]
+        return [x - shared for x in kmers]
+
+    def _buildFlankKmers(self):
+        '''
+        Build the k-mers of the prefix and suffix flanks, in both orientations.
+        '''
+        k = STRANDKMER
+        kmers = set()
+        for flank in (self.fullPrefix, self.fullSuffix):
+            for seq in (flank, rc(flank)):
+                kmers.update(seq[i: i + k] for i in xrange(len(seq) - k + 1))
+        return kmers
+
+    def _buildFlanks(self):
+        '''
+        For each strand of the targets, the prefix flank, the motif and the
+        suffix flank as read on that strand, with the finders of the flanks in
+        the reads and the pattern of the runs of the motif. The suffix is
+        searched backwards from its first base.
+        '''
+        flanks = []
+        for prefix, motif, suffix in ((self.fullPrefix, self.repeat, self.fullSuffix),
+                (rc(self.fullSuffix), rc(self.repeat), rc(self.fullPrefix))):
+            run = re.compile("(?:{})*".format(motif.replace("N", "[ACGT]")))
+            flanks.append((prefix, motif, suffix, FlankFinder(prefix),
+                           FlankFinder(suffix, reverse=True), run))
+        return flanks
+
+    def _buildAnchors(self):
+        '''
+        For each strand of the targets, the aligners of the two anchors of the
+        long reads: the prefix flank followed by the first bases of the tract,
+        and the last bases of the tract followed by the suffix flank. The few
+        motif bases make the short flanks specific enough in long reads, and
+        the flanks are scored again on their own. The anchors are cached in
+        ANCHORS, so that their profiles are built once per locus rather than
+        per parser.
+        '''
+        key = (self.fullPrefix, self.repeat, self.fullSuffix)
+        if key in ANCHORS:
+            return ANCHORS[key]
+        units = int(math.ceil(LONGREAD_MOTIF * 1. / self.period))
+        tract = units * self.period
+        scorer = Aligner(report_cigar=False, **LONGREAD_SCORING)
+        anchors = []
+        for prefix, motif, suffix in ((self.fullPrefix, self.repeat, self.fullSuffix),
+                (rc(self.fullSuffix), rc(self.repeat), rc(self.fullPrefix))):
+            left, right = prefix + motif * units, motif * units + suffix
+            min_scores = [int(LONGREAD_SCORE * LONGREAD_SCORING["match"] * len(x))
+                          for x in (left, right)]
+            flanks = [(x, scorer.profile(x),
+                       int(LONGREAD_SCORE * LONGREAD_SCORING["match"] * len(x)))
+                      for x in (prefix, suffix)]
+            anchors.append((left, right, scorer.profile(left), scorer.profile(right),
+                            min_scores, len(prefix), tract, flanks))
+        return ANCHORS.setdefault(key, anchors)
+
+    def _parseReadLong(self, chr, read, db):
+        '''
+        Classify a long read that spans the repeat tract: the two anchors are
+        aligned to the read, which gives the ends of the tract and thus the
+        units without aligning the read against the targets. Tracts longer than
+        the allele sizes of the caller are counted as PREF at max_units, as the
+        allele is at least that long. Reads with a single anchor are not
+        informative, since they rarely end inside the tract. As the motif bases
+        alone nearly reach the anchor score, each flank also has to score on
+        its own next to the tract, or a read ending in the tract or starting
+        off the locus would be counted as FULL.
+        '''
+        seq = read.query_sequence
+        aligner = Aligner(ref_seq=seq, report_cigar=False, **LONGREAD_SCORING)
+        best = None
+        for strand in self._strands(seq):
+            left, right, left_profile, right_profile, (left_score, right_score), \
+                    prefix_len, tract, (prefix, suffix) = self.anchors[strand]
+            a = aligner.align(left, min_score=left_score, profile=left_profile,
+                              mask_len=len(left))
+            if a is None or a.score2 >= a.score - LONGREAD_MARGIN:
+                continue
+            b = aligner.align(right, min_score=right_score, profile=right_profile,
+                              mask_len=len(right))
+            if b is None or b.score2 >= b.score - LONGREAD_MARGIN:
+                continue
+            start = a.ref_end + 1 - (a.query_end + 1 - prefix_len)
+            end = b.ref_begin + tract - b.query_begin
+            if end - start < -self.period:
+                continue
+            if not (self._flankScores(seq, start - prefix_len, prefix) and
+                    self._flankScores(seq, end, suffix)):
+                continue
+            units = max(int(round((end - start) * 1. / self.period)), 1)
+            tag = "FULL"
+            if units > self.max_units:
+                units, tag = self.max_units, "PREF"
+            res = (a.score + b.score, units, tag)
+            if best is None or res[0] > best[0]:
+                best = res
+        return best
+
+    def _flankScores(self, seq, start, flank):
+        '''
+        Does the flank (sequence, profile, min_score) align with min_score to
+        the read bases from start, give or take LONGREAD_MARGIN bases?
+        '''
+        flank_seq, profile, min_score = flank
+        window = seq[max(start - LONGREAD_MARGIN, 0):
+                     max(start + len(flank_seq) + LONGREAD_MARGIN, 0)]
+        if not window:
+            return False
+        aligner = Aligner(ref_seq=window, report_cigar=False, **LONGREAD_SCORING)
+        return aligner.align(flank_seq, min_score=min_score, profile=profile,
+                             mask_len=len(flank_seq)) is not None
+
+    def _parseReadFast(self, read, db):
+        '''
+        Classify a clean read without scanning the panel: the prefix and suffix
+        flanks are located with at most FASTPATH_EDITS edits, and the sequence
+        between them (or from them to the read end) must be made of exact
+        copies of the motif. The units and the tag then follow from the tract
+        length; they are confirmed with a single alignment against that target,
+        which also gives the score. Returns None when the read is not clean
+        or the confirmation fails, so that the read goes through the panel.
+        '''
+        seq = read.query_sequence
+        _seq = FlankFinder.encode(seq)
+        period = self.period
+        for strand, (prefix, motif, suffix, prefix_finder, suffix_finder, motifs) in \
+                enumerate(self.flanks):
+            end = prefix_finder.find(_seq, FASTPATH_EDITS)
+            start = suffix_finder.find(_seq, FASTPATH_EDITS)
+
+            if end >= 0 and start >= 0:  # prefix + motif * units + suffix
+                tract = seq[end + 1: start]
+                units, tail = divmod(len(tract), period)
+                if start <= end or tail or not units or \
+                        motifs.match(tract).end() != len(tract):
+                    continue
+                tag = "FULL"
+            elif end >= 0:  # prefix + motif * units, up to the read end
+                tract = seq[end + 1:]
+                units, tail = divmod(len(tract), period)
+                if motifs.match(tract).end() != len(tract) - tail or \
+                        not partial_match(tract[len(tract) - tail:], motif[:tail]):
+                    continue
+                # A partial unit needs one more unit, unless the suffix has it
+                if tail and not partial_match(tract[len(tract) - tail:], suffix[:tail]):
+                    units += 1
+                tag = "PREF"
+            elif start >= 0:  # motif * units + suffix, from the read start
+                tract = seq[:start]
+                units, tail = divmod(len(tract), period)
+                if motifs.match(tract, tail).end() != len(tract) or \
+                        not partial_match(tract[:tail], motif[period - tail:]):
+                    continue
+                if tail and not partial_match(tract[:tail], prefix[len(prefix) - tail:]):
+                    units += 1
+                tag = "POST"
+            else:
+                continue
+
+            units = max(units, 1)
+            if units > self.max_units:
+                continue
+            res = self._alignSW(seq, db, units, units, (strand,))
+            if len(res) == 1 and res[0][1:] == (units, tag):
+                return res[0]
+        return None
+
+    def _triage(self, read):
+        '''
+        Reason to skip the read before the alignment, among the reasons enabled
+        in self.triage, or None if the read has to be aligned. Reads without
+        any k-mer of the flanks and with few copies of the motif cannot be
+        anything but HANG.
+        '''
+        triage = self.triage
+        if "duplicate" in triage and read.is_duplicate:
+            return "duplicate"
+        if "secondary" in triage and read.is_secondary:
+            return "secondary"
+        if "supplementary" in triage and read.is_supplementary:
+            return "supplementary"
+        if "lowqual" in triage:
+            quals = read.query_qualities
+            if quals and sum(quals) < TRIAGE_MINQUAL * len(quals):
+                return "lowqual"
+        if "nokmer" in triage:
+            seq = read.query_sequence
+            k = STRANDKMER
+            flank_kmers = self.flank_kmers
+            if not any(seq[i: i + k] in flank_kmers \
+                       for i in xrange(len(seq) - k + 1)) and \
+                    self._estimate_units(seq) < TRIAGE_MOTIFS:
+                return "nokmer"
+        return None
+
+    def _strands(self, seq):
+        '''
+        Strands of the targets to align the read against. The read k-mers vote
+        for the forward and the reverse strand of the locus, a read with votes
+        for both strands or for none is aligned against both.
+        '''
+        if not self.strandvote:
+            return (0, 1)
+        k = STRANDKMER
+        kmers = set(seq[i: i + k] for i in xrange(len(seq) - k + 1))
+        forward, reverse = (len(kmers & x) for x in self.strand_kmers)
+        if forward and not reverse:
+            return (0,)
+        if reverse and not forward:
+            return (1,)
+        return (0, 1)
+
+    def _thresholds(self, db, readlen):
+        """
+        Minimum score and minimum match length of the alignments against each
+        target, which only depend on the read length.
+        """
+        if readlen in self.thresholds:
+            return self.thresholds[readlen]
+        # Both strands have targets of the same lengths, hence the same filters
+        panel = db[0]
+        min_lens = [min(readlen, target_len) / 2 for target_len in panel.ref_lens]
+        min_scores = [max(min_len, 30) for min_len in min_lens]
+        filters = panel.filters(min_score=min_scores, min_len=min_lens)
+        self.thresholds[readlen] = filters
+        return filters
 
     def get_hangs(self, al):
         """
@@ -126,52 +449,292 @@ class BamParser:
         repeats. This is the preferred method that allows mismatches (sequencing
         errors or SNPs) inside the read.
         '''
+        seq = read.query_sequence
+        strands = self._strands(seq)
+        res = self._alignSW(seq, db, 1, self.max_units, strands, verbose=verbose)
+        return self._best(res)
+
+    def _parseReadWindow(self, chr, read, db, verbose=False):
+        '''
+        Same as _parseReadSW() but only aligns the read against the targets
+        with a number of repeat units close to the estimate from the motif
+        density. The window is widened as long as the best alignment sits on
+        one of its edges.
+        '''
+        seq = read.query_sequence
+        strands = self._strands(seq)
+        estimate = min(self._estimate_units(seq), self.max_units)
+        lo = max(1, estimate - UNITWINDOW)
+        hi = min(self.max_units, estimate + UNITWINDOW)
+        res = self._alignSW(seq, db, lo, hi, strands, verbose=verbose)
+        aligned = hi - lo + 1
+        while res:
+            score, units, tag = self._best(res)
+            if units == lo and lo > 1:
+                lo, end = max(1, lo - UNITWINDOW), lo - 1
+                res += self._alignSW(seq, db, lo, end, strands, verbose=verbose)
+                aligned += end - lo + 1
+            elif units == hi and hi < self.max_units:
+                start, hi = hi + 1, min(self.max_units, hi + UNITWINDOW)
+                res += self._alignSW(seq, db, start, hi, strands, verbose=verbose)
+                aligned += hi - start + 1
+            else:
+                break
+
+        if self.unitsearch == "validate":
+            stats = self.unitsearch_stats
+            self._count(stats, "reads")
+            self._count(stats, "targets", len(strands) * aligned)
+            full = self._alignSW(seq, db, 1, self.max_units, (0, 1))
+            window_best = self._best(res)
+            full_best = self._best(full)
+            # Only the (units, tag) of the reads kept as evidence matter,
+            # HANG reads are not counted in the calls
+            evidence = lambda x: x[1:] if x and x[2] != "HANG" else None
+            if evidence(window_best) != evidence(full_best):
+                self._count(stats, "disagreements")
+                self.logger.debug("Unit search disagrees: window={} full={} "\
+                                  "seq={}".format(window_best, full_best, seq))
+
+        return self._best(res)
+
+    def _alignSW(self, seq, db, lo, hi, strands, verbose=False):
+        '''
+        Align the read against the targets with lo to hi repeat units, on the
+        given strands, and return the (score, units, tag) of the informative
+        alignments.
+        '''
         res = []
+        filters = self._thresholds(db, len(seq))
+        batched = self.batched.get(seq)
+        for strand in strands:
+            panel = db[strand]
+            if batched and batched[strand] is not None:
+                alignments = batched[strand][lo - 1: hi]
+            else:
+                alignments = panel.align_batch(seq, filters=filters,
+                                               start=lo - 1, stop=hi)
+            for i, al in enumerate(alignments, lo - 1):
+                if al.ref_begin < 0:
+                    continue
+
+                units, target_len = i + 1, panel.ref_lens[i]
+                prefix_read = al.ref_begin < FLANKMATCH
+                suffix_read = al.ref_end > target_len - FLANKMATCH - 1
+                hang = al.hang
+                hang_read = hang >= FLANKMATCH
+
+                if verbose:
+                    al = panel[i].align(seq)
+                    print >> sys.stderr, units, al.ref_seq
+                    print >> sys.stderr, str(al).strip()
+                    print >> sys.stderr, '\n'.join(al.alignment)
+                    print >> sys.stderr, prefix_read, suffix_read, hang_read, hang
+                    print >> sys.stderr
+
+                tag = self._tag(seq, units, prefix_read, suffix_read, hang_read)
+                if tag is None:
+                    continue
+                res.append((al.score, units, tag))
+
+        return res
+
+    def _buildGraph(self):
+        '''
+        Build a single aligner against the repeat graph prefix -> (repeat)+ ->
+        suffix, that is equivalent to the series of aligners in _buildDB().
+        '''
+        return RepeatGraphAligner(self.fullPrefix, self.repeat, self.fullSuffix,
+                                  match=1, mismatch=5, gap_open=7, gap_extend=2)
+
+    def _parseReadGraph(self, chr, read, graph, verbose=False):
+        '''
+        Same as _parseReadSW() but aligns the read against the repeat graph, so
+        that the number of repeats comes out of a single alignment per strand,
+        whose cost does not grow with the number of targets. The graph has no
+        longest target, so the units are capped at those of the longest
+        target of the panel, where a FULL read only fits partially (PREF).
+        '''
         seq = read.query_sequence
-        rid = read.query_name
-        for units, target, ssw in db:
-            min_len = min(len(seq), len(target)) / 2
-            min_score = max(min_len, 30)
-            al = ssw.align(seq, min_score=min_score, min_len=min_len)
-            if not al:
-                continue
+        al = graph.align(seq, strands=self._strands(seq))
+        if not al:
+            return
+
+        min_len = min(len(seq), al.ref_len) / 2
+        min_score = max(min_len, 30)
+        if al.score < min_score or al.query_end - al.query_begin + 1 < min_len:
+            return
+
+        units = al.units
+        prefix_read = al.touches_start(FLANKMATCH)
+        suffix_read = al.touches_end(FLANKMATCH)
+        hang_read = al.hang >= FLANKMATCH
+        if not (prefix_read or suffix_read):
+            # Repeat-only alignments fit in any longer target with the same
+            # score, out of phase ones touch one more unit than they span
+            units = min(units, len(seq) / self.period)
+            units = max(units, self._max_units(seq) - 1)
 
-            prefix_read = al.ref_begin < FLANKMATCH
-            suffix_read = al.ref_end > len(target) - FLANKMATCH - 1
-            hang = self.get_hangs(al)
-            hang_read = hang >= FLANKMATCH
-
-            if verbose:
-                print >> sys.stderr, units, target
-                print >> sys.stderr, str(al).strip()
-                print >> sys.stderr, '\n'.join(al.alignment)
-                print >> sys.stderr, prefix_read, suffix_read, hang_read, hang
-                print >> sys.stderr
-
-            # Please note that while self.max_units is a global max,
-            # max_units is a local max (based on current read)
-            # This is useful in case one wants to process split reads
-            max_units = int(math.ceil(len(seq) * 1. / self.period)) \
-                            if self.clip else self.max_units
-
-            if hang_read:
-                tag = "HANG"
-            elif prefix_read:
+        if verbose:
+            print >> sys.stderr, str(al).strip()
+            print >> sys.stderr, prefix_read, suffix_read, hang_read, al.hang
+            print >> sys.stderr
+
+        tag = self._tag(seq, units, prefix_read, suffix_read, hang_read)
+        if tag is None:
+            return
+        max_units = self._max_units(seq)
+        if units > max_units:
+            units = max_units
+            if tag == "FULL":
                 tag = "PREF"
-                if suffix_read:
-                    tag = "FULL"
-            elif suffix_read:
-                tag = "POST"
-            elif units >= max_units - 1 and units * self.period <= len(seq):
-                tag = "REPT"
-            else:
-                continue
-            res.append((al.score, units, tag))
+        return al.score, units, tag
+
+    def _tag(self, seq, units, prefix_read, suffix_read, hang_read):
+        '''
+        Classify the alignment of a read against the target with the given
+        number of repeat units. Returns None if the read is not informative.
+        '''
+        max_units = self._max_units(seq)
+        if hang_read:
+            return "HANG"
+        elif prefix_read:
+            return "FULL" if suffix_read else "PREF"
+        elif suffix_read:
+            return "POST"
+        elif units >= max_units - 1 and units * self.period <= len(seq):
+            return "REPT"
+        return None
+
+    def _estimate_units(self, seq):
+        '''
+        Estimate the number of repeat units in the read from the number of
+        occurrences of the motif, in either orientation.
+        '''
+        return max(len(motif.findall(seq)) for motif in self.motifs)
+
+    def _max_units(self, seq):
+        # Please note that while self.max_units is a global max,
+        # max_units is a local max (based on current read)
+        # This is useful in case one wants to process split reads
+        return int(math.ceil(len(seq) * 1. / self.period)) \
+                        if self.clip else self.max_units
 
+    def _best(self, res):
+        '''
+        Best classification among the (score, units, tag) of the alignments of
+        a read, the one with the fewest units in case of ties.
+        '''
         if not res:
+            return None
+        return max(res, key=lambda x: (x[0], -x[1]))
+
+    def _parseRead(self, parseRead, chr, read, db):
+        '''
+        Classify the read with parseRead() and count it.
+        '''
+        best = self._decide(parseRead, chr, read, db)
+        self._addRead(best, read.query_name, read.query_sequence)
+
+    def _decide(self, parseRead, chr, read, db):
+        '''
+        Best classification of the read, None if it is skipped by the triage
+        or not informative. Reads with the same sequence get the same
+        classification, which is looked up in READCACHE when enabled.
+        '''
+        if self.triage:
+            reason = self._triage(read)
+            if reason:
+                self._count(self.triage_counts, reason)
+                return None
+
+        seq = read.query_sequence
+        if not READCACHE.maxsize or self.unitsearch == "validate":
+            return self._classify(parseRead, chr, read, db)
+
+        key = (self.cachekey, PackedSeq(seq).key)
+        with self.lock:
+            best = READCACHE.get(key, _missing)
+        if best is _missing:
+            best = self._classify(parseRead, chr, read, db)
+            with self.lock:
+                READCACHE[key] = best
+        return best
+
+    def _alignBatch(self, parseRead, reads, db):
+        '''
+        Align the reads against all the targets ahead of their classification,
+        in batches with one read per SIMD lane, which _alignSW() then looks up
+        in self.batched. Only the exhaustive search aligns every read against
+        the targets, those with 1 to max_units units as in _parseReadSW()
+        since the cached panels may have more. The reads skipped by the triage
+        or found in READCACHE are left out, and so are the reads classified by
+        the fast path, which is run first and kept in self.fastpaths.
+        '''
+        self.batched = {}
+        self.fastpaths = {}
+        if not self.batchalign or parseRead != self._parseReadSW:
+            return
+
+        pending = defaultdict(set)  # (strand, read length) => sequences
+        for read in reads:
+            if self.triage and self._triage(read):
+                continue
+            seq = read.query_sequence
+            if READCACHE.maxsize and (self.cachekey, PackedSeq(seq).key) in READCACHE:
+                continue
+            if self.fastpath and not self.longreads:
+                if seq not in self.fastpaths:
+                    self.fastpaths[seq] = self._parseReadFast(read, db)
+                if self.fastpaths[seq]:
+                    continue
+            for strand in self._strands(seq):
+                pending[strand, len(seq)].add(seq)
+        if sum(len(x) for x in pending.values()) < READ_BATCH_MIN:
             return
 
-        score, h, tag = max(res, key=lambda x: (x[0], -x[1]))
+        for (strand, readlen), seqs in pending.iteritems():
+            seqs = list(seqs)
+            results = db[strand].align_reads(seqs,
+                                    filters=self._thresholds(db, readlen),
+                                    start=0, stop=self.max_units)
+            if results is None:  # Too long for the batch, align one by one
+                continue
+            for seq, alignments in zip(seqs, results):
+                self.batched.setdefault(seq, [None, None])[strand] = alignments
+
+    def _count(self, counts, key, n=1):
+        '''
+        Increment counts[key], the counters are shared by the threads
+        classifying the reads.
+        '''
+        with self.lock:
+            counts[key] += n
+
+    def _classify(self, parseRead, chr, read, db):
+        '''
+        Classify the read with the fast path when enabled and conclusive,
+        otherwise with parseRead().
+        '''
+        if self.fastpath and not self.longreads:
+            best = self.fastpaths.get(read.query_sequence, _missing)
+            if best is _missing:
+                panels = self._buildDB() if self.repeatgraph else db
+                best = self._parseReadFast(read, panels)
+            if best:
+                self._count(self.fastpath_counts, "fast")
+                return best
+            self._count(self.fastpath_counts, "fallback")
+        return parseRead(chr, read, db)
+
+    def _addRead(self, best, rid, seq):
+        '''
+        Count the read with its best classification (score, units, tag).
+        '''
+        if best is None:
+            return
+
+        score, h, tag = best
         self.counts["HANG"][h] += 1
 
         s = "{}: h={:>3}, seq={}".format(tag, h, seq)
@@ -179,7 +742,7 @@ class BamParser:
 
         if tag == "HANG":
             return
-        self.details.append({'tag': tag, 'h': h, 'id': rid, 'seq': seq})
+        self.details.append(tag, h, rid, seq)
 
     def parse(self, pad=SPAN):
         """
@@ -196,54 +759,44 @@ class BamParser:
         READ_START = max(0, self.startRepeat - self.READLEN)
         READ_END = self.endRepeat + self.READLEN
 
-        samfile = read_alignment(self.bam)
-        db = self._buildDB()
+        samfile = open_alignment(self.session or self.bam)
+        db, parseRead = self._classifier()
 
         chr, start, end = self.chr, WINDOW_START, WINDOW_END
-        n_unmapped = 0
-        if test_fetch(samfile, chr, start, end, self.logger):
-            # This is the official STR region, grab all reads
-            for read in samfile.fetch(chr, start, end):
-                if read.is_unmapped:
-                    n_unmapped += 1
-                else:
-                    if read.reference_start < READ_START:
-                        continue
-                    if read.reference_start > READ_END:
-                        continue
-                self._parseReadSW(chr, read, db)
-
-            # Let's process the ALTs
-            if self.alts:
-                self.logger.debug("Process extra regions for mismapped reads")
-                for c, s, e in self.alt:
-                    if self.clip:
-                        continue
-                    try:
-                        if "nochr" in self.ref:
-                            c = c[3:]
-                        #print "c s e", c,s,e
-                        for read in samfile.fetch(c, s, e):
-                            # Check if the mate read is in the official STR region
-                            rid = read.next_reference_id
-                            if rid == -1:
-                                continue
-                            rname = samfile.getrname(rid)
-                            rstart = read.next_reference_start
-                            if rname != chr:
-                                continue
-                            if rstart < WINDOW_START:
-                                continue
-                            if rstart > WINDOW_END:
-                                continue
-                            self._parseReadSW(chr, read, db)
-                    except Exception as ex:
-                        self.logger.debug("Fetch failed for region {}:{}-{} ({})".\
-                                format(c, s, e, ex))
-                        continue
+        self.n_unmapped = 0
+        reads = self._fetchReads(samfile, WINDOW_START, WINDOW_END,
+                                 READ_START, READ_END)
+        procs = self.procs
+        if procs > 1 and not self.pool and current_process().daemon:
+            self.logger.debug("Cannot start processes from a daemon process, "\
+                              "classify the reads serially")
+            procs = 1
+        if procs > 1:
+            self._parseReadsProcesses(reads, procs)
+        elif self.threads > 1:
+            self._parseReadsThreaded(parseRead, chr, reads, db)
+        else:
+            for batch in batches(reads, READ_BATCH):
+                self._alignBatch(parseRead, batch, db)
+                for read in batch:
+                    self._parseRead(parseRead, chr, read, db)
+            self.batched, self.fastpaths = {}, {}
 
         self.logger.debug("A total of {} unmapped reads in {}:{}-{}".\
-                            format(n_unmapped, chr, start, end))
+                            format(self.n_unmapped, chr, start, end))
+        if self.fastpath:
+            self.logger.debug("Reads classified by the fast path: {} ({} "\
+                              "fallbacks)".format(self.fastpath_counts["fast"],
+                              self.fastpath_counts["fallback"]))
+        if self.triage:
+            self.logger.debug("Reads skipped by triage: {}".format(" ".join(\
+                "{}:{}".format(x, self.triage_counts[x]) for x in self.triage)))
+        if self.unitsearch == "validate":
+            stats = self.unitsearch_stats
+            self.logger.info("Unit search in {}: {} disagreements in {} reads "\
+                             "({} of {} targets aligned)".format(self.tred.name,
+                             stats["disagreements"], stats["reads"],
+                             stats["targets"], stats["reads"] * 2 * self.max_units))
 
         if not (self.repeatpairs or self.clip):
             self.remove_pairs_of_rept()
@@ -256,9 +809,151 @@ class BamParser:
         aggregate = sum
         self.rept = aggregate(self.counts["REPT"].values()) if self.counts["REPT"] else 0
 
+    def _fetchReads(self, samfile, WINDOW_START, WINDOW_END, READ_START, READ_END):
+        '''
+        Generate the reads to classify, in the order of the BAM file: reads of
+        the STR region and then mismapped reads from the alt regions.
+        '''
+        chr, start, end = self.chr, WINDOW_START, WINDOW_END
+        locus = self.locus
+        if locus and locus.covers(chr, start, end, seqs=True):
+            reads = locus
+        else:
+            reads = samfile
+        if not test_fetch(reads, chr, start, end, self.logger):
+            return
+
+        # This is the official STR region, grab all reads
+        for read in reads.fetch(chr, start, end):
+            if read.is_unmapped:
+                self.n_unmapped += 1
+            else:
+                if read.reference_start < READ_START:
+                    continue
+                if read.reference_start > READ_END:
+                    continue
+            yield read
+
+        # Let's process the ALTs
+        if self.alts:
+            self.logger.debug("Process extra regions for mismapped reads")
+            indexed = self.altreads.get(self.tred.name) \
+                        if self.altreads and not self.clip else None
+            if indexed is not None:
+                for read in indexed:
+                    yield read
+                return
+            for c, s, e in self.alt:
+                if self.clip:
+                    continue
+                try:
+                    if "nochr" in self.ref:
+                        c = c[3:]
+                    #print "c s e", c,s,e
+                    for read in samfile.fetch(c, s, e):
+                        # Check if the mate read is in the official STR region
+                        rid = read.next_reference_id
+                        if rid == -1:
+                            continue
+                        rname = samfile.getrname(rid)
+                        rstart = read.next_reference_start
+                        if rname != chr:
+                            continue
+                        if rstart < WINDOW_START:
+                            continue
+                        if rstart > WINDOW_END:
+                            continue
+                        yield read
+                except Exception as ex:
+                    self.logger.debug("Fetch failed for region {}:{}-{} ({})".\
+                            format(c, s, e, ex))
+                    continue
+
+    def _parseReadsThreaded(self, parseRead, chr, reads, db):
+        '''
+        Classify the reads in a pool of threads. The reads are fetched by the
+        pool in a single thread and handed out in batches, while the alignments
+        run in the SSW library which releases the GIL. The decisions come back
+        in the order of the reads and are counted as in the serial path.
+        '''
+        def classify(batch):
+            return [(read.query_name, read.query_sequence,
+                     self._decide(parseRead, chr, read, db)) for read in batch]
+
+        pool = ThreadPool(self.threads)
+        try:
+            for results in pool.imap(classify, batches(reads, THREAD_BATCH)):
+                for rid, seq, best in results:
+                    self._addRead(best, rid, seq)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _parseReadsProcesses(self, reads, procs):
+        '''
+        Classify the reads in a pool of processes, for ultra-deep loci: the
+        pool of the sample shared by its loci, or one started for the locus.
+        The reads are sent as sequence-only records in chunks of PROCESS_CHUNK,
+        with the parameters that the processes rebuild the parser from, and
+        the tallies of the chunks are reduced in the order of the reads, which
+        gives the same results as the serial path.
+        '''
+        key, params = next(_PARSER_KEYS), self._chunkParams()
+
+        def chunks():
+            chunk = []
+            for read in reads:
+                chunk.append(ReadRecord(read.query_name, read.query_sequence,
+                                        read.query_qualities, read.is_duplicate,
+                                        read.is_secondary, read.is_supplementary))
+                if len(chunk) == PROCESS_CHUNK:
+                    yield key, params, chunk
+                    chunk = []
+            if chunk:
+                yield key, params, chunk
+
+        pool = self.pool or Pool(processes=procs)
+        try:
+            for details, hangs, stats in pool.imap(_parse_chunk, chunks()):
+                self.details.extend(details)
+                for h, n in hangs.iteritems():
+                    self.counts["HANG"][h] += n
+                for counts, chunk_counts in zip(self._chunk_counters(), stats):
+                    for key, n in chunk_counts.iteritems():
+                        counts[key] += n
+        finally:
+            if pool is not self.pool:
+                pool.close()
+                pool.join()
+
+    def _classifier(self):
+        '''
+        Targets of the locus and the method classifying the reads against them.
+        '''
+        if self.longreads:
+            return None, self._parseReadLong
+        elif self.repeatgraph:
+            return self._buildGraph(), self._parseReadGraph
+        elif self.unitsearch in ("window", "validate"):
+            return self._buildDB(), self._parseReadWindow
+        return self._buildDB(), self._parseReadSW
+
+    def _chunkParams(self):
+        '''
+        Copy of the input parameters that the classification processes build
+        the same parser from, without the handles of the sample.
+        '''
+        params = copy.copy(self.inputParams)
+        params.session = params.locus = params.altreads = params.profile = None
+        params.pool = None
+        params.threads = params.procs = 1
+        return params
+
+    def _chunk_counters(self):
+        return self.triage_counts, self.fastpath_counts, self.unitsearch_stats
+
     def tally_counts(self):
-        for x in self.details:
-            self.counts[x["tag"]][x["h"]] += 1
+        self.details.tally(self.counts)
 
         for tag in ("FULL", "PREF", "REPT"):
             countMap = self.counts[tag]
@@ -277,14 +972,122 @@ class BamParser:
         experiments. In practice, when whole reference genome is used, this
         most likely has zero effect on the results.
         '''
-        rept_reads = [x for x in self.details if x["tag"] == "REPT"]
-        rept_counts = defaultdict(int)
-        for read in rept_reads:
-            rept_counts[read["id"]] += 1
-        remove_ids = set(rid for rid, count in rept_counts.items() if count > 1)
-        self.details = [x for x in self.details if x["id"] not in remove_ids]
+        removed = self.details.remove_pairs("REPT")
         self.logger.debug("Tagging pairs of REPT to remove: {} pairs"\
-                        .format(len(remove_ids)))
+                        .format(removed))
+
+
+class ReadDetails:
+    '''
+    Classified reads stored by columns: tag codes and repeat units in arrays,
+    read IDs interned as indices into a list of names, and the sequences
+    only if keepseqs, packed unless they have bases other than ACGTN.
+    Iterating gives the {tag, h, id, seq} dict of each read.
+    '''
+    TAGS = ("FULL", "PREF", "POST", "REPT")
+
+    def __init__(self, keepseqs=True):
+        self.keepseqs = keepseqs
+        # The reads are appended one at a time while they are classified:
+        # array.array grows in place in amortized O(1), where numpy would
+        # copy the column on every append. columns() gives numpy views of
+        # the same buffers, without a copy, for keep(), remove_pairs() and
+        # tally().
+        self.tags = array('b')
+        self.h = array('i')
+        self.ids = array('i')
+        self.names = []
+        self.name_index = {}
+        self.seqs = []
+
+    def __len__(self):
+        return len(self.tags)
+
+    def __iter__(self):
+        names, seqs = self.names, self.seqs
+        for i, (tag, h, rid) in enumerate(zip(self.tags, self.h, self.ids)):
+            x = {'tag': self.TAGS[tag], 'h': h, 'id': names[rid]}
+            if self.keepseqs:
+                x['seq'] = str(seqs[i])
+            yield x
+
+    def to_list(self):
+        return list(self)
+
+    def append(self, tag, h, rid, seq):
+        idx = self.name_index.get(rid)
+        if idx is None:
+            idx = self.name_index[rid] = len(self.names)
+            self.names.append(rid)
+        self.tags.append(self.TAGS.index(tag))
+        self.h.append(h)
+        self.ids.append(idx)
+        if self.keepseqs:
+            if isinstance(seq, str) and PackedSeq.packable(seq):
+                seq = PackedSeq(seq)
+            self.seqs.append(seq)
+
+    def extend(self, other):
+        '''
+        Append the reads of another ReadDetails, sequences are kept packed.
+        '''
+        for i, (tag, h, rid) in enumerate(zip(other.tags, other.h, other.ids)):
+            seq = other.seqs[i] if other.keepseqs else None
+            self.append(self.TAGS[tag], h, other.names[rid], seq)
+
+    def columns(self):
+        '''
+        Views of the tag codes, units and read indices as numpy arrays.
+        '''
+        return [np.frombuffer(x, dtype=x.typecode) if len(x) else \
+                    np.array([], dtype=x.typecode) \
+                    for x in (self.tags, self.h, self.ids)]
+
+    def keep(self, mask):
+        '''
+        Keep the reads where mask is True.
+        '''
+        tags, h, ids = self.columns()
+        self.tags = array('b', tags[mask].tostring())
+        self.h = array('i', h[mask].tostring())
+        self.ids = array('i', ids[mask].tostring())
+        if self.keepseqs:
+            self.seqs = [x for x, k in zip(self.seqs, mask) if k]
+
+    def remove_pairs(self, tag):
+        '''
+        Remove the reads whose ID is found more than once with the given tag,
+        and return the number of such IDs.
+        '''
+        tags, h, ids = self.columns()
+        tagged, counts = np.unique(ids[tags == self.TAGS.index(tag)],
+                                   return_counts=True)
+        remove_ids = tagged[counts > 1]
+        if len(remove_ids):
+            self.keep(~np.in1d(ids, remove_ids))
+        return len(remove_ids)
+
+    def tally(self, counts):
+        '''
+        Add the number of reads for each tag and number of repeat units to
+        counts[tag][units]. The units are added in the order of the reads, as
+        the models sum the counts in the order of the dicts.
+        '''
+        tags, h, ids = self.columns()
+        groups = []  # Tags sharing the same counts, like PREF and POST
+        for code, tag in enumerate(self.TAGS):
+            for countMap, codes in groups:
+                if countMap is counts[tag]:
+                    codes.append(code)
+                    break
+            else:
+                groups.append((counts[tag], [code]))
+
+        for countMap, codes in groups:
+            units, first, n = np.unique(h[np.in1d(tags, codes)],
+                                        return_index=True, return_counts=True)
+            for i in np.argsort(first, kind="mergesort"):
+                countMap[int(units[i])] += int(n[i])
 
 
 class BamParserResults:
@@ -295,7 +1098,9 @@ class BamParserResults:
         self.inputParams = inputParams
         self.tred = bamParser.tred
         self.counts = bamParser.counts
-        self.details = bamParser.details
+        self.details = bamParser.details.to_list()
+        self.unitsearch = dict(bamParser.unitsearch_stats)
+        self.triage = dict(bamParser.triage_counts)
         self.FDP = sum(bamParser.counts["FULL"].values())
         self.PDP = sum(bamParser.counts["PREF"].values())
         self.RDP = bamParser.rept
@@ -318,15 +1123,25 @@ class PEextractor:
     Infer distance paired-end reads spanning a certain region.
     """
     def __init__(self, bp):
-        samfile = read_alignment(bp.bam)
         chr = bp.chr
         start = bp.startRepeat
         end = bp.endRepeat
         self.ref = bp.referenceLen
+        self.MINPE = end - start + 2 * FLANKMATCH + 2
+
+        # Paired-end distances of the locus from a previous run on the BAM
+        profiled = bp.profile.locus(bp.tred) if bp.profile else {}
+        if "pairs" in profiled:
+            self.global_lens, self.target_lens = profiled["pairs"]
+            return
 
         # Compute the target distribution (defined as paired spanning the CAG repeats)
         pstart = max(start - DNAPE_ELONGATE, 0)
         pend = end + DNAPE_ELONGATE
+        if bp.locus and bp.locus.covers(chr, pstart, pend):
+            samfile = bp.locus
+        else:
+            samfile = open_alignment(bp.session or bp.bam)
         cache = {}
         if test_fetch(samfile, chr, pstart, pend, bp.logger):
             cache = defaultdict(list)
@@ -358,7 +1173,8 @@ class PEextractor:
             else:
                 self.global_lens.append(tlen)
 
-        self.MINPE = end - start + 2 * FLANKMATCH + 2
+        if bp.profile:
+            profiled["pairs"] = [self.global_lens, self.target_lens]
 
     def get_target_length(self, a, b):
         start, end = a.reference_start, b.reference_end
@@ -369,9 +1185,217 @@ class PEextractor:
         return end - start
 
 
+class LocusRecord(namedtuple("LocusRecord", "query_name query_sequence "\
+                "query_qualities flag reference_start reference_end "\
+                "query_alignment_start query_alignment_end query_length")):
+    '''
+    The attributes of pysam.AlignedSegment used for the classification, the
+    paired-end distances and the depth of a locus
+    '''
+    __slots__ = ()
+
+    is_paired = property(lambda self: bool(self.flag & 0x1))
+    is_proper_pair = property(lambda self: bool(self.flag & 0x2))
+    is_unmapped = property(lambda self: bool(self.flag & 0x4))
+    is_reverse = property(lambda self: bool(self.flag & 0x10))
+    is_secondary = property(lambda self: bool(self.flag & 0x100))
+    is_qcfail = property(lambda self: bool(self.flag & 0x200))
+    is_duplicate = property(lambda self: bool(self.flag & 0x400))
+    is_supplementary = property(lambda self: bool(self.flag & 0x800))
+
+
+class LocusReads:
+    '''
+    Reads of a locus fetched once over the window of the paired-end distances,
+    which contains the windows of the classification and of the depth, and
+    buffered as LocusRecords for all of them. Only the reads overlapping the
+    classification window, the repeat with pad on each side, keep their
+    sequences and qualities. Without paired, the paired-end distances being
+    known from the sample profile, only the classification window is fetched.
+    The BAM file is given by its path or its session.
+    '''
+    def __init__(self, bam, tred, logger, pad=SPAN, paired=True):
+        self.chr = tred.chr
+        self.seq_start = max(tred.repeat_start - pad, 0)
+        self.seq_end = tred.repeat_end + pad
+        if paired:
+            self.start = max(tred.repeat_start - DNAPE_ELONGATE, 0)
+            self.end = tred.repeat_end + DNAPE_ELONGATE
+        else:
+            self.start, self.end = self.seq_start, self.seq_end
+        self.records, self.ends = [], []
+        self.fetched = False
+
+        samfile = open_alignment(bam)
+        if not test_fetch(samfile, self.chr, self.start, self.end, logger):
+            return
+        for read in samfile.fetch(self.chr, self.start, self.end):
+            start = read.reference_start
+            end = read.reference_end or start + 1  # Unmapped reads take one base
+            seqs = start < self.seq_end and end > self.seq_start
+            self.records.append(LocusRecord(read.query_name,
+                    read.query_sequence if seqs else None,
+                    read.query_qualities if seqs else None, read.flag,
+                    start, read.reference_end, read.query_alignment_start,
+                    read.query_alignment_end, read.query_length))
+            self.ends.append(end)
+        self.starts = [x.reference_start for x in self.records]
+        self.fetched = True
+
+    def covers(self, chr, start, end, seqs=False):
+        '''
+        Are the reads overlapping chr:start-end all buffered, with their
+        sequences if seqs?
+        '''
+        if seqs:
+            return self.fetched and chr == self.chr and \
+                    self.seq_start <= start and end <= self.seq_end
+        return self.fetched and chr == self.chr and \
+                self.start <= start and end <= self.end
+
+    def fetch(self, chr, start, end):
+        '''
+        Buffered reads overlapping chr:start-end in the order of the BAM file,
+        as samfile.fetch() gives them.
+        '''
+        if not self.covers(chr, start, end):
+            raise ValueError("Region {}:{}-{} is not buffered".format(chr, start, end))
+        return self._fetch(start, end)
+
+    def _fetch(self, start, end):
+        ends = self.ends
+        for i in xrange(bisect_left(self.starts, end)):
+            if ends[i] > start:
+                yield self.records[i]
+
+    def depth(self, chr, start, end):
+        '''
+        Average depth of chr:start-end, as BamDepth.region_depth() sums the
+        pileup columns: the reads skipped by the pileup are left out, and the
+        other reads count for all the bases of their alignment span.
+        '''
+        spans = [(read.reference_start, read.reference_end) for read in \
+                    self.fetch(chr, start, end) if pileup_read(read)]
+        return pileup_depth(spans) * 1. / (end - start + 1)
+
+
+class LocusPrefetcher:
+    '''
+    LocusReads of the loci of a sample, as (tred, locus) in the order of the
+    items (tred, paired), with the exception instead of the locus when the
+    fetch fails. With prefetch, a background thread fetches and decodes the
+    reads of the next locus on its own handle of the alignment file, while
+    the current locus is called. The thread, kept as reader, is stopped and
+    joined when the iteration ends, also when it is abandoned part-way.
+    '''
+    def __init__(self, session, items, logger, prefetch=False):
+        self.session = session
+        self.items = items
+        self.logger = logger
+        self.prefetch = prefetch
+        self.reader = None
+
+    def __iter__(self):
+        if not self.prefetch:
+            for tred, paired in self.items:
+                yield tred, self.fetch(self.session, tred, paired)
+            return
+
+        queue = Queue.Queue(maxsize=1)
+        stop = threading.Event()
+        self.reader = reader = threading.Thread(target=self.read, args=(queue, stop))
+        reader.daemon = True
+        reader.start()
+        try:
+            for tred, paired in self.items:
+                yield tred, queue.get()
+        finally:
+            # Unblock the reader waiting to queue a locus, so that it closes
+            # its handle of the alignment file
+            stop.set()
+            while reader.is_alive():
+                try:
+                    queue.get(timeout=.1)
+                except Queue.Empty:
+                    pass
+            reader.join()
+
+    def fetch(self, session, tred, paired):
+        try:
+            return LocusReads(session, tred, self.logger, paired=paired)
+        except Exception as e:
+            return e
+
+    def read(self, queue, stop):
+        try:
+            session = AlignmentSession(self.session.bam, self.session.threads,
+                                       self.session.path)
+        except Exception as e:
+            for item in self.items:
+                if stop.is_set():
+                    break
+                queue.put(e)
+            return
+        try:
+            for tred, paired in self.items:
+                if stop.is_set():
+                    break
+                queue.put(self.fetch(session, tred, paired))
+        finally:
+            session.close()
+
+
+class AltReads:
+    '''
+    Mismapped reads of the alt regions of the loci of a sample. The alt
+    regions of all the loci are merged, sorted by coordinate and fetched once,
+    and the reads whose mates fall in the window of a locus, the repeat with
+    pad on each side, are indexed by locus. The reads of a locus are in the
+    order of its alt regions, as BamParser fetches them region by region.
+    '''
+    def __init__(self, bam, treds, ref, logger, pad=SPAN):
+        samfile = open_alignment(bam)
+        windows, mate_windows, regions = alt_windows(samfile, treds, ref, pad)
+
+        reads = {}  # Alt region => reads with mates in a window
+        for region in regions:
+            c, s, e = region
+            try:
+                found = []
+                for read in samfile.fetch(c, s, e):
+                    if not mate_in_windows(read, mate_windows):
+                        continue
+                    tid, pos = read.next_reference_id, read.next_reference_start
+                    found.append((tid, pos, LocusRecord(read.query_name,
+                            read.query_sequence, read.query_qualities,
+                            read.flag, read.reference_start, read.reference_end,
+                            read.query_alignment_start, read.query_alignment_end,
+                            read.query_length)))
+                reads[region] = found
+            except Exception as ex:
+                logger.debug("Fetch failed for region {}:{}-{} ({})".\
+                        format(c, s, e, ex))
+        self.reads = {}
+        for tred in treds:
+            if tred.name not in windows:
+                continue
+            tid, start, end = windows[tred.name]
+            self.reads[tred.name] = [read for x in tred.alt \
+                    for mate_tid, pos, read in reads.get(alt_region(x, ref), ()) \
+                    if mate_tid == tid and start <= pos <= end]
+        logger.debug("Alt regions: {} fetched for {} loci".format(len(regions),
+                        len(windows)))
+
+    def get(self, name):
+        '''
+        Mismapped reads of the locus, None if the locus is not indexed.
+        '''
+        return self.reads.get(name)
+
+
 class BamReadLen:
     """
-    Returns the read length in BAM file.
+    Returns the read length in BAM file, given by its path or its session.
     """
     def __init__(self, bamfile, logger):
         self.bamfile = bamfile
@@ -379,7 +1403,7 @@ class BamReadLen:
 
     @property
     def readlen(self, firstN=100):
-        sam = read_alignment(self.bamfile)
+        sam = open_alignment(self.bamfile)
         rls = []
         for read in sam.fetch():
             rls.append(read.query_length)
@@ -394,7 +1418,8 @@ class BamReadLen:
 class BamDepth:
     """
     Computes the average depth for a particular region, both for the inference
-    of the repeat size and inference of gender.
+    of the repeat size and inference of gender. The BAM file is given by its
+    path or its session.
     """
     def __init__(self, bamfile, ref, logger):
         self.bamfile = bamfile
@@ -402,38 +1427,515 @@ class BamDepth:
         self.ref = ref
 
     def region_depth(self, chr, start, end, verbose=False):
-        sam = read_alignment(self.bamfile)
-        depths = [c.n for c in sam.pileup(chr, start, end)]
-        depth = sum(depths) * 1. / (end - start + 1)
+        depth, = self.regions_depth([(chr, start, end)])
         if verbose:
             self.logger.debug("Depth of region {}:{}-{}: {}"\
                             .format(chr, start, end, depth))
         return depth
 
-    def get_Y_depth(self, N=5):
+    def regions_depth(self, regions):
+        '''
+        Average depths of the regions (chr, start, end), in one call. The sum
+        of the pileup columns of each region is computed from the spans of the
+        reads that the pileup keeps, and the overlapping regions are fetched
+        together.
+        '''
+        sam = open_alignment(self.bamfile)
+        depths = [0.] * len(regions)
+        order = sorted(xrange(len(regions)), key=lambda i: regions[i])
+        i = 0
+        while i < len(order):
+            chr, start, end = regions[order[i]]
+            j = i + 1
+            while j < len(order) and regions[order[j]][0] == chr and \
+                    regions[order[j]][1] < end:
+                end = max(end, regions[order[j]][2])
+                j += 1
+            spans = [(read.reference_start, read.reference_end) for read in \
+                        sam.fetch(chr, start, end) if pileup_read(read)]
+            for k in order[i:j]:
+                c, s, e = regions[k]
+                depth = pileup_depth([x for x in spans if x[1] > s and x[0] < e])
+                depths[k] = depth * 1. / (e - s + 1)
+            i = j
+        return depths
+
+    def get_Y_regions(self, N=5):
         UNIQY = datafile("chrY.{}.unique_ccn.gc".format(self.ref.split('_')[0]))
         fp = open(UNIQY)
-        depths = []
+        regions = []
         for i, row in enumerate(fp):
             # Some regions still have mapped reads, exclude a few
             if i in (1, 4, 6, 7, 10, 11, 13, 16, 18, 19):
                 continue
-            if len(depths) >= N:
+            if len(regions) >= N:
                 break
             c, start, end, gc = row.split()
-            start, end = int(start), int(end)
-            d = self.region_depth(c, start, end)
-            depths.append(d)
+            regions.append((c, int(start), int(end)))
+        fp.close()
+        return regions
+
+    def get_Y_depth(self, N=5, maxreads=None):
+        '''
+        Median depth of the first N unique regions of chrY. With maxreads, the
+        depth of a region is estimated from its first maxreads reads counted by
+        the pileup, over the part of the region they cover, which is exact for
+        the regions with fewer reads.
+        '''
+        regions = self.get_Y_regions(N=N)
+        if maxreads:
+            depths = [self.sampled_depth(*x, maxreads=maxreads) for x in regions]
+        else:
+            depths = self.regions_depth(regions)
         self.logger.debug("Y depths (first {} regions): {}"\
                     .format(N, np.array(depths)))
         return np.median(depths)
 
+    def sampled_depth(self, chr, start, end, maxreads=GENDER_MAXREADS):
+        '''
+        Depth of the region from its first maxreads reads counted by the
+        pileup, over the part of the region they cover.
+        '''
+        sam = open_alignment(self.bamfile)
+        bases, n = 0, 0
+        for read in sam.fetch(chr, start, end):
+            if not pileup_read(read):
+                continue
+            if n == maxreads:
+                end = max(read.reference_start, start + 1)
+                break
+            bases += read.reference_end - read.reference_start
+            n += 1
+        return bases * 1. / (end - start + 1)
+
+    def get_X_ratio(self):
+        '''
+        Ratio of the read densities of chrX and of the autosomes, from the
+        mapped read counts of the BAM index; about .5 for males and 1 for
+        females. None when the index has no counts (CRAM) or no such contigs.
+        '''
+        sam = open_alignment(self.bamfile)
+        lengths = dict(zip(sam.references, sam.lengths))
+        autosomes = set(str(x) for x in range(1, 23))
+        x_reads = x_len = auto_reads = auto_len = 0
+        for stats in sam.get_index_statistics():
+            name = stats.contig[3:] if stats.contig.startswith("chr") else stats.contig
+            if name == "X":
+                x_reads, x_len = stats.mapped, lengths[stats.contig]
+            elif name in autosomes:
+                auto_reads += stats.mapped
+                auto_len += lengths[stats.contig]
+        if not (x_reads and auto_reads):
+            return None
+        return (x_reads * 1. / x_len) / (auto_reads * 1. / auto_len)
+
+    def infer_gender(self):
+        '''
+        Gender of the sample, with the Y depth and X/autosome ratio it is
+        inferred from. The Y depth is sampled with at most GENDER_MAXREADS
+        reads per region, and the X/autosome ratio decides when the Y regions
+        cannot be read. The results are cached in GENDERS by BAM fingerprint.
+        '''
+        key = (bam_fingerprint(self.bamfile), self.ref)
+        if key in GENDERS:
+            return GENDERS[key]
+
+        try:
+            ydepth = self.get_Y_depth(maxreads=GENDER_MAXREADS)
+        except Exception as e:
+            self.logger.debug("Cannot compute the Y depth ({})".format(e))
+            ydepth = -1
+        try:
+            xratio = self.get_X_ratio()
+        except Exception as e:
+            self.logger.debug("Cannot compute the X ratio ({})".format(e))
+            xratio = None
+
+        if ydepth >= 0:
+            gender = 'Male' if ydepth > 1 else 'Female'
+        elif xratio is not None:
+            gender = 'Male' if xratio < GENDER_XRATIO else 'Female'
+        else:
+            gender = 'Unknown'
+        GENDERS[key] = gender, ydepth, xratio
+        return GENDERS[key]
+
+
+def _parse_chunk(task):
+    '''
+    Classify a chunk of reads in a process of the pool of
+    BamParser._parseReadsProcesses(), and return the tallies of the chunk.
+    The parser is rebuilt from the parameters when the key changes, that is
+    on the first chunk of each locus.
+    '''
+    global _CHUNK_PARSER
+    key, params, chunk = task
+    if _CHUNK_PARSER is None or _CHUNK_PARSER[0] != key:
+        bp = BamParser(params)
+        _CHUNK_PARSER = (key, bp) + bp._classifier()
+    key, bp, db, parseRead = _CHUNK_PARSER
+    chr = bp.chr
+    bp.details = ReadDetails(keepseqs=bp.details.keepseqs)
+    bp.counts["HANG"] = defaultdict(int)
+    for counts in bp._chunk_counters():
+        counts.clear()
+
+    bp._alignBatch(parseRead, chunk, db)
+    for read in chunk:
+        bp._parseRead(parseRead, chr, read, db)
+    bp.batched = {}
+    return bp.details, dict(bp.counts["HANG"]), \
+                [dict(x) for x in bp._chunk_counters()]
+
+
+def get_panels(prefix, repeat, suffix, max_units):
+    '''
+    Aligner panels of the locus, one per strand, where the target i has i + 1
+    repeat units. Panels are cached in PANELS, and panels with more units than
+    needed are reused as is since the targets are aligned by ranges of units.
+    '''
+    key = (prefix, repeat, suffix)
+    panels = PANELS.get(key)
+    if panels and len(panels[0]) >= max_units:
+        return panels
+
+    targets = [prefix + repeat * units + suffix \
+                    for units in xrange(1, max_units + 1)]
+    panels = []
+    for strand_targets in (targets, [rc(x) for x in targets]):
+        panel = AlignerPanel(strand_targets,
+                    match=1, mismatch=5, gap_open=7, gap_extend=2,  # Strict
+                    #match=1, mismatch=4, gap_open=6, gap_extend=1, # BWA-MEM
+                    report_secondary=False)
+        panels.append(panel)
+    PANELS[key] = panels
+    return panels
+
 
-def read_alignment(samfile):
-    ''' Dispatches BAM/CRAM based on file suffix
+def precompile_panels(repo, filename, readlen=PANEL_READLEN):
+    '''
+    Build the aligner panels of all the loci in the repo for reads up to
+    readlen, and pack them into filename to be loaded by load_panels().
+    '''
+    for tred in repo.values():
+        max_units = int(math.ceil(readlen * 1. / len(tred.repeat)))
+        get_panels(tred.prefix, tred.repeat, tred.suffix, max_units)
+
+    fw = open(filename, "wb")
+    cPickle.dump(PANELS, fw, cPickle.HIGHEST_PROTOCOL)
+    fw.close()
+
+
+def load_panels(filename):
+    '''
+    Load the aligner panels packed by precompile_panels() into the cache.
+    '''
+    fp = open(filename, "rb")
+    PANELS.update(cPickle.load(fp))
+    fp.close()
+
+
+def read_alignment(samfile, threads=1):
+    ''' Dispatches BAM/CRAM based on file suffix, the BGZF blocks or CRAM
+    containers being decompressed by threads
     '''
     tag = 'rc' if samfile.endswith(".cram") else 'rb'
-    return pysam.AlignmentFile(samfile, tag)
+    return pysam.AlignmentFile(samfile, tag, threads=threads)
+
+
+class AlignmentSession:
+    '''
+    Alignment file of a sample, opened once with its header and index, and
+    shared by all the loci and the helpers reading the sample. A remote file
+    can be read from the local copy at path. The fingerprint of the file is
+    taken when first needed and kept, as it takes a request for a remote file.
+    '''
+    def __init__(self, bam, threads=1, path=None):
+        self.bam = bam
+        self.threads = threads
+        self.path = path or bam
+        self.samfile = read_alignment(self.path, threads=threads)
+        self.fingerprint = None
+
+    def close(self):
+        self.samfile.close()
+
+
+def bam_fingerprint(bam):
+    ''' Path, size and modification time of the BAM file of the path or the
+    session. Remote files read by ranges are identified by their URL and
+    version, the other URLs, and the remote files whose version cannot be
+    requested, by themselves.
+    '''
+    if isinstance(bam, AlignmentSession):
+        if bam.fingerprint is None:
+            bam.fingerprint = bam_fingerprint(bam.bam)
+        return bam.fingerprint
+    if is_remote(bam):
+        try:
+            return (bam,) + remote_version(bam)
+        except Exception:  # No range requests, no AWS CLI, ...
+            return (bam,)
+    if not op.exists(bam):
+        return (bam,)
+    st = os.stat(bam)
+    return (op.abspath(bam), st.st_size, int(st.st_mtime))
+
+
+class SampleProfile:
+    '''
+    Facts of a sample that do not depend on the loci being called: the read
+    length, the gender and, by locus, the depth and the paired-end distances.
+    With a profile directory, the profile is kept in a JSON sidecar named
+    after the BAM fingerprint, so that the reruns on the same BAM file (other
+    loci, new sites) reuse them. Without one, the profile lasts for the run.
+    '''
+    def __init__(self, bam, profiledir=None):
+        self.fingerprint = self.filename = None
+        if profiledir:
+            self.fingerprint = list(bam_fingerprint(bam))
+            digest = hashlib.sha1(json.dumps(self.fingerprint)).hexdigest()
+            self.filename = op.join(profiledir, digest + ".profile.json")
+        self.sample, self.loci = self.load()
+        # Facts of the original BAM file in the header of a mini-BAM
+        for key, value in header_facts(bam).iteritems():
+            self.sample.setdefault(key, value)
+
+    def load(self):
+        '''
+        Sample and locus facts in the sidecar, empty if it is missing, does
+        not match the BAM file or was written by another PROFILE_VERSION.
+        '''
+        if not (self.filename and op.exists(self.filename)):
+            return {}, {}
+        try:
+            with open(self.filename) as fp:
+                data = json.load(fp)
+        except ValueError:
+            return {}, {}
+        if data.get("version") != PROFILE_VERSION or \
+           data.get("fingerprint") != self.fingerprint:
+            return {}, {}
+        return data["sample"], data["loci"]
+
+    def get(self, key, compute):
+        '''
+        Profiled value of key, computed and added to the profile if missing
+        '''
+        if key not in self.sample:
+            self.sample[key] = compute()
+        return self.sample[key]
+
+    def locus(self, tred):
+        '''
+        Profiled facts of the locus, added to as they are computed
+        '''
+        key = "{}:{}:{}-{}".format(tred.name, tred.chr, tred.repeat_start,
+                                   tred.repeat_end)
+        return self.loci.setdefault(key, {})
+
+    def save(self):
+        '''
+        Write the sidecar, merged with the facts written meanwhile by other
+        runs on the same BAM file
+        '''
+        if not self.filename:
+            return
+        sample, loci = self.load()
+        sample.update(self.sample)
+        for key, facts in self.loci.iteritems():
+            loci.setdefault(key, {}).update(facts)
+        data = {"version": PROFILE_VERSION, "fingerprint": self.fingerprint,
+                "sample": sample, "loci": loci}
+        tmpfile = "{}.{}".format(self.filename, os.getpid())
+        with open(tmpfile, "w") as fw:
+            json.dump(data, fw, separators=(',', ':'))
+        os.rename(tmpfile, self.filename)
+
+
+def open_alignment(bam):
+    ''' Alignment file of the session, or opened from the path
+    '''
+    if isinstance(bam, AlignmentSession):
+        return bam.samfile
+    return read_alignment(bam)
+
+
+def genomic_order(bam, treds):
+    ''' Loci sorted by their position in the alignment file, the loci on the
+    contigs missing from its header last
+    '''
+    samfile = open_alignment(bam)
+
+    def position(tred):
+        tid = samfile.get_tid(tred.chr)
+        return tid < 0, tid, tred.repeat_start
+
+    return sorted(treds, key=position)
+
+
+def alt_region(region, ref):
+    ''' Alt region of the catalog on the contigs of the reference
+    '''
+    c, s, e = region
+    if "nochr" in ref:
+        c = c[3:]
+    return c, s, e
+
+
+def alt_windows(samfile, treds, ref, pad=SPAN):
+    ''' Windows of the loci that have alt regions, the repeat with pad on each
+    side, by locus and as the mate windows by reference id, with the alt
+    regions of these loci sorted by coordinate
+    '''
+    tids = dict((name, i) for i, name in enumerate(samfile.references))
+    windows = {}  # Locus => mate reference id, window start and end
+    for tred in treds:
+        if tred.alt and tred.chr in tids:
+            windows[tred.name] = (tids[tred.chr],
+                    max(0, tred.repeat_start - pad), tred.repeat_end + pad)
+    mate_windows = defaultdict(list)
+    for tid, start, end in windows.values():
+        mate_windows[tid].append((start, end))
+
+    regions = set()
+    for tred in treds:
+        if tred.name in windows:
+            regions.update(alt_region(x, ref) for x in tred.alt)
+    regions = sorted(regions, key=lambda x: (tids.get(x[0], len(tids)),) + x[1:])
+    return windows, mate_windows, regions
+
+
+def mate_in_windows(read, mate_windows):
+    ''' Is the mate of the read in one of the mate windows?
+    '''
+    pos = read.next_reference_start
+    return any(start <= pos <= end for start, end in \
+                    mate_windows.get(read.next_reference_id, ()))
+
+
+def locus_regions(treds, ref, logger):
+    ''' Regions of the alignment file read for the loci: the paired-end windows,
+    which contain the other windows of the loci, the alt regions, and the
+    unique regions of chrY for the gender
+    '''
+    regions = [(x.chr, max(x.repeat_start - DNAPE_ELONGATE, 0),
+                x.repeat_end + DNAPE_ELONGATE) for x in treds]
+    regions += [alt_region(a, ref) for x in treds for a in x.alt]
+    regions += BamDepth(None, ref, logger).get_Y_regions()
+    return regions
+
+
+def header_facts(bam):
+    ''' Sample facts written by write_evidence() in the header of a mini-BAM,
+    empty for the other alignment files
+    '''
+    header = open_alignment(bam).header.to_dict()
+    for comment in header.get("CO", []):
+        if comment.startswith(PROFILE_HEADER):
+            return json.loads(comment[len(PROFILE_HEADER):])
+    return {}
+
+
+def write_evidence(bam, treds, ref, outfile, logger, facts=None):
+    '''
+    Write the reads of the alignment file that the loci need into the indexed
+    mini-BAM outfile, on which the loci are called as on the whole file: the
+    paired-end windows of the loci, which contain the windows of the
+    classification and of the depth and the unmapped mates placed there, the
+    reads of the alt regions with mates in a locus window, and the unique
+    regions of chrY for the gender. The header keeps all the contigs, and
+    the sample facts that the mini-BAM cannot give, like the read length
+    and the X/autosome ratio of the index, are added to it for SampleProfile.
+    '''
+    facts = facts or {}
+    samfile = open_alignment(bam)
+    header = samfile.header.to_dict()
+    header.setdefault("CO", []).append(PROFILE_HEADER + json.dumps(facts))
+
+    regions = [(x.chr, max(x.repeat_start - DNAPE_ELONGATE, 0),
+                x.repeat_end + DNAPE_ELONGATE) for x in treds]
+    regions += BamDepth(bam, ref, logger).get_Y_regions()
+    windows = defaultdict(list)  # Reference id => sorted disjoint windows
+    for c, s, e in sorted(regions):
+        tid = samfile.get_tid(c)
+        if tid < 0:
+            continue
+        if windows[tid] and s <= windows[tid][-1][1]:
+            windows[tid][-1][1] = max(e, windows[tid][-1][1])
+        else:
+            windows[tid].append([s, e])
+
+    # Reads of the alt regions outside of the windows, by reference id
+    _, mate_windows, alt_regions = alt_windows(samfile, treds, ref)
+    alt_reads, seen = defaultdict(list), set()
+    for c, s, e in alt_regions:
+        tid = samfile.get_tid(c)
+        if tid < 0:
+            continue
+        starts = [x[0] for x in windows[tid]]
+        for read in samfile.fetch(c, s, e):
+            if not mate_in_windows(read, mate_windows):
+                continue
+            key = (read.query_name, read.flag, read.reference_start)
+            if key in seen:  # Also in an overlapping alt region
+                continue
+            i = bisect_left(starts, read.reference_end or read.reference_start + 1)
+            if i and windows[tid][i - 1][1] > read.reference_start:
+                continue
+            seen.add(key)
+            alt_reads[tid].append(read)
+
+    # Reads in the order of the alignment file, the alt reads merged in
+    out = pysam.AlignmentFile(outfile, "wb", header=header)
+    nreads = 0
+    for tid in sorted(set(windows) | set(alt_reads)):
+        c = samfile.get_reference_name(tid)
+        alts = sorted(alt_reads[tid], key=lambda x: x.reference_start)
+        j, last_end = 0, -1
+        for s, e in windows[tid]:
+            for read in samfile.fetch(c, s, e):
+                if read.reference_start < last_end:  # Written with the last window
+                    continue
+                while j < len(alts) and alts[j].reference_start < read.reference_start:
+                    out.write(alts[j])
+                    j += 1
+                out.write(read)
+                nreads += 1
+            last_end = e
+        for read in alts[j:]:
+            out.write(read)
+        nreads += len(alts)
+    out.close()
+    pysam.index(outfile)
+    logger.debug("Mini-BAM `{}`: {} reads in {} windows and {} alt regions"\
+                    .format(outfile, nreads, sum(len(x) for x in windows.values()),
+                            len(alt_regions)))
+
+
+def pileup_read(read):
+    '''
+    Is the read counted by the pileup? Unmapped, secondary, QC fail, duplicate
+    and orphan reads (paired reads not in a proper pair) are skipped.
+    '''
+    return not (read.flag & PILEUP_SKIP or (read.flag & 0x3) == 0x1) and \
+            read.reference_end is not None
+
+
+def pileup_depth(spans):
+    '''
+    Sum of the pileup columns of the reads with these reference spans (start,
+    end), from the difference array of their coverage. The columns deeper
+    than PILEUP_MAXDEPTH are capped, as the pileup stops adding reads there.
+    '''
+    if not spans:
+        return 0
+    starts, ends = np.array(spans, dtype=np.int64).T
+    lo = starts.min()
+    size = ends.max() - lo + 1
+    coverage = np.cumsum(np.bincount(starts - lo, minlength=size) -
+                         np.bincount(ends - lo, minlength=size))
+    return int(np.minimum(coverage, PILEUP_MAXDEPTH).sum())
 
 
 def test_fetch(samfile, chr, start, end, logger):
@@ -445,6 +1947,28 @@ def test_fetch(samfile, chr, start, end, logger):
         return False
 
 
+def batches(items, size):
+    '''
+    Group the items into lists of size items, the last one may be shorter.
+    '''
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 def rc(s):
     cs = s.translate(_complement)
     return cs[::-1]
+
+
+def partial_match(a, b):
+    '''
+    Does the sequence a match the pattern b, where N matches any base?
+    '''
+    return len(a) == len(b) and all(x == y or y == 'N' for x, y in zip(a, b))
+
@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Copyright (c) 2015-2017 Human Longevity Inc.
+
+Author: Haibao Tang <htang@humanlongevity.com>
+License: Non-Commercial Use Only. For details, see `LICENSE` file
+
+Remote BAM files read by byte ranges. The BGZF blocks that the loci of a sample
+need are located with the BAM index, fetched concurrently with the adjacent
+ranges coalesced into one request, and kept in a bounded on-disk block cache
+shared by the runs. They are then written into a sparse local copy of the file
+that pysam reads instead of the URL.
+"""
+
+import hashlib
+import os
+import os.path as op
+import struct
+import threading
+import zlib
+
+import requests
+
+from multiprocessing.pool import ThreadPool
+from utils import popen
+
+
+REMOTE_SCHEMES = ("http://", "https://", "s3://")  # Inputs read by byte ranges
+BLOCK_SIZE = 1 << 18  # Bytes of the cache blocks, the unit of the range requests
+REQUEST_BLOCKS = 64  # Most blocks coalesced into one range request
+COALESCE_GAP = 1  # Cached blocks fetched again to join two runs of missing blocks
+FETCH_THREADS = 8  # Concurrent range requests
+BGZF_MAXBLOCK = 1 << 16  # Largest compressed BGZF block
+BGZF_EOF = 28  # Empty BGZF block that ends the file
+HEAD_BLOCKS = 2  # BGZF blocks after the header, for the first reads of the file
+BAI_SHIFT = 14  # Windows of the linear index, 16kb
+BAI_BINS = ((26, 1), (23, 9), (20, 73), (17, 585), (14, 4681))  # Shift and first bin by level
+
+
+class BlockCache:
+    '''
+    Bounded on-disk cache of the blocks of the remote files, one file per block
+    named after the file key and the block index. The least recently used
+    blocks are evicted when the cache grows beyond maxsize bytes.
+    '''
+    def __init__(self, cachedir, maxsize):
+        self.cachedir = cachedir
+        self.maxsize = maxsize
+        try:
+            os.makedirs(cachedir)
+        except OSError:  # Exists, or created by another process
+            pass
+
+    def path(self, key, i):
+        return op.join(self.cachedir, "{}.{}".format(key, i))
+
+    def get(self, key, i):
+        path = self.path(key, i)
+        try:
+            with open(path, "rb") as fp:
+                data = fp.read()
+            os.utime(path, None)  # Recently used
+        except (IOError, OSError):
+            return None
+        return data
+
+    def put(self, key, i, data):
+        path = self.path(key, i)
+        tmpfile = "{}.{}.{}".format(path, os.getpid(), threading.current_thread().ident)
+        with open(tmpfile, "wb") as fw:
+            fw.write(data)
+        os.rename(tmpfile, path)
+
+    def evict(self):
+        '''
+        Remove the least recently used blocks beyond maxsize
+        '''
+        blocks = []
+        for name in os.listdir(self.cachedir):
+            if name.count(".") != 1:  # Block being written
+                continue
+            path = op.join(self.cachedir, name)
+            try:
+                st = os.stat(path)
+            except OSError:  # Evicted by another process
+                continue
+            blocks.append((st.st_mtime, st.st_size, path))
+        total = sum(x[1] for x in blocks)
+        for mtime, size, path in sorted(blocks):
+            if total <= self.maxsize:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+class RemoteFile:
+    '''
+    Remote file read by blocks of BLOCK_SIZE through the block cache. The
+    missing blocks are fetched by concurrent range requests, each covering a
+    run of consecutive blocks. The s3 objects are read through URLs presigned
+    with the AWS CLI.
+    '''
+    def __init__(self, url, cache, threads=FETCH_THREADS):
+        self.url = url
+        self.cache = cache
+        self.threads = threads
+        self.local = threading.local()
+        self.http = url
+        if url.startswith("s3://"):
+            self.http = popen("aws s3 presign {}".format(url), debug=False)\
+                            .read().strip()
+        self.size, self.version = self.stat()
+        # Blocks are cached by URL and version, the presigned URLs change
+        self.key = hashlib.sha1("{} {}".format(url, self.version)).hexdigest()
+
+    def request(self, start, end):
+        '''
+        Bytes start to end (included) of the file, by a range request
+        '''
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        r = session.get(self.http, headers={"Range": "bytes={}-{}".format(start, end)})
+        r.raise_for_status()
+        if r.status_code != 206:
+            raise IOError("No range requests on `{}`".format(self.url))
+        return r
+
+    def stat(self):
+        '''
+        Size of the file, and its version: the size, the ETag and the
+        Last-Modified date, the last two None when the server has none
+        '''
+        r = self.request(0, 0)
+        size = int(r.headers["Content-Range"].rsplit("/", 1)[1])
+        return size, (size, r.headers.get("ETag"), r.headers.get("Last-Modified"))
+
+    def fetch(self, run):
+        start, end = run
+        data = self.request(start * BLOCK_SIZE,
+                            min(end * BLOCK_SIZE, self.size) - 1).content
+        if len(data) != min(end * BLOCK_SIZE, self.size) - start * BLOCK_SIZE:
+            raise IOError("Short read on `{}`".format(self.url))
+        return data
+
+    def read_blocks(self, blocks):
+        '''
+        Contents of the blocks by index, from the cache or fetched
+        '''
+        data, missing = {}, []
+        for i in sorted(set(blocks)):
+            block = self.cache.get(self.key, i)
+            if block is None:
+                missing.append(i)
+            else:
+                data[i] = block
+        if not missing:
+            return data
+
+        runs = coalesce(missing)
+        pool = ThreadPool(min(self.threads, len(runs)))
+        try:
+            contents = pool.map(self.fetch, runs)
+        finally:
+            pool.close()
+        for (start, end), content in zip(runs, contents):
+            for i in xrange(start, end):
+                block = content[(i - start) * BLOCK_SIZE: (i - start + 1) * BLOCK_SIZE]
+                self.cache.put(self.key, i, block)
+                data[i] = block
+        self.cache.evict()
+        return data
+
+    def read(self, start, end):
+        '''
+        Bytes start to end (excluded) of the file
+        '''
+        end = min(end, self.size)
+        first, last = start / BLOCK_SIZE, (end - 1) / BLOCK_SIZE
+        data = self.read_blocks(xrange(first, last + 1))
+        content = "".join(data[i] for i in xrange(first, last + 1))
+        return content[start - first * BLOCK_SIZE: end - first * BLOCK_SIZE]
+
+
+class RemoteBam:
+    '''
+    Local copy of a remote BAM file with the bytes that a list of regions needs:
+    the header, the first reads of the file, the BGZF blocks of the chunks of
+    the regions in the BAM index, and the EOF block. The copy is a sparse file
+    of the size of the remote file, so that the virtual offsets of the index,
+    written next to it, stay valid.
+    '''
+    def __init__(self, url, cache, logger, threads=FETCH_THREADS):
+        self.logger = logger
+        self.bam = RemoteFile(url, cache, threads)
+        try:
+            self.bai = RemoteFile(url + ".bai", cache, threads)
+        except (IOError, requests.RequestException):
+            self.bai = RemoteFile(url.rsplit(".", 1)[0] + ".bai", cache, threads)
+        self.index = self.bai.read(0, self.bai.size)
+        self.refs = read_bai(self.index)
+        self.references, self.header_end = self.read_header()
+
+    def read_header(self):
+        '''
+        Reference names of the header, and the end of its last BGZF block
+        '''
+        offset, text = 0, ""
+        while True:
+            block = self.bam.read(offset, offset + BGZF_MAXBLOCK)
+            bsize = struct.unpack("<H", block[16:18])[0] + 1
+            text += zlib.decompress(block[18: bsize - 8], -15)
+            offset += bsize
+            references = read_references(text)
+            if references is not None:
+                return references, offset
+            if offset >= self.bam.size:
+                raise IOError("Truncated header in `{}`".format(self.bam.url))
+
+    def region_ranges(self, tid, start, end):
+        '''
+        Byte ranges of the BGZF blocks that htslib reads for the region
+        '''
+        bins, offsets = self.refs[tid]
+        min_off = min_offset(bins, offsets, start)
+        ranges = []
+        for bin in reg2bins(start, end):
+            for vstart, vend in bins.get(bin, ()):
+                if vend > min_off:
+                    ranges.append((vstart >> 16, (vend >> 16) + BGZF_MAXBLOCK))
+        return ranges
+
+    def localize(self, regions, filename):
+        '''
+        Write the local copy with the regions (chr, start, end) into filename
+        and its index into filename.bai
+        '''
+        size = self.bam.size
+        ranges = [(0, self.header_end + HEAD_BLOCKS * BGZF_MAXBLOCK),
+                  (size - BGZF_EOF, size)]
+        tids = dict((name, i) for i, name in enumerate(self.references))
+        for c, s, e in regions:
+            if c in tids and tids[c] < len(self.refs):
+                ranges += self.region_ranges(tids[c], s, e)
+        blocks = set()
+        for start, end in ranges:
+            blocks.update(xrange(start / BLOCK_SIZE, (min(end, size) - 1) / BLOCK_SIZE + 1))
+
+        data = self.bam.read_blocks(blocks)
+        with open(filename, "wb") as fw:
+            fw.truncate(size)
+            for i in sorted(data):
+                fw.seek(i * BLOCK_SIZE)
+                fw.write(data[i])
+        with open(filename + ".bai", "wb") as fw:
+            fw.write(self.index)
+        self.logger.debug("Local copy of `{}`: {} blocks of {} for {} regions"\
+                        .format(self.bam.url, len(blocks),
+                                (size - 1) / BLOCK_SIZE + 1, len(regions)))
+        return filename
+
+
+def is_remote(bam):
+    return bam.startswith(REMOTE_SCHEMES)
+
+
+def remote_version(url):
+    ''' Version of the remote file (size, ETag, Last-Modified), which changes
+    when the object behind the URL is replaced
+    '''
+    return RemoteFile(url, None).version
+
+
+def coalesce(blocks):
+    ''' Runs [start, end) of the sorted block indices, joined across gaps of at
+    most COALESCE_GAP blocks and split at REQUEST_BLOCKS blocks
+    '''
+    runs = []
+    for i in blocks:
+        if runs and i - runs[-1][1] <= COALESCE_GAP and \
+                i - runs[-1][0] < REQUEST_BLOCKS:
+            runs[-1][1] = i + 1
+        else:
+            runs.append([i, i + 1])
+    return [tuple(x) for x in runs]
+
+
+def read_references(text):
+    ''' Reference names of the uncompressed BAM header, None if incomplete
+    '''
+    if len(text) < 8:
+        return None
+    if text[:4] != "BAM\1":
+        raise IOError("Not a BAM file")
+    pos = 8 + struct.unpack("<i", text[4:8])[0]
+    if len(text) < pos + 4:
+        return None
+    n_ref, = struct.unpack("<i", text[pos: pos + 4])
+    pos += 4
+    references = []
+    for i in xrange(n_ref):
+        if len(text) < pos + 4:
+            return None
+        l_name, = struct.unpack("<i", text[pos: pos + 4])
+        if len(text) < pos + 8 + l_name:
+            return None
+        references.append(text[pos + 4: pos + 3 + l_name])
+        pos += 8 + l_name
+    return references
+
+
+def read_bai(data):
+    ''' Bins (bin => chunks of virtual offsets) and linear index of each
+    reference of a BAI index
+    '''
+    if data[:4] != "BAI\1":
+        raise IOError("Not a BAI index")
+    pos = 8
+    refs = []
+    for i in xrange(struct.unpack("<i", data[4:8])[0]):
+        n_bin, = struct.unpack("<i", data[pos: pos + 4])
+        pos += 4
+        bins = {}
+        for j in xrange(n_bin):
+            bin, n_chunk = struct.unpack("<Ii", data[pos: pos + 8])
+            pos += 8
+            chunks = struct.unpack("<{}Q".format(2 * n_chunk),
+                                   data[pos: pos + 16 * n_chunk])
+            pos += 16 * n_chunk
+            bins[bin] = zip(chunks[::2], chunks[1::2])
+        n_intv, = struct.unpack("<i", data[pos: pos + 4])
+        pos += 4
+        offsets = struct.unpack("<{}Q".format(n_intv), data[pos: pos + 8 * n_intv])
+        pos += 8 * n_intv
+        refs.append((bins, offsets))
+    return refs
+
+
+def reg2bins(start, end):
+    ''' Bins overlapping the region start to end (excluded), as in the SAM spec
+    '''
+    end -= 1
+    bins = [0]
+    for shift, first in BAI_BINS:
+        bins.extend(xrange(first + (start >> shift), first + (end >> shift) + 1))
+    return bins
+
+
+def min_offset(bins, offsets, start):
+    ''' Lowest virtual offset of the chunks read for a region from start: the
+    linear index at the window of start, or at the last window with a bin
+    (htslib 1.10+), whichever is lower
+    '''
+    if not offsets:
+        return 0
+    w = min(start >> BAI_SHIFT, len(offsets) - 1)
+    for i in xrange(w, -1, -1):
+        if BAI_BINS[-1][1] + i in bins:
+            return min(offsets[w], offsets[i])
+    return 0
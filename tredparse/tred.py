@@ -25,16 +25,28 @@ import logging
 from . import __version__
 from .utils import DefaultHelpParser, InputParams, \
         mkdir, ls_s3, push_to_s3
-from .bam_parser import BamDepth, BamReadLen, BamParser, \
-        BamParserResults, SPAN, read_alignment
+from .bam_parser import AltReads, BamDepth, BamReadLen, BamParser, \
+        BamParserResults, LocusPrefetcher, SPAN, READCACHE, TRIAGE, \
+        AlignmentSession, SampleProfile, genomic_order, load_panels, \
+        locus_regions, precompile_panels, write_evidence
 from .models import IntegratedCaller
+from .remote import BlockCache, RemoteBam, is_remote
 from .meta import TREDsRepo
+from collections import namedtuple
 from datetime import datetime as dt, timedelta
-from multiprocessing import Pool, cpu_count
+from multiprocessing import Pool, cpu_count, current_process
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 
+# The job of one sample, with the options of the run, as run() and extract()
+# take it in the worker processes
+SampleTask = namedtuple("SampleTask", "samplekey bam repo tredNames "\
+                        "maxinsert fullsearch clip alts repeatpairs repeatgraph "\
+                        "unitsearch strandvote readcache sharereadcache triage "\
+                        "fastpath threads locuscpus detailseqs batchalign "\
+                        "longreads profiles prefetch iothreads blockcache log")
+
 
 INFO = """##INFO=<ID=RPA,Number=1,Type=String,Description="Repeats per allele">
 ##INFO=<ID=END,Number=1,Type=Integer,Description="End position of variant">
@@ -79,6 +91,9 @@ def set_argparse():
                              'faster but less accurate')
     p.add_argument('--norepeatpairs', default=False, action="store_true",
                         help='Exclude pairs of repeat-only reads from evidence')
+    p.add_argument('--longreads', default=False, action="store_true",
+                        help='Long reads (PacBio, ONT) that span the repeats, '\
+                             'measure the repeat tract between the flanks')
     p.add_argument('--log', choices=("INFO", "DEBUG"), default="INFO",
                         help='Print debug logs, DEBUG=verbose')
     p.add_argument('--version', action='version', version="%(prog)s " + __version__)
@@ -90,6 +105,48 @@ def set_argparse():
                         help="Maximum number of repeats")
     g.add_argument('--fullsearch', default=False, action="store_true",
                         help="Full grid search, could be slow")
+    g.add_argument('--repeatgraph', default=False, action="store_true",
+                        help="Align reads to the repeat graph of each locus in "\
+                             "one pass, instead of one reference per repeat size")
+    g.add_argument('--unitsearch', default="exhaustive",
+                        choices=("exhaustive", "window", "validate"),
+                        help="Align reads to all the repeat sizes, or only to "\
+                             "those around the estimate from the motif density. "\
+                             "`validate` runs both and reports disagreements")
+    g.add_argument('--strandvote', default=False, action="store_true",
+                        help="Align each read to one strand of the locus, "\
+                             "chosen by its k-mers, unless the vote is ambiguous")
+    g.add_argument('--panels',
+                        help="Aligner panels of all the loci, loaded at startup "\
+                             "and precompiled into this file if it does not exist")
+    g.add_argument('--readcache', default=0, type=int,
+                        help="Number of read classifications to cache by read "\
+                             "sequence, 0 to disable")
+    g.add_argument('--sharereadcache', default=False, action="store_true",
+                        help="Share the read cache across the samples "\
+                             "processed by the same worker")
+    g.add_argument('--triage',
+                        help="Skip reads before the alignment for these comma "\
+                             "separated reasons: {} or all".format(", ".join(TRIAGE)))
+    g.add_argument('--fastpath', default=False, action="store_true",
+                        help="Count the repeat units of clean reads between "\
+                             "their flanks, and align only the other reads")
+    g.add_argument('--threads', default=1, type=int,
+                        help="Number of threads classifying the reads of each "\
+                             "locus, on top of the --cpus processes")
+    g.add_argument('--locuscpus', default=1, type=int,
+                        help="Number of processes classifying the reads of each "\
+                             "locus, for ultra-deep BAMs. Only used with --cpus 1")
+    g.add_argument('--nobatchalign', default=False, action="store_true",
+                        help="Align the reads one at a time, instead of in "\
+                             "batches with one read per SIMD lane")
+    g.add_argument('--prefetch', default=False, action="store_true",
+                        help="Fetch the reads of the next locus in a background "\
+                             "thread while the current one is called. Not "\
+                             "used with --locuscpus")
+    g.add_argument('--iothreads', default=1, type=int,
+                        help="Number of threads decompressing the BAM/CRAM "\
+                             "blocks of each sample")
 
     g = p.add_argument_group("I/O options")
     g.add_argument("--workdir", default=os.getcwd(), help="Specify work dir")
@@ -99,6 +156,25 @@ def set_argparse():
                                 help="Do not run if JSON output exists")
     g.add_argument('--no-output', default=False, action="store_true",
                                 help="Do not write JSON and VCF output")
+    g.add_argument('--nodetailseqs', default=False, action="store_true",
+                                help="Do not write the read sequences in the "\
+                                     "JSON details")
+    g.add_argument('--minibam', default=False, action="store_true",
+                                help="Write the reads that the loci need into "\
+                                     "an indexed mini-BAM `samplekey.bam` in "\
+                                     "the workdir, to be called instead of "\
+                                     "the input, and skip the calls")
+    g.add_argument('--blockcache',
+                                help="Read the remote BAM files (http, s3) by "\
+                                     "byte ranges for all the loci at once, "\
+                                     "through this block cache directory")
+    g.add_argument('--blockcachesize', default=4096, type=int,
+                                help="Size of the block cache in MB")
+    g.add_argument('--profiles',
+                                help="Directory of the sample profiles (read "\
+                                     "length, gender, depth and paired-end "\
+                                     "distances), reused by the reruns on "\
+                                     "the same BAM files")
     set_aws_opts(p)
     return p
 
@@ -123,7 +199,24 @@ def bam_path(bam):
         return op.abspath(bam)
 
 
-def check_bam(bam):
+def fetch_remote(bam, samplekey, repo, tredNames, blockcache):
+    '''
+    Fetch the parts of a remote bam that the treds need through the block
+    cache (cachedir, maxsize), into a local copy in the current folder
+    :return: path to the local copy, None to read the bam directly
+    '''
+    try:
+        cache = BlockCache(*blockcache)
+        regions = locus_regions([repo[x] for x in tredNames], repo.ref, logger)
+        return RemoteBam(bam, cache, logger).localize(regions,
+                        op.abspath(samplekey + ".remote.bam"))
+    except Exception as e:
+        logger.error("Cannot fetch `{}` by ranges ({}), read it directly"\
+                        .format(bam, e))
+        return None
+
+
+def check_bam(bam, threads=1, path=None):
     # Check indices - remove if found, otherwise distinct bams may try to use
     # the previous index, leading to an error
     bbam = op.basename(bam)
@@ -135,15 +228,15 @@ def check_bam(bam):
             logger.debug("Remove index `{}`".format(bai))
             os.remove(bai)
 
-    # Does the file exist?
+    # Does the file exist? It is then opened once for all the loci
     logger.debug("Working on `{}`".format(bam))
     try:
-        read_alignment(bam)
+        session = AlignmentSession(bam, threads=threads, path=path)
     except (IOError, ValueError) as e:
         logger.error("Cannot retrieve file `{}` ({})".format(bam, e))
         return None
 
-    return bam
+    return session
 
 
 def counter_s(c):
@@ -177,115 +270,211 @@ def cleanup(cwd, samplekey):
     shutil.rmtree(samplekey)
 
 
-def run(arg):
+def run(task):
     '''
     Run Tred Caller on a list of treds
-    :param bam: path to bam file
-    :param: referenceVersion, hg19 or hg38
+    :param task: SampleTask, with the bam file and the treds of the sample
     :return: dict of calls
     '''
-    samplekey, bam, repo, tredNames, maxinsert, fullsearch, clip, alts, \
-                repeatpairs, log = arg
+    samplekey, bam, repo, tredNames = task.samplekey, task.bam, task.repo, \
+                task.tredNames
     cwd = os.getcwd()
+    READCACHE.resize(task.readcache)
+    if not task.sharereadcache:
+        READCACHE.clear()
     mkdir(samplekey)
     os.chdir(samplekey)
     gender = 'Unknown'
     ydepth = -1
+    xratio = None
 
     tredCalls = {"inferredGender": gender, "depthY": ydepth}
-    if check_bam(bam) is None:
+    localcopy = None
+    if task.blockcache and is_remote(bam):
+        localcopy = fetch_remote(bam, samplekey, repo, tredNames, task.blockcache)
+    session = check_bam(bam, task.iothreads, path=localcopy)
+    if session is None:
         cleanup(cwd, samplekey)
         return {'samplekey': samplekey, 'bam': bam, 'tredCalls': tredCalls}
 
-    # Infer gender based on depth on chrY
+    # Sample facts from the previous runs on the same BAM file
+    profile = SampleProfile(session, task.profiles)
+
+    # Infer gender based on depth on chrY, or on the X/autosome ratio
     if any(repo[tred].is_xlinked for tred in tredNames):
         try:
-            bd = BamDepth(bam, repo.ref, logger)
-            ydepth = bd.get_Y_depth()
-            if ydepth > 1:
-                gender = 'Male'
-            else:
-                gender = 'Female'
+            bd = BamDepth(session, repo.ref, logger)
+            gender, ydepth, xratio = profile.get("gender." + repo.ref,
+                                                 bd.infer_gender)
         except:
             pass
-        logger.debug("Inferred gender: {} (depthY={})".format(gender, ydepth))
+        logger.debug("Inferred gender: {} (depthY={}, ratioX={})"\
+                        .format(gender, ydepth, xratio))
         tredCalls["inferredGender"] = gender
         tredCalls["depthY"] = ydepth
+        tredCalls["ratioX"] = xratio
 
     # Get read length
     READLEN = 150
     try:
-        brl = BamReadLen(bam, logger)
-        READLEN = brl.readlen
+        brl = BamReadLen(session, logger)
+        READLEN = profile.get("readLen", lambda: brl.readlen)
     except:
         pass
     logger.debug("Read length: {}bp".format(READLEN))
     tredCalls["readLen"] = READLEN
 
-    for tred in tredNames:
-        # Infer local read depth
-        bd = BamDepth(bam, repo.ref, logger)
-        xtred = repo[tred]
-        WINDOW_START = max(0, xtred.repeat_start - SPAN)
-        WINDOW_END = xtred.repeat_end + SPAN
-        try:
-            depth = bd.region_depth(xtred.chr, WINDOW_START, WINDOW_END)
-        except Exception as e:
-            depth = 30
-            logger.error("Exception on `{}` {} ({}). Set depth={}"\
-                        .format(bam, tred, e, depth))
-
-        logger.debug("Inferred depth at locus {}: {}".format(tred, depth))
-        ip = InputParams(bam=bam, READLEN=READLEN, tredName=tred,
-                         repo=repo, maxinsert=maxinsert, fullsearch=fullsearch,
-                         gender=gender, depth=depth, clip=clip, alts=alts,
-                         repeatpairs=repeatpairs, log=log)
-
-        #tpResult = runBam(ip)
-        try:
-            tpResult = runBam(ip)
-        except Exception as e:
-            logger.error("Exception on `{}` {} ({})".format(bam, tred, e))
-            continue
-
-        alleles = tpResult.alleles
-        tredCalls[tred + ".1"] = alleles[0] # .1 is the shorter allele
-        tredCalls[tred + ".2"] = alleles[1] # .2 is the longer allele
-        tredCalls[tred + ".FR"] = counter_s(tpResult.counts["FULL"])
-        tredCalls[tred + ".PR"] = counter_s(tpResult.counts["PREF"])
-        tredCalls[tred + ".RR"] = counter_s(tpResult.counts["REPT"])
-        tredCalls[tred + ".DP"] = depth             # Average read depth
-        tredCalls[tred + ".FDP"] = tpResult.FDP     # Full spanning depth
-        tredCalls[tred + ".PDP"] = tpResult.PDP     # Partial depth
-        tredCalls[tred + ".RDP"] = tpResult.RDP     # Repeat read depth
-        tredCalls[tred + ".PEDP"] = tpResult.PEDP   # PE depth
-        tredCalls[tred + ".PEG"] = tpResult.PEG     # PE global estimate
-        tredCalls[tred + ".PET"] = tpResult.PET     # PE target estimate
-        tredCalls[tred + ".CI"] = tpResult.CI       # Confidence interval
-        tredCalls[tred + ".PP"] = tpResult.PP       # Prob(disease)
-        tredCalls[tred + ".label"] = tpResult.label # Disease status
-
-        # Following output are relatively big array of numbers that mostly
-        # specify probability distribution, only available in JSON output
-        tredCalls[tred + ".details"] = tpResult.details
-        tredCalls[tred + ".P_h1"] = tpResult.P_h1
-        tredCalls[tred + ".P_h2"] = tpResult.P_h2
-        tredCalls[tred + ".P_h1h2"] = tpResult.P_h1h2
-        tredCalls[tred + ".P_PEG"] = tpResult.P_PEG
-        tredCalls[tred + ".P_PET"] = tpResult.P_PET
+    # Fetch the alt regions of all the loci at once for the mismapped reads
+    altreads = None
+    if task.alts and not task.clip:
+        altreads = AltReads(session, [repo[x] for x in tredNames], repo.ref,
+                            logger)
+
+    # Visit the loci in genomic order, fetching the reads of each locus once;
+    # the paired-end window is not needed once its distances are known
+    xtreds = genomic_order(session, [repo[x] for x in tredNames])
+    items = [(x, "pairs" not in profile.locus(x)) for x in xtreds]
+    loci = LocusPrefetcher(session, items, logger,
+                           prefetch=task.prefetch and task.locuscpus == 1)
+
+    # The processes classifying the reads are started once for all the loci
+    pool = None
+    if task.locuscpus > 1 and not current_process().daemon:
+        pool = Pool(processes=task.locuscpus)
+    try:
+        for xtred, locus in loci:
+            # Infer local read depth from the reads of the locus
+            tred = xtred.name
+            WINDOW_START = max(0, xtred.repeat_start - SPAN)
+            WINDOW_END = xtred.repeat_end + SPAN
+            profiled = profile.locus(xtred)
+            try:
+                if isinstance(locus, Exception):  # The reads cannot be fetched
+                    fetch_error, locus = locus, None
+                    raise fetch_error
+                if "depth" not in profiled:
+                    profiled["depth"] = locus.depth(xtred.chr, WINDOW_START,
+                                                    WINDOW_END)
+                depth = profiled["depth"]
+            except Exception as e:
+                depth = 30
+                logger.error("Exception on `{}` {} ({}). Set depth={}"\
+                            .format(bam, tred, e, depth))
+
+            logger.debug("Inferred depth at locus {}: {}".format(tred, depth))
+            ip = InputParams(bam=bam, READLEN=READLEN, tredName=tred,
+                             repo=repo, maxinsert=task.maxinsert,
+                             fullsearch=task.fullsearch, gender=gender,
+                             depth=depth, clip=task.clip, alts=task.alts,
+                             repeatpairs=task.repeatpairs,
+                             repeatgraph=task.repeatgraph,
+                             unitsearch=task.unitsearch,
+                             strandvote=task.strandvote, triage=task.triage,
+                             fastpath=task.fastpath, threads=task.threads,
+                             procs=task.locuscpus, detailseqs=task.detailseqs,
+                             batchalign=task.batchalign,
+                             longreads=task.longreads, session=session,
+                             locus=locus, altreads=altreads, profile=profile,
+                             pool=pool, log=task.log)
+
+            #tpResult = runBam(ip)
+            try:
+                tpResult = runBam(ip)
+            except Exception as e:
+                logger.error("Exception on `{}` {} ({})".format(bam, tred, e))
+                continue
 
+            alleles = tpResult.alleles
+            tredCalls[tred + ".1"] = alleles[0] # .1 is the shorter allele
+            tredCalls[tred + ".2"] = alleles[1] # .2 is the longer allele
+            tredCalls[tred + ".FR"] = counter_s(tpResult.counts["FULL"])
+            tredCalls[tred + ".PR"] = counter_s(tpResult.counts["PREF"])
+            tredCalls[tred + ".RR"] = counter_s(tpResult.counts["REPT"])
+            tredCalls[tred + ".DP"] = depth             # Average read depth
+            tredCalls[tred + ".FDP"] = tpResult.FDP     # Full spanning depth
+            tredCalls[tred + ".PDP"] = tpResult.PDP     # Partial depth
+            tredCalls[tred + ".RDP"] = tpResult.RDP     # Repeat read depth
+            tredCalls[tred + ".PEDP"] = tpResult.PEDP   # PE depth
+            tredCalls[tred + ".PEG"] = tpResult.PEG     # PE global estimate
+            tredCalls[tred + ".PET"] = tpResult.PET     # PE target estimate
+            tredCalls[tred + ".CI"] = tpResult.CI       # Confidence interval
+            tredCalls[tred + ".PP"] = tpResult.PP       # Prob(disease)
+            tredCalls[tred + ".label"] = tpResult.label # Disease status
+
+            # Following output are relatively big array of numbers that mostly
+            # specify probability distribution, only available in JSON output
+            tredCalls[tred + ".details"] = tpResult.details
+            tredCalls[tred + ".P_h1"] = tpResult.P_h1
+            tredCalls[tred + ".P_h2"] = tpResult.P_h2
+            tredCalls[tred + ".P_h1h2"] = tpResult.P_h1h2
+            tredCalls[tred + ".P_PEG"] = tpResult.P_PEG
+            tredCalls[tred + ".P_PET"] = tpResult.P_PET
+            if task.unitsearch == "validate":
+                tredCalls[tred + ".unitsearch"] = tpResult.unitsearch
+            if task.triage:
+                tredCalls[tred + ".triage"] = tpResult.triage
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    if task.readcache:
+        logger.debug("Read cache: {} hits, {} misses ({} reads cached)"\
+                    .format(READCACHE.hits, READCACHE.misses, len(READCACHE)))
+    profile.save()
+    session.close()
     cleanup(cwd, samplekey)
     return {'samplekey': samplekey, 'bam': bam, 'tredCalls': tredCalls}
 
 
+def extract(task):
+    '''
+    Write the reads that a list of treds needs into a mini-BAM
+    :param task: SampleTask, with the bam file and the treds of the sample
+    :return: path to the mini-BAM, samplekey.bam in the workdir
+    '''
+    samplekey, bam, repo, tredNames = task.samplekey, task.bam, task.repo, \
+                task.tredNames
+    minibam = op.abspath(samplekey + ".bam")
+    if minibam == bam:
+        logger.error("Mini-BAM would overwrite `{}`".format(bam))
+        return None
+    cwd = os.getcwd()
+    mkdir(samplekey)
+    os.chdir(samplekey)
+    session = check_bam(bam, task.iothreads)
+    if session is None:
+        cleanup(cwd, samplekey)
+        return None
+
+    # Sample facts that the reads of the mini-BAM cannot give back
+    facts = {}
+    try:
+        bd = BamDepth(session, repo.ref, logger)
+        facts["gender." + repo.ref] = bd.infer_gender()
+    except:
+        pass
+    try:
+        facts["readLen"] = BamReadLen(session, logger).readlen
+    except:
+        pass
+
+    write_evidence(session, [repo[x] for x in tredNames], repo.ref, minibam,
+                   logger, facts=facts)
+    session.close()
+    cleanup(cwd, samplekey)
+    return minibam
+
+
 def vcfstanza(sampleid, bam, tredCalls, ref):
     # VCF spec
     m = "##fileformat=VCFv4.1\n"
     m += "##fileDate={}{:02d}{:02d}\n".format(dt.now().year, dt.now().month, dt.now().day)
     m += "##source={} {}\n".format(__file__, bam)
     m += "##reference={}\n".format(ref)
-    m += "##inferredGender={} depthY={}\n".format(
-                    tredCalls["inferredGender"], tredCalls["depthY"])
+    m += "##inferredGender={} depthY={} ratioX={}\n".format(
+                    tredCalls["inferredGender"], tredCalls["depthY"],
+                    tredCalls.get("ratioX"))
     m += "##readLen={}bp\n".format(tredCalls["readLen"])
     m += INFO
     header = "CHROM POS ID REF ALT QUAL FILTER INFO FORMAT\n".split() + [sampleid]
@@ -485,17 +674,36 @@ def main(args):
 
     task_args = []
     sites = op.join(os.getcwd(), "sites")
+    panels = op.abspath(args.panels) if args.panels else None
+    profiles = op.abspath(args.profiles) if args.profiles else None
+    blockcache = (op.abspath(args.blockcache), args.blockcachesize << 20) \
+                    if args.blockcache else None
     os.chdir(workdir)
+    if profiles:
+        mkdir(profiles, logger=logger)
 
     ref = args.ref
     repo = TREDsRepo(ref=ref, toy=args.toy, sites=sites)
     repo.set_ploidy(args.haploid)
+    if panels:
+        if op.exists(panels):
+            load_panels(panels)
+        else:
+            precompile_panels(repo, panels)
+        logger.debug("Aligner panels loaded from `{}`".format(panels))
     TRED_NAMES = repo.names
     treds = args.tred or TRED_NAMES
 
     if args.toy:
         treds = ["HD"]
 
+    triage = ()
+    if args.triage:
+        triage = TRIAGE if args.triage == "all" else tuple(args.triage.split(","))
+        unknown = set(triage) - set(TRIAGE)
+        if unknown:
+            p.error("Unknown triage reasons: {}".format(", ".join(sorted(unknown))))
+
     samplekey_index = {}
     # Parallel processing
     for i, (samplekey, bam, tred) in enumerate(samples):
@@ -505,10 +713,23 @@ def main(args):
                             .format(jsonfile))
             continue
         _treds = [tred] if tred else treds
-        task_args.append((samplekey, bam, repo, _treds,
-                          args.maxinsert, args.fullsearch,
-                          args.useclippedreads, (not args.noalts),
-                          (not args.norepeatpairs), args.log))
+        task_args.append(SampleTask(samplekey=samplekey, bam=bam, repo=repo,
+                          tredNames=_treds, maxinsert=args.maxinsert,
+                          fullsearch=args.fullsearch,
+                          clip=args.useclippedreads, alts=(not args.noalts),
+                          repeatpairs=(not args.norepeatpairs),
+                          repeatgraph=args.repeatgraph,
+                          unitsearch=args.unitsearch,
+                          strandvote=args.strandvote,
+                          readcache=args.readcache,
+                          sharereadcache=args.sharereadcache, triage=triage,
+                          fastpath=args.fastpath, threads=args.threads,
+                          locuscpus=args.locuscpus,
+                          detailseqs=(not args.nodetailseqs),
+                          batchalign=(not args.nobatchalign),
+                          longreads=args.longreads, profiles=profiles,
+                          prefetch=args.prefetch, iothreads=args.iothreads,
+                          blockcache=blockcache, log=args.log))
         samplekey_index[samplekey] = i
 
     cpus = min(args.cpus, len(task_args))
@@ -518,7 +739,14 @@ def main(args):
 
     logger.debug("Starting {} threads for {} jobs.".format(cpus, len(task_args)))
 
-    if cpus == 1:  # Serial
+    if args.minibam:  # Extraction, without calls
+        if cpus == 1:
+            minibams = map(extract, task_args)
+        else:
+            minibams = Pool(processes=cpus).map(extract, task_args)
+        logger.debug("Mini-BAMs written: {}".format(
+                        ", ".join(x for x in minibams if x)))
+    elif cpus == 1:  # Serial
         for ta in task_args:
             results = run(ta)
             if args.no_output:
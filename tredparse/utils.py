@@ -18,6 +18,7 @@ import shutil
 import sys
 import logging
 
+from collections import OrderedDict
 from subprocess import PIPE, call
 
 
@@ -29,7 +30,12 @@ class InputParams:
 
     def __init__(self, bam, READLEN, repo, tredName,
                        gender="Unknown", depth=30,
-                       clip=False, alts=True, repeatpairs=False, **kwargs):
+                       clip=False, alts=True, repeatpairs=False,
+                       repeatgraph=False, unitsearch="exhaustive",
+                       strandvote=False, triage=(), fastpath=False, threads=1,
+                       procs=1, detailseqs=True, batchalign=True,
+                       longreads=False, session=None, locus=None,
+                       altreads=None, profile=None, pool=None, **kwargs):
         self.bam = bam
         self.READLEN = READLEN
         self.tredName = tredName
@@ -39,6 +45,21 @@ class InputParams:
         self.clip = clip                # Use clipped reads?
         self.alts = alts                # More exhaustive search?
         self.repeatpairs = repeatpairs  # Include pairs of REPT reads?
+        self.repeatgraph = repeatgraph  # Align to the repeat graph?
+        self.unitsearch = unitsearch    # Targets to align reads against
+        self.strandvote = strandvote    # Align reads to one strand only?
+        self.triage = triage            # Reasons to skip reads before alignment
+        self.fastpath = fastpath        # Count units of clean reads directly?
+        self.threads = threads          # Threads classifying the reads of a locus
+        self.procs = procs              # Processes classifying the reads of a locus
+        self.detailseqs = detailseqs    # Keep the read sequences in the details?
+        self.batchalign = batchalign    # Align the reads in batches of SIMD lanes?
+        self.longreads = longreads      # Measure the repeat tract of long reads?
+        self.session = session          # Alignment file opened once for the sample
+        self.locus = locus              # Reads of the locus fetched once
+        self.altreads = altreads        # Mismapped reads of the sample by locus
+        self.profile = profile          # Sample facts reused across runs
+        self.pool = pool                # Processes classifying the reads, for all loci
         self.kwargs = kwargs
         self.ref = repo.ref
 
@@ -51,6 +72,47 @@ class InputParams:
         return numericLevel
 
 
+class LRUCache(object):
+    '''
+    Bounded mapping that evicts the least recently used keys first, and counts
+    the lookups that hit and miss
+    '''
+    def __init__(self, maxsize=0):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __setitem__(self, key, value):
+        self.data.pop(key, None)
+        self.data[key] = value
+        self.resize(self.maxsize)
+
+    def get(self, key, default=None):
+        try:
+            value = self.data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.data[key] = value  # Most recently used
+        self.hits += 1
+        return value
+
+    def resize(self, maxsize):
+        self.maxsize = maxsize
+        while len(self.data) > maxsize:
+            self.data.popitem(last=False)
+
+    def clear(self):
+        self.data.clear()
+        self.hits = self.misses = 0
+
+
 class DefaultHelpParser(argparse.ArgumentParser):
 
     def error(self, message):